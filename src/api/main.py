@@ -1,9 +1,18 @@
 import os
+import gc
 import sys
+import time
+import signal
+import socket
+import asyncio
 import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field
+from typing import List, Optional
 from enum import Enum
 
 from rag import rag
@@ -13,10 +22,206 @@ class LLMModel(str, Enum):
     gemini_finetuned = "gemini-finetuned"
 
 
+class BatchQuery(BaseModel):
+    prompts: List[str] = Field(..., min_length=1, max_length=rag.BATCH_SIZE)
+    llm_choice: LLMModel = LLMModel.gemini_default
+
+
+class IngestStep(str, Enum):
+    chunk = "chunk"
+    embed = "embed"
+    store = "store"
+
+
+class IngestRequest(BaseModel):
+    # Either a weblink to a decision document (interactive priority) or a list
+    # of bulk pipeline steps (low priority).
+    url: Optional[str] = None
+    steps: List[IngestStep] = []
+
+
 UVICORN_PORT = os.environ.get("UVICORN_PORT", "9000")
 
+# Responses smaller than this are sent uncompressed.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1000"))
+
+# Worker processes forked by serve_prefork(). 1 runs a single uvicorn process.
+API_WORKERS = int(os.environ.get("API_WORKERS", "1"))
+
+# nginx's status for a request the client gave up on.
+HTTP_CODE_CLIENT_CLOSED = 499
+
+
+def http_status_of(ret_val):
+    # RAG error codes are small integers; anything below 400 is a server error.
+    return ret_val if ret_val >= 400 else 500
+
+
+def retry_headers(status_code):
+    # Overloaded (503) and rate limited (429) clients are told when to retry.
+    if status_code in (rag.HTTP_CODE_TOO_MANY_REQUESTS, rag.HTTP_CODE_OVERLOADED):
+        return {"Retry-After": str(rag.retry_after_sec())}
+    return {}
+
+
+async def wait_for_disconnect(request):
+    # The request has no body; the next ASGI message is the disconnect.
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(request, coro):
+    """
+    Awaits 'coro' unless the client disconnects first, in which case it is
+    cancelled: queued CPU pool tasks are dropped and computations nobody
+    else waits for are stopped (see rag.SingleFlight).
+    Returns: (True, result of coro) or (False, None) after a disconnect.
+    """
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    if not task.done() or task.cancelled():
+        return False, None
+    return True, task.result()
+
+
+def client_closed():
+    return JSONResponse(content={"error": "Client closed request"}, status_code=HTTP_CODE_CLIENT_CLOSED)
+
+
+def format_sse(data, event=None):
+    # Each line of the payload needs its own "data:" field; the client
+    # joins them back together with newlines.
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
+
+
+async def sse_events(chunks, served_llm):
+    # The model that answers comes first: it differs from llm_choice when
+    # the chosen one failed before its first chunk.
+    yield format_sse(served_llm, event="model")
+    try:
+        async for chunk in chunks:
+            yield format_sse(chunk)
+    except Exception as e:
+        yield format_sse(f"Communication with LLM failed. Error: {e}", event="error")
+        return
+    yield format_sse("", event="end")
+
+
+class InFlightMiddleware:
+    # Plain ASGI middleware: unlike @app.middleware("http"), it keeps a
+    # streaming response counted until its last chunk is sent.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        rag.REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            rag.REQUESTS_IN_FLIGHT.dec()
+
+
+class RateLimitMiddleware:
+    # Per-client token bucket in front of the query endpoints (see
+    # rag.RateLimiter). Behind the load balancer the client is the first
+    # X-Forwarded-For address.
+    def __init__(self, app, limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/query"):
+            return await self.app(scope, receive, send)
+
+        wait = self.limiter.acquire(client_of(scope))
+        if not wait:
+            return await self.app(scope, receive, send)
+
+        rag.ADMISSION_REJECTED.inc("client", "rate_limited")
+        response = JSONResponse(
+            content={"error": f"Rate limit exceeded, retry after {wait} seconds."},
+            status_code=rag.HTTP_CODE_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(wait)},
+        )
+        await response(scope, receive, send)
+
+
+def client_of(scope):
+    for name, value in scope["headers"]:
+        if name == b"x-forwarded-for":
+            return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else ""
+
+
+class EncodedETagMiddleware:
+    # A strong ETag of a gzip-compressed response gets the encoding as
+    # suffix, as the bytes differ. Sits outside GZipMiddleware, which never
+    # compresses Server-Sent Events.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_tagged(message):
+            if message["type"] == "http.response.start":
+                tag_etag(message)
+            await send(message)
+
+        await self.app(scope, receive, send_tagged)
+
+
+def tag_etag(message):
+    headers = dict(message["headers"])
+    encoding = headers.get(b"content-encoding")
+    etag = headers.get(b"etag")
+    if encoding and etag and etag.startswith(b'"'):
+        tagged = etag[:-1] + b"-" + encoding + b'"'
+        message["headers"] = [
+            (name, tagged if name == b"etag" else value) for name, value in message["headers"]
+        ]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load spaCy, the gazetteers and the embedding, LLM and ChromaDB clients
+    # once per worker so that requests only pay for the actual work. It runs
+    # in the background: /healthz answers right away, /readyz once it is done.
+    warm_up_task = asyncio.create_task(rag.warm_up())
+    yield
+    warm_up_task.cancel()
+    await rag.close_job_queue()
+    rag.close_cpu_pool()
+    rag.close_clients()
+
+
 # Setup FastAPI app
-app = FastAPI(title="API Server", description="API Server", version="v1")
+app = FastAPI(
+    title="API Server", description="API Server", version="v1", lifespan=lifespan
+)
+
+# The last middleware added is the outermost: CORS wraps the rate limiter so
+# that its 429 responses reach browsers with their CORS headers.
+if rag.RATE_LIMIT_RPS > 0:
+    app.add_middleware(
+        RateLimitMiddleware,
+        limiter=rag.RateLimiter(rag.RATE_LIMIT_RPS, rag.RATE_LIMIT_BURST),
+    )
 
 # Enable CORSMiddleware
 app.add_middleware(
@@ -26,6 +231,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(InFlightMiddleware)
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_BYTES, compresslevel=6)
+app.add_middleware(EncodedETagMiddleware)
 
 
 # Routes
@@ -33,17 +241,233 @@ app.add_middleware(
 async def get_index():
     return {"message": "Welcome to Formula One Penalty Analysis Tool"}
 
+@app.get("/healthz")
+async def get_healthz():
+    # Liveness: the event loop is serving requests.
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def get_readyz():
+    # Readiness: spaCy, the gazetteers and the backend clients are loaded.
+    ready, checks = rag.readiness()
+    return JSONResponse(
+        content={"status": "ready" if ready else "warming up", "checks": checks},
+        status_code=200 if ready else 503,
+    )
+
+
 @app.get("/query/")
-async def query_llm(prompt: str, llm_choice: LLMModel = LLMModel.gemini_default):
+async def query_llm(
+    request: Request,
+    prompt: str,
+    llm_choice: LLMModel = LLMModel.gemini_default,
+    trace: bool = False,
+    x_trace: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    deadline: Optional[float] = Query(None, gt=0, le=600),
+):
+    # 'deadline' (seconds) overrides QUERY_DEADLINE_SEC for this request.
+    # Opt-in per-request timing breakdown: '?trace=true' or 'X-Trace: 1'.
+    want_trace = trace or (x_trace or "").lower() in ("1", "true", "yes")
+    # Traced responses carry their own timings; they are never revalidated.
+    if want_trace:
+        if_none_match = None
+
+    async def run_query():
+        # The served model, the ETag and the degraded stages are set in the
+        # context of the query task.
+        ret_str, ret_val = await rag.query_async(prompt, llm_choice.value, if_none_match, deadline)
+        return ret_str, ret_val, rag.served_llm.get(), rag.response_etag.get(), rag.degraded_stages.get()
+
+    with rag.start_trace("query", force=want_trace) as request_trace:
+        completed, result = await cancel_on_disconnect(request, run_query())
+    if not completed:
+        return client_closed()
+    ret_str, ret_val, served_llm, etag, degraded = result
 
-    ret_str, ret_val = rag.query(prompt, llm_choice.value)
+    # Clients revalidate with If-None-Match before reusing a stored answer.
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag and not want_trace else {}
+    if ret_val == rag.HTTP_CODE_NOT_MODIFIED:
+        return Response(status_code=ret_val, headers=cache_headers)
 
     if ret_val == rag.HTTP_CODE_GENERIC_SUCCESS:
-        return JSONResponse(content={"response": ret_str}, status_code=ret_val)
+        # 'model' differs from llm_choice when a hedge or fallback answered;
+        # 'degraded' lists the context sections dropped to meet the deadline.
+        content = {"response": ret_str, "model": served_llm, "degraded": degraded or {}}
+        status_code = ret_val
     else:
-        http_status = ret_val if ret_val >= 400 else 500
-        return JSONResponse(content={"error": ret_str}, status_code=http_status)
+        content, status_code = {"error": ret_str}, http_status_of(ret_val)
+
+    headers = {**retry_headers(status_code), **cache_headers}
+    if request_trace is not None:
+        headers["X-Trace-Id"] = request_trace.trace_id
+        if want_trace:
+            content["timings"] = request_trace.breakdown()
+
+    return JSONResponse(content=content, status_code=status_code, headers=headers)
+
+
+@app.get("/query/stream")
+async def query_llm_stream(
+    request: Request,
+    prompt: str,
+    llm_choice: LLMModel = LLMModel.gemini_default,
+    deadline: Optional[float] = Query(None, gt=0, le=600),
+):
+
+    async def run_query():
+        # The served model is set in the context of the query task.
+        ret, ret_val = await rag.query_stream_async(prompt, llm_choice.value, deadline)
+        return ret, ret_val, rag.served_llm.get()
+
+    # Once streaming, StreamingResponse stops on a disconnect by itself.
+    completed, result = await cancel_on_disconnect(request, run_query())
+    if not completed:
+        return client_closed()
+    ret, ret_val, served_llm = result
+
+    if ret_val != rag.HTTP_CODE_GENERIC_SUCCESS:
+        status_code = http_status_of(ret_val)
+        return JSONResponse(
+            content={"error": ret}, status_code=status_code, headers=retry_headers(status_code)
+        )
+
+    return StreamingResponse(
+        sse_events(ret, served_llm),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/query/batch")
+async def query_llm_batch(batch: BatchQuery):
+
+    results = await rag.query_batch_async(batch.prompts, batch.llm_choice.value)
+
+    items = []
+    for prompt, (ret_str, ret_val) in zip(batch.prompts, results):
+        if ret_val == rag.HTTP_CODE_GENERIC_SUCCESS:
+            items.append({"prompt": prompt, "status_code": ret_val, "response": ret_str})
+        else:
+            items.append(
+                {"prompt": prompt, "status_code": http_status_of(ret_val), "error": ret_str}
+            )
+
+    return JSONResponse(content={"results": items}, status_code=200)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=rag.render_metrics(), media_type=rag.METRICS_CONTENT_TYPE)
+
+
+@app.post("/ingest")
+async def ingest(request: IngestRequest):
+
+    if bool(request.url) == bool(request.steps):
+        return JSONResponse(
+            content={"error": "Provide either 'url' or 'steps'"}, status_code=422
+        )
+
+    if request.url:
+        job = await rag.submit_url_ingest(request.url)
+        if job is None:
+            return JSONResponse(content={"error": "Invalid weblink"}, status_code=422)
+    else:
+        job = await rag.submit_corpus_ingest([step.value for step in request.steps])
+        if job is None:
+            return JSONResponse(content={"error": "Unknown ingest steps"}, status_code=422)
+
+    return JSONResponse(
+        content=job.to_dict(), status_code=202, headers={"Location": f"/jobs/{job.id}"}
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+
+    job = rag.get_job(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+
+    return JSONResponse(content=job.to_dict(), status_code=200)
+
+
+def run_worker(sock):
+    # Runs in a forked child: one uvicorn server on the inherited socket.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def serve_prefork(workers, port):
+    """
+    Pre-fork master: loads spaCy and the gazetteers once, then forks
+    'workers' uvicorn processes that share the listening socket and, copy
+    on write, the read-only model memory. Dead workers are replaced;
+    SIGTERM/SIGINT stop them all.
+    """
+    rag.init_globals()
+    # Keep the garbage collector from touching (and so copying) the pages
+    # of the objects loaded so far.
+    gc.freeze()
+
+    # Each worker has its own GIL already; a CPU pool per worker would
+    # load one more spaCy copy per process.
+    if "CPU_WORKERS" not in os.environ:
+        rag.CPU_WORKERS = 0
+
+    sock = socket.create_server(("0.0.0.0", port), backlog=2048)
+    sock.set_inheritable(True)
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                run_worker(sock)
+                code = 0
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+    print(f"Pre-fork master {os.getpid()}: {workers} workers on port {port}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        print(f"Worker {pid} exited with status {status}, restarting")
+        # Do not spin on a worker that dies right at startup.
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        spawn()
+
+    sock.close()
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=int(UVICORN_PORT), log_level="info")
+    if API_WORKERS > 1:
+        serve_prefork(API_WORKERS, int(UVICORN_PORT))
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=int(UVICORN_PORT), log_level="info")
@@ -246,6 +246,36 @@ def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
                                     protocol="TCP",
                                 )
                             ],
+                            # The entrypoint may run --store before the server
+                            # starts; allow up to 10 minutes for that.
+                            startup_probe=k8s.core.v1.ProbeArgs(
+                                http_get=k8s.core.v1.HTTPGetActionArgs(
+                                    path="/healthz",
+                                    port=9000,
+                                ),
+                                period_seconds=10,
+                                failure_threshold=60,
+                            ),
+                            liveness_probe=k8s.core.v1.ProbeArgs(
+                                http_get=k8s.core.v1.HTTPGetActionArgs(
+                                    path="/healthz",
+                                    port=9000,
+                                ),
+                                period_seconds=10,
+                                timeout_seconds=5,
+                                failure_threshold=3,
+                            ),
+                            # No traffic until spaCy, the gazetteers and the
+                            # backend clients are loaded.
+                            readiness_probe=k8s.core.v1.ProbeArgs(
+                                http_get=k8s.core.v1.HTTPGetActionArgs(
+                                    path="/readyz",
+                                    port=9000,
+                                ),
+                                period_seconds=5,
+                                timeout_seconds=3,
+                                failure_threshold=3,
+                            ),
                             volume_mounts=[
                                 k8s.core.v1.VolumeMountArgs(
                                     name="persistent-vol",
@@ -0,0 +1,434 @@
+import os
+import re
+import sys
+import time
+import signal
+import argparse
+import threading
+import statistics
+import subprocess
+import http.client
+from urllib.parse import quote
+
+# Modules that must not be pulled in by a plain 'from rag import rag'. They
+# are loaded lazily by the functions that need them.
+HEAVY_MODULES = [
+    "spacy",
+    "pandas",
+    "chromadb",
+    "vertexai",
+    "langchain_text_splitters",
+    "pypdf",
+    "country_converter",
+    "countryinfo",
+    "google.cloud.storage",
+]
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MAIN_PY = os.path.join(SRC_DIR, "api", "main.py")
+
+IMPORT_STMT = "from rag import rag"
+
+# Prints the heavy modules that ended up in sys.modules, one per line.
+IMPORT_PROBE = (
+    IMPORT_STMT
+    + "\nimport sys"
+    + "\nfor m in %r:" % (HEAVY_MODULES,)
+    + "\n    print(m) if m in sys.modules else None"
+)
+
+# Queries and decision document names of the shape seen in production,
+# including the unit test cases.
+EXTRACT_SAMPLES = [
+    "This is Japanese car",
+    "2019 Sakhir Grand Prix",
+    "infringement of Car 30 in 2024 abu dhabi GP",
+    "Is the infringement of Car 30 in 2024 abu dhabi Grand Prix fair",
+    "Is the Car 30 infringement in 2024 Abu Dhabi Grand Prix a fair penalty?",
+    "Was Car 1's penalty fair in Bahrain 2024?",
+    "Car 1 - Unsafe release, 2024 Italian Grand Prix",
+    "2023 Las Vegas Grand Prix - Infringement - Car 4 - Leaving the track",
+    "2020 Eifel Grand Prix - Offence - Car 11 - Causing a collision",
+    "2021 Styrian Grand Prix - Car 44 - Impeding",
+    "2024 British Grand Prix - Cars 16 and 55 - Pit lane speeding",
+    "Observation abou Car 15 in 2019 Austria Grand Prix",
+    "2022 Emilia Romagna Grand Prix - Car 14 - Track limits",
+    "2024 Sao Paulo Grand Prix - Car 63 - Red flag infringement",
+]
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = SRC_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def run_import(env):
+    """
+    Import rag in a fresh interpreter with -X importtime. Returns the wall
+    time in ms, the heavy modules that got imported and the importtime
+    records as (cumulative_us, self_us, module) tuples.
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_PROBE],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    if proc.returncode != 0:
+        errors = [
+            line for line in proc.stderr.splitlines() if not IMPORTTIME_RE.match(line)
+        ]
+        raise RuntimeError(f"'{IMPORT_STMT}' failed:\n" + "\n".join(errors))
+
+    heavy = proc.stdout.split()
+    records = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            records.append((int(match.group(2)), int(match.group(1)), match.group(4)))
+
+    return elapsed_ms, heavy, records
+
+
+def bench_import(args):
+    env = import_env()
+    if args.no_env:
+        for name in [
+            "GCP_PROJECT",
+            "GCP_BUCKET",
+            "ROOT_DIR",
+            "DATASET_DIR",
+            "OUTPUT_DIR",
+            "CHROMADB_HOST",
+            "CHROMADB_PORT",
+            "CSV_ROOT",
+        ]:
+            env.pop(name, None)
+
+    timings = []
+    heavy = []
+    records = []
+    for _ in range(args.runs):
+        elapsed_ms, heavy, records = run_import(env)
+        timings.append(elapsed_ms)
+
+    median_ms = statistics.median(timings)
+    print(
+        f"'{IMPORT_STMT}': median {median_ms:.1f} ms over {args.runs} runs (min {min(timings):.1f} ms, max {max(timings):.1f} ms)"
+    )
+
+    print(f"Top {args.top} modules by cumulative import time:")
+    for cumulative_us, self_us, module in sorted(records, reverse=True)[: args.top]:
+        print(
+            f"  {cumulative_us / 1000:8.1f} ms  {self_us / 1000:8.1f} ms self  {module}"
+        )
+
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported at module load: {', '.join(heavy)}")
+        failed = True
+    if args.max_ms and median_ms > args.max_ms:
+        print(
+            f"FAIL: median import time {median_ms:.1f} ms exceeds budget of {args.max_ms} ms"
+        )
+        failed = True
+
+    return 1 if failed else 0
+
+
+def import_rag():
+    # Works both as 'python benchmark.py' and when imported by the tests.
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    from rag import rag
+
+    return rag
+
+
+def time_calls(fn, texts, runs):
+    # Returns the median time of one call in ms.
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        timings.append((time.perf_counter() - start) * 1000 / len(texts))
+    return statistics.median(timings)
+
+
+def compare_extractors(rag, texts):
+    # Returns [(text, compiled, nlp)] for the texts the compiled matcher
+    # resolves (not ambiguous) to another location than the spaCy path.
+    matcher = rag.get_location_matcher()
+    mismatches = []
+    for text in texts:
+        location, ambiguous = matcher.match(text)
+        if ambiguous:
+            continue
+        expected = rag.extract_place_with_nlp(text)
+        if location != expected:
+            mismatches.append((text, location, expected))
+    return mismatches
+
+
+def bench_extract(args):
+    rag = import_rag()
+    rag.init_globals()
+    texts = EXTRACT_SAMPLES
+
+    ambiguous = [text for text in texts if rag.get_location_matcher().match(text)[1]]
+    compiled_ms = time_calls(rag.get_location_matcher().match, texts, args.runs)
+    nlp_ms = time_calls(rag.extract_place_with_nlp, texts, args.runs)
+    print(f"{len(texts)} texts, {len(ambiguous)} left to spaCy as ambiguous")
+    print(f"  compiled matcher: {compiled_ms:8.3f} ms per text")
+    print(f"  spaCy path:       {nlp_ms:8.3f} ms per text")
+    print(f"  speedup:          {nlp_ms / compiled_ms:8.1f}x")
+
+    mismatches = compare_extractors(rag, texts)
+    for text, location, expected in mismatches:
+        print(f"FAIL: {text!r}: compiled {location!r} != spaCy {expected!r}")
+
+    return 1 if mismatches else 0
+
+
+def bench_metadata(args):
+    rag = import_rag()
+    rag.init_globals()
+    # A corpus pass sees many similar file names.
+    texts = [
+        f"{text} - document {i}" for i in range(args.repeat) for text in EXTRACT_SAMPLES
+    ]
+
+    start = time.perf_counter()
+    single = [
+        rag.parse_metadata_from_text(text, rag.extract_place_with_nlp) for text in texts
+    ]
+    single_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    bulk = rag.parse_metadata_bulk(texts, n_process=args.n_process)
+    bulk_ms = (time.perf_counter() - start) * 1000
+
+    print(f"{len(texts)} file names")
+    print(f"  one spaCy call per name: {single_ms:8.1f} ms")
+    print(f"  parse_metadata_bulk():   {bulk_ms:8.1f} ms")
+    print(f"  speedup:                 {single_ms / bulk_ms:8.1f}x")
+
+    mismatches = [(text, a, b) for text, a, b in zip(texts, bulk, single) if a != b]
+    for text, a, b in mismatches:
+        print(f"FAIL: {text!r}: bulk {a} != single {b}")
+
+    return 1 if mismatches else 0
+
+
+def process_tree(pid):
+    # 'pid' and all its descendants (workers, CPU pool processes).
+    pids = [pid]
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children = f.read().split()
+        except FileNotFoundError:
+            continue
+        for child in children:
+            pids.extend(process_tree(int(child)))
+    return pids
+
+
+def process_memory(pids):
+    """
+    Summed Rss and Pss of 'pids' in MB. Rss counts the pages shared copy on
+    write once per process; Pss splits them between the sharers, so the
+    summed Pss is what the pod really uses.
+    """
+    totals = {"Rss": 0, "Pss": 0}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name in totals:
+                        totals[name] += int(value.split()[0])
+        except FileNotFoundError:
+            continue
+    return totals["Rss"] / 1024, totals["Pss"] / 1024
+
+
+def wait_for_server(port, path, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", path)
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(1)
+    return False
+
+
+def generate_load(port, path, concurrency, duration):
+    # Keep-alive clients hammering 'path'. Returns (latencies in s, errors).
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except OSError:
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def percentile_ms(latencies, q):
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))] * 1000
+
+
+def bench_serve(args):
+    path = args.path or "/query/?prompt=" + quote(EXTRACT_SAMPLES[4])
+    print(
+        f"{'workers':>7} {'rss MB':>8} {'pss MB':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6}"
+    )
+
+    failed = False
+    for workers in [int(n) for n in args.workers.split(",")]:
+        env = import_env()
+        env.update(API_WORKERS=str(workers), UVICORN_PORT=str(args.port))
+        server = subprocess.Popen(
+            [sys.executable, MAIN_PY],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not wait_for_server(args.port, args.wait_path, args.startup_timeout):
+                print(f"FAIL: {workers} workers: {args.wait_path} not up")
+                failed = True
+                continue
+            latencies, errors = generate_load(
+                args.port, path, args.concurrency, args.duration
+            )
+            # Measured after the load, once the workers have touched their
+            # share of the model pages.
+            rss_mb, pss_mb = process_memory(process_tree(server.pid))
+            print(
+                f"{workers:>7} {rss_mb:>8.0f} {pss_mb:>8.0f} {len(latencies) / args.duration:>8.1f} "
+                f"{percentile_ms(latencies, 50):>8.1f} {percentile_ms(latencies, 99):>8.1f} {errors:>6}"
+            )
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG micro benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser(
+        "import", help="Measure the cold import time of the rag module"
+    )
+    import_parser.add_argument(
+        "--runs", type=int, default=5, help="Number of fresh interpreters to time"
+    )
+    import_parser.add_argument(
+        "--top", type=int, default=15, help="Number of slowest modules to list"
+    )
+    import_parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=0,
+        help="Fail if the median import time exceeds this budget",
+    )
+    import_parser.add_argument(
+        "--no-env",
+        action="store_true",
+        help="Import without the deployment environment variables",
+    )
+    import_parser.set_defaults(func=bench_import)
+
+    extract_parser = subparsers.add_parser(
+        "extract",
+        help="Compare the compiled location matcher with the spaCy path",
+    )
+    extract_parser.add_argument(
+        "--runs", type=int, default=20, help="Number of passes over the samples"
+    )
+    extract_parser.set_defaults(func=bench_extract)
+
+    metadata_parser = subparsers.add_parser(
+        "metadata",
+        help="Compare per-file metadata extraction with parse_metadata_bulk()",
+    )
+    metadata_parser.add_argument(
+        "--repeat", type=int, default=50, help="Copies of each sample file name"
+    )
+    metadata_parser.add_argument(
+        "--n-process", type=int, default=1, help="nlp.pipe() worker processes"
+    )
+    metadata_parser.set_defaults(func=bench_metadata)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Memory and throughput of the API server per number of workers",
+    )
+    serve_parser.add_argument(
+        "--workers", default="1,2,4", help="Comma separated API_WORKERS values"
+    )
+    serve_parser.add_argument("--port", type=int, default=9100)
+    serve_parser.add_argument(
+        "--path", default="", help="Request path (default: a /query/ sample)"
+    )
+    serve_parser.add_argument(
+        "--wait-path",
+        default="/readyz",
+        help="Path that answers 200 once the server is up",
+    )
+    serve_parser.add_argument(
+        "--startup-timeout", type=float, default=600, help="Seconds to wait for it"
+    )
+    serve_parser.add_argument("--concurrency", type=int, default=16)
+    serve_parser.add_argument(
+        "--duration", type=float, default=20, help="Seconds of load per run"
+    )
+    serve_parser.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
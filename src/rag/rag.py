@@ -1,59 +1,124 @@
 import os
 import re
 import sys
+import time
+import asyncio
+import heapq
+import hashlib
+import sqlite3
+import threading
+import signal
+import bisect
+import functools
+import contextvars
+import itertools
+import uuid
 import glob
+import fcntl
 import json
 import argparse
-from pypdf import PdfReader
 from urllib import request
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager, ExitStack
 
+# NOTE: spaCy, pandas, Vertex AI, ChromaDB, LangChain, pypdf, GCS and the
+# country packages are imported by the functions that need them, so that
+# importing this module (the API server, '--help', unit tests) stays fast.
+# Keep it that way; 'python benchmark.py import' checks it.
 
-import pandas as pd
-
-import spacy
-from spacy.matcher import Matcher
-from spacy.cli import download
-
-import country_converter
-from countryinfo import CountryInfo
-
-# Langchain
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-
-# Vertex AI
-from vertexai.language_models import TextEmbeddingModel
-from vertexai.generative_models import GenerativeModel
-
-# GCP Storage
-from google.cloud import storage
-
-# Chromadb
-import chromadb
-
-# GCP related parameters
-GCP_PROJECT = os.environ["GCP_PROJECT"]
-GCP_BUCKET = os.environ["GCP_BUCKET"]
 GCP_LOCATION = "us-central1"
 
-# Data related parameters
-ROOT_DIR = os.environ["ROOT_DIR"]
-DATASET_DIR = os.environ["DATASET_DIR"]
-
-JSON_OUTPUT_DIR = os.environ["OUTPUT_DIR"]
-DECISION_JSON_DIR = JSON_OUTPUT_DIR + "/decision_jsons"
-REGULATION_JSON_DIR = JSON_OUTPUT_DIR + "/regulation_jsons"
-
 BATCH_SIZE = 250
 
-# ChromaDB related parameters
-
-CHROMADB_HOST = os.environ["CHROMADB_HOST"]
-CHROMADB_PORT = os.environ["CHROMADB_PORT"]
 CHUNK_SIZE = 250
+CHUNK_OVERLAP = 20
 
 DECISIONS_COLLECTION = "ac215-f1-decisions_collection"
 REGULATIONS_COLLECTION = "ac215-f1-regulations_collection"
 
+# Deadline for the concurrent retrieval stage of a query (STEP-5 to STEP-7).
+RETRIEVAL_TIMEOUT_SEC = float(os.environ.get("RETRIEVAL_TIMEOUT_SEC", "15"))
+
+# Overall deadline of a query (see start_deadline()), overridable per call.
+# The optional stages (historical precedents, regulations) only get what is
+# left after keeping LLM_MIN_BUDGET_SEC for the answer, and are skipped if
+# that is less than OPTIONAL_STAGE_MIN_SEC. With less than
+# LLM_TRIM_BELOW_SEC left for the LLM, their context is halved.
+QUERY_DEADLINE_SEC = float(os.environ.get("QUERY_DEADLINE_SEC", "90"))
+LLM_MIN_BUDGET_SEC = float(os.environ.get("LLM_MIN_BUDGET_SEC", "10"))
+LLM_TRIM_BELOW_SEC = float(os.environ.get("LLM_TRIM_BELOW_SEC", "20"))
+OPTIONAL_STAGE_MIN_SEC = 1.0
+
+# Per-request traces. TRACE_EXPORT_FILE enables tracing of every request and
+# appends one OTLP-JSON line per trace at least TRACE_EXPORT_MIN_MS long.
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE")
+TRACE_EXPORT_MIN_MS = float(os.environ.get("TRACE_EXPORT_MIN_MS", "0"))
+
+# Token budget of each context section of the prompt (see ContextAssembler).
+# Tokens are estimated at CHARS_PER_TOKEN characters each.
+CONTEXT_TOKEN_BUDGETS = {
+    "target": int(os.environ.get("TARGET_CONTEXT_TOKENS", "500")),
+    "historical": int(os.environ.get("HISTORICAL_CONTEXT_TOKENS", "500")),
+    "regulation": int(os.environ.get("REGULATION_CONTEXT_TOKENS", "300")),
+}
+CHARS_PER_TOKEN = 4
+# A passage is a near-duplicate if this share of its word trigrams already
+# appears in one passage of the context.
+CONTEXT_DEDUP_THRESHOLD = float(os.environ.get("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+# Deadline of the LLM stage of a query, hedge and fallback calls included.
+LLM_TIMEOUT_SEC = float(os.environ.get("LLM_TIMEOUT_SEC", "60"))
+
+# Optional hedging (see generate_with_fallback()): once the chosen model runs
+# past its LLM_HEDGE_PERCENTILE latency, a second request goes to the Gemini
+# model and the first answer wins. LLM_HEDGE_DEFAULT_SEC is used until
+# LLM_HEDGE_MIN_SAMPLES latencies have been seen.
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_DEFAULT_SEC = float(os.environ.get("LLM_HEDGE_DEFAULT_SEC", "15"))
+LLM_HEDGE_MIN_SEC = 1.0
+LLM_LATENCY_WINDOW = 200
+
+# Max concurrent LLM calls of one batch query.
+BATCH_LLM_CONCURRENCY = int(os.environ.get("BATCH_LLM_CONCURRENCY", "4"))
+
+# Admission control (see AdmissionGate): max concurrent Vertex AI calls per
+# worker and stage, and how many more may wait, for how long, before
+# requests are turned away with 503.
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "16"))
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "32"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_QUEUE_TIMEOUT_SEC = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SEC", "10"))
+
+# Per-client token bucket of the query endpoints (see RateLimiter).
+# RATE_LIMIT_RPS=0 disables it.
+RATE_LIMIT_RPS = float(os.environ.get("RATE_LIMIT_RPS", "0"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_MAX_CLIENTS = 10000
+
+# Worker processes of the API server for spaCy, PDF parsing and the
+# decision marker regexes (see get_cpu_pool()). 0 runs them on threads.
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", "2"))
+
+# Seconds between attempts of a failed startup warm-up (see warm_up()).
+WARMUP_RETRY_SEC = float(os.environ.get("WARMUP_RETRY_SEC", "10"))
+
+# Ingestion job queue. Bulk jobs never take the last worker, so a URL ingest
+# does not wait behind a corpus rebuild.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "2"))
+BULK_INGEST_WORKERS = int(os.environ.get("BULK_INGEST_WORKERS", "1"))
+JOB_HISTORY_SIZE = int(os.environ.get("JOB_HISTORY_SIZE", "1000"))
+
+# Answer cache. ANSWER_CACHE_DB enables the shared on-disk (SQLite) tier.
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL_SEC = float(os.environ.get("ANSWER_CACHE_TTL_SEC", "86400"))
+ANSWER_CACHE_DB = os.environ.get("ANSWER_CACHE_DB")
+
+# The on-disk cache tiers drop expired and surplus entries once every this
+# many writes of a process, rather than on every write.
+CACHE_DB_PRUNE_EVERY = 100
+
 # LLM related parameters
 EMBEDDING_MODEL = "text-embedding-004"
 EMBED_DIM = 256
@@ -88,11 +153,75 @@ ERROR_CODE_SPACY_FAILED = 6
 ERROR_CODE_INVALID_PARAM = 7
 
 HTTP_CODE_GENERIC_SUCCESS = 200
+HTTP_CODE_NOT_MODIFIED = 304
 HTTP_CODE_GENERIC_FAILURE = 400
+HTTP_CODE_TOO_MANY_REQUESTS = 429
+HTTP_CODE_OVERLOADED = 503
+HTTP_CODE_DEADLINE_EXCEEDED = 504
 
 nlp = None
 locations_list = None
 country_adjectives_map = None
+location_matcher = None
+gp_matcher = None
+
+# Prebuilt country and demonym lookups, see build_gazetteer().
+# Regenerate with: python src/rag/rag.py --build-gazetteer
+GAZETTEER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "gazetteer.json"
+)
+GAZETTEER_VERSION = 2
+
+# spaCy components the extraction does not read. The entities are only
+# compared with the "gpe" label, which en_core_web_sm never emits (its labels
+# are upper case), so dropping NER does not change any result.
+NLP_DISABLED_PIPES = ["lemmatizer", "ner"]
+
+# nlp.pipe() settings of the bulk metadata extraction, parse_metadata_bulk().
+NLP_BATCH_SIZE = int(os.environ.get("NLP_BATCH_SIZE", "256"))
+NLP_N_PROCESS = int(os.environ.get("NLP_N_PROCESS", "1"))
+
+# Longer texts are not "short and formulaic": leave them to spaCy.
+LOCATION_MATCHER_MAX_TOKENS = int(os.environ.get("LOCATION_MATCHER_MAX_TOKENS", "48"))
+
+# NOTE: The following adjectives are missing in the pycountry data.
+COUNTRY_ADJECTIVE_OVERRIDES = {
+    "turkish": "Türkiye".lower(),
+    "british": "United Kingdom".lower(),
+    "styrian": "Austria".lower(),
+}
+
+# Warm clients shared by all requests of a worker. See init_clients().
+registry_lock = threading.RLock()
+registry_loop = None
+embed_model_cache = None
+llm_model_cache = {}
+chroma_client = None
+collection_cache = {}
+async_chroma_client = None
+async_collection_cache = {}
+
+answer_cache = None
+embedding_cache = None
+metadata_index = None
+
+# In-flight request coalescing (see SingleFlight and StreamFlight).
+preprocess_flights = None
+answer_flights = None
+stream_flights = {}
+
+# Admission gates per stage (see get_admission_gate()).
+admission_gates = {}
+
+# Pre-warmed worker processes for CPU bound work (see start_cpu_pool()).
+cpu_pool = None
+cpu_pool_ready = False
+
+# Ingestion job queue of the current event loop (see get_job_queue()).
+job_queue = None
+
+# Set once warm_up() has built the backend clients and reached ChromaDB.
+clients_ready = False
 
 CHUNK_SKIPPED_LIST_FILE = "chunk_skipped.csv"
 CHUNK_PROCESSED_LIST_FILE = "chunk_processed.csv"
@@ -100,13 +229,102 @@ CHUNK_CORRUPTED_LIST_FILE = "chunk_corrupted.csv"
 EMBED_DECISION_STORE_LIST_FILE = "embed_deci_stored.csv"
 EMBED_REGULATION_STORE_LIST_FILE = "embed_regul_stored.csv"
 
-CSV_ROOT = os.environ["CSV_ROOT"]
+# Bump when the metadata extraction rules change: the metadata index entries
+# computed by older rules are then recomputed.
+METADATA_VERSION = 1
+
+# Chunk/embedding record fields that are not document metadata.
+RECORD_FIELDS = ("id", "text", "file", "chunk", "embedding")
+
+# Query embedding cache. Set EMBED_CACHE_DB to "" to keep it in memory only
+# (the default location is under CSV_ROOT, see Settings).
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_DB_SIZE = int(os.environ.get("EMBED_CACHE_DB_SIZE", "100000"))
+
+
+class Settings:
+    """
+    Configuration that has to come from the environment (GCP, data folders,
+    ChromaDB, ledgers). Built on first use by get_settings() instead of at
+    import time, so importing this module does not need the variables.
+    """
+
+    NAMES = (
+        "GCP_PROJECT",
+        "GCP_BUCKET",
+        "ROOT_DIR",
+        "DATASET_DIR",
+        "JSON_OUTPUT_DIR",
+        "DECISION_JSON_DIR",
+        "REGULATION_JSON_DIR",
+        "CHROMADB_HOST",
+        "CHROMADB_PORT",
+        "CSV_ROOT",
+        "chunk_skipped_file",
+        "chunk_processed_file",
+        "chunk_corrupted_file",
+        "embed_deci_store_list_file",
+        "embed_regul_store_list_file",
+        "EMBED_CACHE_DB",
+        "METADATA_INDEX_DB",
+    )
+
+    def __init__(self, environ=os.environ):
+        # GCP related parameters
+        self.GCP_PROJECT = environ["GCP_PROJECT"]
+        self.GCP_BUCKET = environ["GCP_BUCKET"]
+
+        # Data related parameters
+        self.ROOT_DIR = environ["ROOT_DIR"]
+        self.DATASET_DIR = environ["DATASET_DIR"]
+
+        self.JSON_OUTPUT_DIR = environ["OUTPUT_DIR"]
+        self.DECISION_JSON_DIR = self.JSON_OUTPUT_DIR + "/decision_jsons"
+        self.REGULATION_JSON_DIR = self.JSON_OUTPUT_DIR + "/regulation_jsons"
+
+        # ChromaDB related parameters
+        self.CHROMADB_HOST = environ["CHROMADB_HOST"]
+        self.CHROMADB_PORT = environ["CHROMADB_PORT"]
+
+        self.CSV_ROOT = environ["CSV_ROOT"]
+
+        csv_root = self.CSV_ROOT
+        self.chunk_skipped_file = os.path.join(csv_root, CHUNK_SKIPPED_LIST_FILE)
+        self.chunk_processed_file = os.path.join(csv_root, CHUNK_PROCESSED_LIST_FILE)
+        self.chunk_corrupted_file = os.path.join(csv_root, CHUNK_CORRUPTED_LIST_FILE)
+        self.embed_deci_store_list_file = os.path.join(
+            csv_root, EMBED_DECISION_STORE_LIST_FILE
+        )
+        self.embed_regul_store_list_file = os.path.join(
+            csv_root, EMBED_REGULATION_STORE_LIST_FILE
+        )
+
+        self.EMBED_CACHE_DB = environ.get(
+            "EMBED_CACHE_DB", os.path.join(csv_root, "query_embed_cache.sqlite")
+        )
+        self.METADATA_INDEX_DB = environ.get(
+            "METADATA_INDEX_DB", os.path.join(csv_root, "metadata_index.sqlite")
+        )
+
+
+settings = None
+
+
+def get_settings():
+    global settings
+
+    if settings is None:
+        settings = Settings()
+    return settings
+
+
+def __getattr__(name):
+    # Backward compatibility: 'rag.DECISION_JSON_DIR' and friends used to be
+    # module globals.
+    if name in Settings.NAMES:
+        return getattr(get_settings(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-chunk_skipped_file = os.path.join(CSV_ROOT, CHUNK_SKIPPED_LIST_FILE)
-chunk_processed_file = os.path.join(CSV_ROOT, CHUNK_PROCESSED_LIST_FILE)
-chunk_corrupted_file = os.path.join(CSV_ROOT, CHUNK_CORRUPTED_LIST_FILE)
-embed_deci_store_list_file = os.path.join(CSV_ROOT, EMBED_DECISION_STORE_LIST_FILE)
-embed_regul_store_list_file = os.path.join(CSV_ROOT, EMBED_REGULATION_STORE_LIST_FILE)
 
 chunk_processed_set = set()
 chunk_processed_set_orig = set()
@@ -131,6 +349,9 @@ def delete_file(filepath):
 
 
 def get_country_adjectives_map():
+    import country_converter
+    from countryinfo import CountryInfo
+
     # Generate the exhaustive Adjective to Country map using country-converter
     country_map = {}
     cc = country_converter.CountryConverter()
@@ -181,6 +402,7 @@ def get_country_adjectives_map():
 
 
 def create_country_params():
+    import country_converter
 
     # Create a list of known country names from country_converter package.
     country_conv = country_converter.CountryConverter()
@@ -194,23 +416,200 @@ def create_country_params():
     return loc_list
 
 
-def extract_countries_using_demonyms(text):
-    extracted_locations = set()
+def build_gazetteer():
+    # Live computation of the lookups from country_converter and countryinfo,
+    # including the manual overrides, and of spaCy's English stop words used
+    # by LocationMatcher. Slow; used to (re)build GAZETTEER_FILE.
+    import importlib.metadata
+    from spacy.lang.en.stop_words import STOP_WORDS
+
+    country_adjectives = get_country_adjectives_map()
+    country_adjectives.update(COUNTRY_ADJECTIVE_OVERRIDES)
+
+    return {
+        "version": GAZETTEER_VERSION,
+        "sources": {
+            package: importlib.metadata.version(package)
+            for package in ["country_converter", "countryinfo", "spacy"]
+        },
+        "locations": sorted(create_country_params()),
+        "country_adjectives": country_adjectives,
+        "stop_words": sorted(STOP_WORDS),
+    }
+
+
+def write_gazetteer(gazetteer_file=GAZETTEER_FILE):
+    gazetteer = build_gazetteer()
+    tmp_file = f"{gazetteer_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(gazetteer, f, ensure_ascii=False, indent=0, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_file, gazetteer_file)
+
+    ret_str = "Gazetteer written to: %s (%d locations, %d adjectives)" % (
+        gazetteer_file,
+        len(gazetteer["locations"]),
+        len(gazetteer["country_adjectives"]),
+    )
+    DEBUG(DBG_LVL_HIGH, ret_str)
+    return ret_str
+
+
+def load_gazetteer(gazetteer_file=GAZETTEER_FILE):
+    # Returns: (locations set, adjective to country dict, stop words set).
+    # Falls back to the live computation if the artifact is missing or of
+    # another version.
+    try:
+        with open(gazetteer_file, "r", encoding="utf-8") as f:
+            gazetteer = json.load(f)
+        if gazetteer.get("version") != GAZETTEER_VERSION:
+            raise ValueError(
+                f"version {gazetteer.get('version')} != {GAZETTEER_VERSION}"
+            )
+    except (OSError, ValueError) as e:
+        DEBUG(DBG_LVL_HIGH, f"Gazetteer not loaded, building it. Error: {e}")
+        gazetteer = build_gazetteer()
+
+    return (
+        set(gazetteer["locations"]),
+        gazetteer["country_adjectives"],
+        set(gazetteer["stop_words"]),
+    )
+
 
+class LocationMatcher:
+    """
+    Compiled counterpart of the spaCy path of extract_place_from_text() for
+    short, formulaic texts such as "Car 30 2024 Abu Dhabi GP". All demonyms,
+    country names and GP markers are compiled into one token trie, and a
+    single pass over the text reports every (overlapping) match, as an
+    Aho-Corasick automaton would.
+
+    The resolution rules follow the spaCy path, so both tag documents and
+    queries with the same location values:
+      - a demonym resolves to its country (demonyms are single tokens there);
+      - otherwise the non stop words in front of "grand prix" / "gp" are the
+        candidates, a country name among them wins, else the last word.
+    match() returns (location, ambiguous). Ambiguous texts (several
+    countries, several GP mentions, long texts) are left to spaCy.
+    """
+
+    TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+    GP_MARKERS = ["grand prix", "gp"]
+
+    def __init__(self, locations, country_adjectives, stop_words):
+        self.stop_words = stop_words
+        self.trie = {}
+
+        for location in locations:
+            self.add(location, "location", location)
+        for adjective, country in country_adjectives.items():
+            # spaCy only looks up single tokens in the adjective map.
+            if len(self.tokenize(adjective)) == 1:
+                self.add(adjective, "demonym", country)
+        for marker in self.GP_MARKERS:
+            self.add(marker, "gp", marker)
+
+    def tokenize(self, text):
+        return self.TOKEN_RE.findall(text.lower())
+
+    def add(self, phrase, kind, value):
+        node = self.trie
+        for token in self.tokenize(phrase):
+            node = node.setdefault(token, {})
+        # The None key holds the matches ending at this node.
+        node.setdefault(None, {})[kind] = value
+
+    def scan(self, tokens):
+        # Yields (start, end, kind, value) for all matches, overlapping ones
+        # included.
+        for start in range(len(tokens)):
+            node = self.trie
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end])
+                if node is None:
+                    break
+                for kind, value in node.get(None, {}).items():
+                    yield start, end + 1, kind, value
+
+    def match(self, text):
+        tokens = self.tokenize(text)
+        if len(tokens) > LOCATION_MATCHER_MAX_TOKENS:
+            return None, True
+
+        countries = set()
+        locations = []
+        markers = []
+        for start, end, kind, value in self.scan(tokens):
+            if kind == "demonym":
+                countries.add(value)
+            elif kind == "location":
+                locations.append((start, end, value))
+            else:
+                markers.append((start, end))
+
+        if countries:
+            if len(countries) > 1:
+                return None, True
+            return countries.pop(), False
+
+        if not markers:
+            return None, False
+        if len(markers) > 1:
+            return None, True
+
+        # Run of non stop words right before the marker.
+        marker_start = markers[0][0]
+        run_start = marker_start
+        while run_start > 0 and tokens[run_start - 1] not in self.stop_words:
+            run_start -= 1
+        if run_start == marker_start:
+            return None, False
+
+        known = [
+            value
+            for start, end, value in locations
+            if end == marker_start and start >= run_start
+        ]
+        if len(known) > 1:
+            return None, True
+        if known:
+            return known[0], False
+
+        return tokens[marker_start - 1], False
+
+
+def get_location_matcher():
+    init_gazetteer()
+    return location_matcher
+
+
+def nlp_doc(text):
+    # Runs the trimmed spaCy pipeline over the lower cased text.
+    # Returns: the Doc, or None on failure.
     init_globals()
 
     try:
         # doc = nlp(text)
-        doc = nlp(text.lower())
+        return nlp(text.lower(), disable=NLP_DISABLED_PIPES)
     except OSError as e:
         print(f"Error loading spaCy model: {e}")
-        return list(extracted_locations)
     except ValueError as e:
         print(f"Error during NLP processing: {e}")
-        return list(extracted_locations)
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        return list(extracted_locations)
+    return None
+
+
+def extract_countries_using_demonyms(text):
+    doc = nlp_doc(text)
+    if doc is None:
+        return []
+    return countries_from_doc(doc)
+
+
+def countries_from_doc(doc):
+    extracted_locations = set()
 
     # 1. Extract explicit GPEs (Cities, Countries, etc.)
     for ent in doc.ents:
@@ -251,22 +650,22 @@ def extract_countries_using_demonyms(text):
 
 # Rule-Based Matching with spaCy's Matcher
 def extract_domain_entities(text):
-    init_globals()
+    doc = nlp_doc(text)
+    if doc is None:
+        return []
+    return domain_entities_from_doc(doc)
 
-    extracted_entities = set()
 
-    try:
-        # doc = nlp(text)
-        doc = nlp(text.lower())
-    except OSError as e:
-        print(f"Error loading spaCy model: {e}")
-        return list(extracted_entities)
-    except ValueError as e:
-        print(f"Error during NLP processing: {e}")
-        return list(extracted_entities)
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return list(extracted_entities)
+def get_gp_matcher():
+    # The Grand Prix Matcher, compiled once per process.
+    global gp_matcher
+
+    if gp_matcher is not None:
+        return gp_matcher
+
+    from spacy.matcher import Matcher
+
+    init_globals()
 
     # Initialize the Matcher with the shared vocabulary
     matcher = Matcher(nlp.vocab)
@@ -294,7 +693,14 @@ def extract_domain_entities(text):
 
     matcher.add("LOCATION", [pattern_gp, pattern_gp_abbr])
 
-    matches = matcher(doc)
+    gp_matcher = matcher
+    return gp_matcher
+
+
+def domain_entities_from_doc(doc):
+    extracted_entities = set()
+
+    matches = get_gp_matcher()(doc)
 
     for match_id, start, end in matches:
         span = doc[start:end]
@@ -313,13 +719,29 @@ def extract_domain_entities(text):
 
 
 def extract_place_from_text(text):
+    location, ambiguous = get_location_matcher().match(text)
+    if not ambiguous:
+        return location
+
+    return extract_place_with_nlp(text)
+
+
+def extract_place_with_nlp(text):
+    return place_from_doc(nlp_doc(text))
 
-    demonym_list = extract_countries_using_demonyms(text)
+
+def place_from_doc(doc):
+    # One Doc serves both the demonym and the Grand Prix matching.
+    if doc is None:
+        return None
+
+    demonym_list = countries_from_doc(doc)
     extracted_locations = set(demonym_list)
     # print("demonym_list: " + str(demonym_list))
 
+    domain_entity_list = []
     if not len(extracted_locations):
-        domain_entity_list = extract_domain_entities(text)
+        domain_entity_list = domain_entities_from_doc(doc)
         extracted_locations.update(domain_entity_list)
         # print("domain_entity_list: " + str(extracted_locations))
 
@@ -365,7 +787,11 @@ def extract_car_num_from_txt(text: str) -> str or None:
     return digits_only
 
 
-def parse_metadata_from_text(text) -> dict:
+def is_regulation_text(text):
+    return "Driver" not in text and "regulations" in text.lower()
+
+
+def parse_metadata_from_text(text, extract_place=extract_place_from_text) -> dict:
     """
     Parses the FIA document filename to extract structured metadata.
     Returns: dict{year, location, car}.
@@ -386,14 +812,14 @@ def parse_metadata_from_text(text) -> dict:
 
     # 2. Set document type
     metadata["doc_type"] = "decision"
-    if "Driver" not in text and "regulations" in text.lower():
+    if is_regulation_text(text):
         # NOTE: We are maintaining "Year" context for regulation too.
         metadata["doc_type"] = "regulation"
         return metadata
 
     DEBUG(DBG_LVL_LOW, "Extracting location")
     # 3. Extract location (Country, City, etc) from file name.
-    location = extract_place_from_text(text)
+    location = extract_place(text)
     if location is not None:
         metadata["location"] = location
         DEBUG(DBG_LVL_LOW, "Location: " + location)
@@ -413,12 +839,201 @@ def parse_metadata_from_text(text) -> dict:
     return metadata
 
 
-def init_globals():
-    global nlp
+def parse_metadata_bulk(texts, batch_size=NLP_BATCH_SIZE, n_process=NLP_N_PROCESS):
+    """
+    parse_metadata_from_text() for a whole corpus pass (chunking, storing).
+    LocationMatcher resolves most file names; the ambiguous ones go through
+    a single batched nlp.pipe() run instead of one spaCy call per name.
+    Returns: list of metadata dicts, in the order of texts.
+    """
+    matcher = get_location_matcher()
+
+    locations = {}
+    ambiguous = []
+    for text in dict.fromkeys(texts):
+        if is_regulation_text(text):
+            continue
+        location, is_ambiguous = matcher.match(text)
+        if is_ambiguous:
+            ambiguous.append(text)
+        else:
+            locations[text] = location
+
+    if ambiguous:
+        DEBUG(DBG_LVL_MED, f"spaCy pass over {len(ambiguous)} of {len(texts)} texts")
+        init_globals()
+        try:
+            docs = nlp.pipe(
+                [text.lower() for text in ambiguous],
+                batch_size=batch_size,
+                n_process=n_process,
+                disable=NLP_DISABLED_PIPES,
+            )
+            for text, doc in zip(ambiguous, docs):
+                locations[text] = place_from_doc(doc)
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Batched spaCy pass failed: {e}")
+            for text in ambiguous:
+                if text not in locations:
+                    locations[text] = extract_place_with_nlp(text)
+
+    return [parse_metadata_from_text(text, locations.get) for text in texts]
+
+
+def document_id(file_name):
+    # 'chunks-<doc>.jsonl', 'embeddings-<doc>.jsonl' and '<doc>' -> '<doc>'
+    doc_id = os.path.splitext(os.path.basename(file_name))[0]
+    for prefix in ["chunks-", "embeddings-"]:
+        if doc_id.startswith(prefix):
+            return doc_id[len(prefix) :]
+    return doc_id
+
+
+class MetadataIndex:
+    """
+    Persistent metadata of the documents, keyed by document id and by the
+    hash of the content it was derived from (the file name, or the PDF text
+    of a linked document). Chunking, storing and URL ingestion read it, so
+    the extraction runs once per document across pipeline runs. Without a
+    'db_path' it is kept in memory.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self.items = {}
+        self.lock = threading.Lock()
+
+        if self.db_path:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            with self.db_connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS metadata "
+                    "(doc_id TEXT PRIMARY KEY, content_hash TEXT, metadata TEXT, updated REAL)"
+                )
+
+    def db_connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    @staticmethod
+    def content_hash(content):
+        key = f"{METADATA_VERSION}|{GAZETTEER_VERSION}|{content}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_many(self, entries):
+        # entries: [(doc_id, content)]. Returns: {doc_id: metadata} of the
+        # documents indexed with the same content.
+        wanted = {doc_id: self.content_hash(content) for doc_id, content in entries}
+        if not self.db_path:
+            with self.lock:
+                rows = [
+                    (doc_id, *self.items[doc_id])
+                    for doc_id in wanted
+                    if doc_id in self.items
+                ]
+        else:
+            rows = []
+            doc_ids = list(wanted)
+            try:
+                with self.db_connect() as conn:
+                    # Stay below SQLite's limit of host parameters.
+                    for i in range(0, len(doc_ids), 500):
+                        batch = doc_ids[i : i + 500]
+                        rows += conn.execute(
+                            "SELECT doc_id, content_hash, metadata FROM metadata "
+                            f"WHERE doc_id IN ({', '.join('?' * len(batch))})",
+                            batch,
+                        ).fetchall()
+            except sqlite3.Error as e:
+                DEBUG(DBG_LVL_HIGH, f"Metadata index read failed: {e}")
+
+        return {
+            doc_id: json.loads(metadata)
+            for doc_id, content_hash, metadata in rows
+            if wanted[doc_id] == content_hash
+        }
+
+    def put_many(self, entries):
+        # entries: [(doc_id, content, metadata)]
+        now = time.time()
+        rows = [
+            (doc_id, self.content_hash(content), json.dumps(metadata), now)
+            for doc_id, content, metadata in entries
+        ]
+        if not self.db_path:
+            with self.lock:
+                for doc_id, content_hash, metadata, _ in rows:
+                    self.items[doc_id] = (content_hash, metadata)
+            return
+
+        try:
+            with self.db_connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", rows
+                )
+        except sqlite3.Error as e:
+            DEBUG(DBG_LVL_HIGH, f"Metadata index write failed: {e}")
+
+
+def get_metadata_index():
+    global metadata_index
+
+    if metadata_index is None:
+        with registry_lock:
+            if metadata_index is None:
+                metadata_index = MetadataIndex(get_settings().METADATA_INDEX_DB or None)
+    return metadata_index
+
+
+def get_document_metadata(doc_ids, contents=None, parse=parse_metadata_bulk):
+    """
+    Metadata of the documents 'doc_ids', derived from 'contents' (default:
+    the document ids, i.e. the file names). Served from the metadata index;
+    the misses are parsed in one 'parse' (parse_metadata_bulk()) pass and
+    indexed.
+    Returns: list of metadata dicts, in the order of doc_ids.
+    """
+    contents = doc_ids if contents is None else contents
+    index = get_metadata_index()
+
+    found = index.get_many(zip(doc_ids, contents))
+    missing = {
+        doc_id: content
+        for doc_id, content in zip(doc_ids, contents)
+        if doc_id not in found
+    }
+    DEBUG(DBG_LVL_MED, f"Metadata index: {len(found)} hits, {len(missing)} misses")
+
+    if missing:
+        parsed = parse(list(missing.values()))
+        index.put_many(
+            (doc_id, content, metadata)
+            for (doc_id, content), metadata in zip(missing.items(), parsed)
+        )
+        found.update(zip(missing, parsed))
+
+    # Every caller gets its own copy, chunk_file() adds keys to it.
+    return [dict(found[doc_id]) for doc_id in doc_ids]
+
+
+def init_gazetteer():
     global locations_list
     global country_adjectives_map
+    global location_matcher
+
+    if location_matcher is None:
+        locations, country_adjectives, stop_words = load_gazetteer()
+        locations_list = locations
+        country_adjectives_map = country_adjectives
+        location_matcher = LocationMatcher(locations, country_adjectives, stop_words)
+
+
+def init_globals():
+    global nlp
 
     if nlp is None:
+        import spacy
+        from spacy.cli import download
+
         # Load spacy's pre-trained English language processing pipeline.
         try:
             nlp = spacy.load("en_core_web_sm")
@@ -436,174 +1051,1449 @@ def init_globals():
             DEBUG(DBG_LVL_HIGH, f"Spacy loading failed: {e}")
             raise
 
-    if locations_list is None:
-        locations_list = create_country_params()
-
-    if country_adjectives_map is None:
-        # Generate a dictionary of adjectives and their corresponding
-        # country names from the pycountry data.
-        country_adjectives_map = get_country_adjectives_map()
-
-        # NOTE: The following adjectives are missing in the pycountry data.
-        country_adjectives_map["turkish"] = "Türkiye".lower()
-        country_adjectives_map["british"] = "United Kingdom".lower()
-        country_adjectives_map["styrian"] = "Austria".lower()
+    init_gazetteer()
 
 
 # =============================================================================
-#                                CHUNK THE DATA
+#                                    METRICS
 # =============================================================================
-def is_file_interesting(file_name):
-    strs = ["Decision", "Summons", "Offence", "Infringement", "regulations"]
-    for substr in strs:
-        if substr in file_name:
-            return True
-    return False
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
+# Stage latencies range from sub-millisecond cache lookups to LLM calls.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-def find_markers(input_text):
-    markers = [
-        "No / Driver",
-        "Competitor",
-        "Time",
-        "Session",
-        "Fact",
-        "Infringement",
-        "Offence",
-        "Decision",
-        "Reason",
-    ]
-    marker_pattern = "|".join(re.escape(m) for m in markers)
+metrics_registry = []
 
-    # The main regex pattern:
-    # (marker_pattern)   -> Capture Group 1: Matches and captures one of the defined markers.
-    # \s* -> Matches zero or more whitespace characters (spaces, tabs, newlines).
-    # (.*?)              -> Capture Group 2: Matches and captures the content (non-greedily).
-    # (?=marker_pattern|$) -> Positive Lookahead: Looks ahead for the next marker OR the end of the string ($).
-    #                         This tells the non-greedy content capture (.*?) where to stop.
-    regex = rf"({marker_pattern})\s*(.*?)(?={marker_pattern}|$)"
 
-    # Find all matches
-    # re.DOTALL ensures that '.' matches newlines, allowing content to span multiple lines.
-    matches = re.findall(regex, input_text, re.DOTALL)
+def format_labels(label_names, label_values, *extra):
+    # 'extra' are preformatted pairs (e.g. 'le="0.1"'); empty ones are skipped.
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    pairs.extend(pair for pair in extra if pair)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
 
-    # Format results into a dictionary
-    results = {}
-    for marker, content in matches:
-        # Clean up any leading/trailing whitespace from the content before storing
-        results[marker.strip()] = content.strip()
 
-    return results
+class Metric:
+    """
+    Minimal Prometheus metric. Samples are kept per tuple of label values;
+    updates take a lock since pipeline stages also run in worker threads.
+    """
 
+    metric_type = "untyped"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def render_samples(self, const_labels=""):
+        for label_values, value in sorted(self.values.items()):
+            labels = format_labels(self.label_names, label_values, const_labels)
+            yield f"{self.name}{labels} {value}"
+
+    def render(self, const_labels=""):
+        # 'const_labels' (preformatted) are added to every sample.
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self.lock:
+            lines.extend(self.render_samples(const_labels))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            sample = self.values.get(label_values)
+            if sample is None:
+                # Per bucket counts (the last one is +Inf), sum, count.
+                sample = self.values[label_values] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                    0,
+                ]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def render_samples(self, const_labels=""):
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                labels = format_labels(
+                    self.label_names, label_values, const_labels, f'le="{bound}"'
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.label_names, label_values, const_labels)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+STAGE_LATENCY = Histogram(
+    "rag_stage_duration_seconds", "Latency of each query pipeline stage.", ["stage"]
+)
+CHROMA_QUERY_LATENCY = Histogram(
+    "rag_chroma_query_duration_seconds",
+    "Latency of ChromaDB queries per collection.",
+    ["collection"],
+)
+QUERIES = Counter("rag_queries_total", "Queries answered per entry point.", ["kind"])
+QUERY_ERRORS = Counter(
+    "rag_query_errors_total", "Failed queries per error code.", ["kind", "code"]
+)
+LLM_REQUESTS = Counter(
+    "rag_llm_requests_total", "LLM calls per chosen model.", ["model", "mode"]
+)
+LLM_ANSWERS = Counter(
+    "rag_llm_answers_total",
+    "LLM answers per requested and serving model.",
+    ["requested", "served", "via"],
+)
+LLM_FAILURES = Counter(
+    "rag_llm_failures_total", "Failed LLM calls per model.", ["model", "reason"]
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "rag_http_requests_in_flight", "HTTP requests currently being served."
+)
+ADMISSION_ACTIVE = Gauge(
+    "rag_admission_active", "Calls holding an admission slot per stage.", ["stage"]
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "rag_admission_queue_depth", "Calls waiting for a slot per stage.", ["stage"]
+)
+ADMISSION_REJECTED = Counter(
+    "rag_admission_rejected_total",
+    "Requests turned away per stage and reason.",
+    ["stage", "reason"],
+)
+DEGRADED_STAGES = Counter(
+    "rag_degraded_stages_total",
+    "Optional stages skipped or trimmed to meet the query deadline.",
+    ["stage", "reason"],
+)
+CACHE_HITS = Counter("rag_cache_hits_total", "Cache hits per cache.", ["cache"])
+CACHE_MISSES = Counter("rag_cache_misses_total", "Cache misses per cache.", ["cache"])
+CACHE_ITEMS = Gauge("rag_cache_items", "Items in the in-memory cache tier.", ["cache"])
+COALESCED = Counter(
+    "rag_coalesced_requests_total",
+    "Requests that joined an identical in-flight computation.",
+    ["flight"],
+)
+INGEST_JOBS = Gauge("rag_ingest_jobs", "Ingestion jobs per state.", ["state"])
+PROMPT_TOKENS = Histogram(
+    "rag_prompt_tokens",
+    "Estimated prompt tokens per context section and in total.",
+    ["section"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+
+
+@contextmanager
+def stage_timer(stage):
+    # Feeds the stage histogram and, if the request is traced, its span.
+    start = time.perf_counter()
+    try:
+        with trace_span(stage):
+            yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage)
 
-def chunk_file(filepath, filename, json_folder, counter, metadata):
-    DEBUG(DBG_LVL_MED, "\nCOUNT: %d, FILE: %s" % (counter, filepath))
-    # DEBUG(DBG_LVL_LOW, "filename: %s" % (filename))
 
-    chunk_jsonl = os.path.join(json_folder, f"chunks-{filename}.jsonl")
-    if os.path.isfile(chunk_jsonl):
-        return ERROR_CODE_ALREADY_CHUNKED
+def error_code_name(ret_val):
+    for name, value in globals().items():
+        if value == ret_val and name.startswith(("ERROR_CODE_", "HTTP_CODE_")):
+            return name
+    return str(ret_val)
 
-    input_text = ""
-    try:
-        pdf_reader = PdfReader(filepath)
-        for page in pdf_reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                page_text = page_text.replace("\n", " ") + " "
-                page_text = page_text.replace("\u00a0", " ")
-                page_text = page_text.replace("\u2013", " ")
-
-                input_text += page_text
-    except Exception as e:
-        DEBUG(DBG_LVL_MED, f"Error processing {filepath}: {e}")
-        return ERROR_CODE_FILE_CORRUPTED
 
-    # Collapse any sequence of one or more spaces into a single space
-    input_text = re.sub(" +", " ", input_text).strip()
+def count_query(kind, ret_val):
+    QUERIES.inc(kind)
+    if ret_val not in (
+        ERROR_CODE_SUCCESS,
+        HTTP_CODE_GENERIC_SUCCESS,
+        HTTP_CODE_NOT_MODIFIED,
+    ):
+        QUERY_ERRORS.inc(kind, error_code_name(ret_val))
+
+
+def counted_query(kind):
+    # Counts the (result, ret_val) outcome of a query entry point.
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            ret, ret_val = await fn(*args, **kwargs)
+            count_query(kind, ret_val)
+            trace_attributes(kind=kind, status=ret_val)
+            return ret, ret_val
+
+        return wrapper
+
+    return decorate
+
+
+def collect_runtime_metrics():
+    # Caches, flights and the job queue keep their own counters; they are
+    # copied into the registry at scrape time instead of on the hot path.
+    for cache in (answer_cache, embedding_cache):
+        if cache is not None:
+            stats = cache.stats()
+            CACHE_HITS.set(stats["hits"], cache.name)
+            CACHE_MISSES.set(stats["misses"], cache.name)
+            CACHE_ITEMS.set(stats["size"], cache.name)
+    for flight in (preprocess_flights, answer_flights):
+        if flight is not None:
+            COALESCED.set(flight.coalesced, flight.name)
+    if job_queue is not None:
+        for state, value in job_queue.stats().items():
+            INGEST_JOBS.set(value, state)
+    for stage, gate in list(admission_gates.items()):
+        ADMISSION_ACTIVE.set(gate.active, stage)
+        ADMISSION_QUEUE_DEPTH.set(len(gate.waiters), stage)
+
+
+def render_metrics():
+    # The registry lives in this process only. The 'worker' label keeps the
+    # series of pre-forked workers (see API_WORKERS) apart, as a scrape
+    # reaches whichever worker accepts it.
+    collect_runtime_metrics()
+    worker = f'worker="{os.getpid()}"'
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render(worker))
+    return "\n".join(lines) + "\n"
 
-    if metadata["doc_type"] == "decision":
-        if "car_num" not in metadata:
-            # Extract Car Number(s) from file content.
-            all_involved_cars = extract_car_num_from_txt(input_text)
-            if all_involved_cars:
-                # Use the first car found as the primary filter target
-                metadata["car_num"] = all_involved_cars[0]
 
-                # Store ALL involved cars for RAG context.
-                metadata["all_involved_cars"] = ", ".join(all_involved_cars)
-        DEBUG(DBG_LVL_LOW, '"Metadata:" ' + str(metadata))
+# =============================================================================
+#                                    TRACING
+# =============================================================================
+# Trace of the current request and the innermost open span. Tasks created by
+# gather() and threads started by to_thread() inherit both.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
 
-        # If "Car xxx" is still not found, this file can be skipped.
-        if "car_num" not in metadata:
-            DEBUG(DBG_LVL_MED, "CAR INFO NOT FOUND. FILE: %s" + filepath)
-            return ERROR_CODE_FILE_SKIPPED
+trace_export_lock = threading.Lock()
 
-        # Find relevant markers in the input text.
-        markers = find_markers(input_text)
-        if "Fact" not in markers.keys() or "Reason" not in markers.keys():
-            DEBUG(DBG_LVL_MED, "NO PARAMETERS FOUND. FILE: %s" + filepath)
-            return ERROR_CODE_FILE_SKIPPED
 
-    DEBUG(DBG_LVL_MED, "FILE COUNT-%d, CHUNKING: %s" % (counter, filepath))
+class Span:
+    __slots__ = ("name", "span_id", "parent", "start_ns", "end_ns", "attributes")
 
-    # Initialize the splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, chunk_overlap=20, separators=["\n\n", "\n", " ", ""]
-    )
+    def __init__(self, name, parent):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent = parent
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = {}
 
-    # Perform the chunking process.
-    text_chunks = text_splitter.create_documents([input_text.lower()])
-    text_chunks = [doc.page_content for doc in text_chunks]
-    assert len(text_chunks)
 
-    # Save the chunks
-    data_df = pd.DataFrame(text_chunks, columns=["chunk"])
-    data_df["file"] = filename
+class Trace:
+    """
+    Spans of one request. The breakdown is returned to opted-in clients and
+    the OTLP-JSON form is appended to TRACE_EXPORT_FILE.
+    """
 
-    DEBUG(DBG_LVL_MED, "Writing chunks to: " + chunk_jsonl)
-    # Combine base metadata with chunk specifics
-    with open(chunk_jsonl, "w") as f:
-        for i, chunk in enumerate(text_chunks):
-            record = {"id": f"{filename}_{i}", "text": chunk, **metadata}
-            f.write(json.dumps(record) + "\n")
+    def __init__(self, name):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, None)
+        self.spans = [self.root]
+
+    def start_span(self, name, parent):
+        span = Span(name, parent or self.root)
+        self.spans.append(span)
+        return span
+
+    def duration_ms(self):
+        end_ns = self.root.end_ns or time.time_ns()
+        return (end_ns - self.root.start_ns) / 1e6
+
+    def breakdown(self):
+        spans = []
+        for span in self.spans[1:]:
+            end_ns = span.end_ns or time.time_ns()
+            spans.append(
+                {
+                    "name": span.name,
+                    "parent": span.parent.name,
+                    "start_ms": round((span.start_ns - self.root.start_ns) / 1e6, 3),
+                    "duration_ms": round((end_ns - span.start_ns) / 1e6, 3),
+                    "attributes": span.attributes,
+                }
+            )
+        return {
+            "trace_id": self.trace_id,
+            "total_ms": round(self.duration_ms(), 3),
+            "attributes": self.root.attributes,
+            "spans": spans,
+        }
+
+    def to_otlp(self):
+        spans = []
+        for span in self.spans:
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or time.time_ns()),
+                "attributes": [
+                    {"key": key, "value": otlp_value(value)}
+                    for key, value in span.attributes.items()
+                ],
+            }
+            if span.parent is not None:
+                otlp_span["parentSpanId"] = span.parent.span_id
+            if "error" in span.attributes:
+                otlp_span["status"] = {"code": 2, "message": span.attributes["error"]}
+            spans.append(otlp_span)
+
+        resource = {
+            "attributes": [{"key": "service.name", "value": otlp_value("f1-rag")}]
+        }
+        return {
+            "resourceSpans": [
+                {
+                    "resource": resource,
+                    "scopeSpans": [{"scope": {"name": "rag"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+@contextmanager
+def trace_span(name):
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = current_span.get()
+    span = trace.start_span(name, parent)
+    # set() instead of a reset token: async generators resume in the
+    # context of whoever iterates them.
+    current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.attributes["error"] = str(e)
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        current_span.set(parent)
 
-    return ERROR_CODE_SUCCESS
 
+def trace_attributes(**attributes):
+    # Annotates the innermost open span; a no-op for untraced requests.
+    trace = current_trace.get()
+    if trace is not None:
+        (current_span.get() or trace.root).attributes.update(attributes)
 
-def get_delta_files_to_process(chunk_file_list, json_folder):
-    chunk_jsonl_list = glob.glob(os.path.join(json_folder, "chunks-*.jsonl"))
-    chunk_jsonl_files = [os.path.basename(file) for file in chunk_jsonl_list]
-    # print("len(chunk_jsonl_files) " + str(len(chunk_jsonl_files)))
 
-    if not os.path.isfile(chunk_processed_file):
-        # print("CHUNK PROCESSED file: %s DOES NOT exist" %(chunk_processed_file))
+@contextmanager
+def start_trace(name, force=False):
+    """
+    Traces everything run inside the block. Tracing is on if the caller asks
+    for it ('force') or if traces are exported; otherwise None is yielded.
+    """
+    if not (force or TRACE_EXPORT_FILE):
+        yield None
+        return
 
-        if len(chunk_jsonl_files):
-            # This is the case where some files are already processed before
-            # CSV tracking is introduced.
+    trace = Trace(name)
+    trace_token = current_trace.set(trace)
+    span_token = current_span.set(None)
+    try:
+        yield trace
+    finally:
+        trace.root.end_ns = time.time_ns()
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+        if TRACE_EXPORT_FILE and trace.duration_ms() >= TRACE_EXPORT_MIN_MS:
+            export_trace(trace)
 
-            # print("%d no of already processed files" %(len(chunk_jsonl_files)))
-            chunk_processed_set.update(chunk_jsonl_files)
-            chunk_processed_set_orig.update(chunk_jsonl_files)
 
-            processed_df = pd.DataFrame(chunk_jsonl_files, columns=["filename"])
-            processed_df.to_csv(chunk_processed_file, index=False)
-    else:
-        # print("CHUNK PROCESSED file: %s Exist" %(chunk_processed_file))
+def export_trace(trace):
+    line = json.dumps(trace.to_otlp())
+    try:
+        with trace_export_lock, open(TRACE_EXPORT_FILE, "a") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        DEBUG(DBG_LVL_HIGH, f"Trace export failed. Error: {e}")
 
-        df = pd.read_csv(chunk_processed_file)
-        chunk_processed_set.update(df["filename"])
-        chunk_processed_set_orig.update(df["filename"])
-    # print("Size of chunk_processed_set: " + str(len(chunk_processed_set)))
 
-    if os.path.isfile(chunk_skipped_file):
-        # print("CHUNK SKIPPED file: %s Exist" %(chunk_skipped_file))
+# =============================================================================
+#                                CLIENT REGISTRY
+# =============================================================================
+def check_registry_loop():
+    # Async Vertex AI and ChromaDB clients are bound to the event loop that
+    # first used them. If a different loop shows up (e.g. query() running
+    # query_async() in a fresh asyncio.run()), drop the loop bound clients.
+    global registry_loop
+    global embed_model_cache
+    global async_chroma_client
 
-        df = pd.read_csv(chunk_skipped_file)
-        chunk_skipped_set.update(df["filename"])
-        chunk_skipped_set_orig.update(df["filename"])
-    # print("Size of chunk_skipped_set: %d" %len(chunk_skipped_set))
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Called from a worker thread or from synchronous code.
+        return
+
+    if registry_loop is loop:
+        return
+
+    with registry_lock:
+        if registry_loop is not None:
+            DEBUG(DBG_LVL_MED, "Event loop changed. Rebuilding async clients.")
+            embed_model_cache = None
+            llm_model_cache.clear()
+            async_chroma_client = None
+            async_collection_cache.clear()
+        registry_loop = loop
+
+
+def get_embed_model():
+    global embed_model_cache
+
+    check_registry_loop()
+    if embed_model_cache is None:
+        with registry_lock:
+            if embed_model_cache is None:
+                from vertexai.language_models import TextEmbeddingModel
+
+                embed_model_cache = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+    return embed_model_cache
+
+
+def get_llm_model(model_name):
+    check_registry_loop()
+    if model_name not in llm_model_cache:
+        with registry_lock:
+            if model_name not in llm_model_cache:
+                from vertexai.generative_models import GenerativeModel
+
+                llm_model_cache[model_name] = GenerativeModel(model_name)
+    return llm_model_cache[model_name]
+
+
+def get_chroma_client():
+    global chroma_client
+
+    config = get_settings()
+
+    if chroma_client is None:
+        with registry_lock:
+            if chroma_client is None:
+                import chromadb
+
+                chroma_client = chromadb.HttpClient(
+                    host=config.CHROMADB_HOST, port=config.CHROMADB_PORT
+                )
+    return chroma_client
+
+
+def get_collection(name):
+    if name not in collection_cache:
+        collection_cache[name] = get_chroma_client().get_collection(name=name)
+    return collection_cache[name]
+
+
+async def get_async_chroma_client():
+    global async_chroma_client
+
+    config = get_settings()
+
+    check_registry_loop()
+    if async_chroma_client is None:
+        import chromadb
+
+        # The async client keeps one pooled keep-alive HTTP connection set
+        # per event loop, so reusing it avoids a handshake per request.
+        async_chroma_client = await chromadb.AsyncHttpClient(
+            host=config.CHROMADB_HOST, port=config.CHROMADB_PORT
+        )
+    return async_chroma_client
+
+
+async def get_async_collection(name):
+    if name not in async_collection_cache:
+        client = await get_async_chroma_client()
+        async_collection_cache[name] = await client.get_collection(name=name)
+    return async_collection_cache[name]
+
+
+async def query_collection_async(name, **kwargs):
+    start = time.perf_counter()
+    with trace_span("chroma_query") as span:
+        try:
+            collection = await get_async_collection(name)
+            results = await collection.query(**kwargs)
+        except Exception as e:
+            # The connection or the cached collection handle may be stale (e.g.
+            # store_embeddings() recreated the collection). Reconnect once.
+            # Other errors (a bad filter...) would fail again, and resetting
+            # the shared clients would disturb every in-flight query.
+            if not is_stale_client_error(e):
+                raise
+            DEBUG(DBG_LVL_HIGH, f"ChromaDB query failed, reconnecting. Error: {e}")
+            reset_chroma_clients()
+            collection = await get_async_collection(name)
+            results = await collection.query(**kwargs)
+        finally:
+            CHROMA_QUERY_LATENCY.observe(time.perf_counter() - start, name)
+
+        if span is not None:
+            documents = results.get("documents") or []
+            span.attributes.update(
+                collection=name,
+                queries=len(kwargs.get("query_embeddings", [])),
+                n_results=kwargs.get("n_results", 10),
+                filtered=kwargs.get("where") is not None,
+                chunks=count_chunks(results),
+                bytes_in=sum(len(doc.encode()) for docs in documents for doc in docs),
+            )
+    return results
+
+
+def is_stale_client_error(e):
+    # The ChromaDB server is unreachable, or the collection behind a cached
+    # handle is gone (ValueError "... does not exist" in older clients).
+    import httpx
+
+    if isinstance(e, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    if type(e).__name__ in ("NotFoundError", "InvalidCollectionException"):
+        return True
+    return "does not exist" in str(e)
+
+
+def count_chunks(results):
+    return sum(len(docs) for docs in results["documents"])
+
+
+def reset_chroma_clients():
+    global chroma_client
+    global async_chroma_client
+
+    with registry_lock:
+        chroma_client = None
+        collection_cache.clear()
+        async_chroma_client = None
+        async_collection_cache.clear()
+
+
+def init_clients():
+    # Build the warm clients once per worker. Missing collections are not
+    # fatal here; they are looked up again on first use.
+    # Returns: True if every collection was loaded.
+    get_embed_model()
+    for model_name in LLM_MODELS.values():
+        get_llm_model(model_name)
+    # Opening the caches sets up and prunes their SQLite tiers.
+    get_embedding_cache()
+    get_answer_cache()
+
+    loaded = True
+    for name in [DECISIONS_COLLECTION, REGULATIONS_COLLECTION]:
+        try:
+            get_collection(name)
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Collection '{name}' not loaded. Error: {e}")
+            loaded = False
+    return loaded
+
+
+async def init_async_clients():
+    check_registry_loop()
+    for name in [DECISIONS_COLLECTION, REGULATIONS_COLLECTION]:
+        try:
+            await get_async_collection(name)
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Collection '{name}' not loaded. Error: {e}")
+
+
+def warm_up_globals():
+    # Loads spaCy and the gazetteers, then runs one extraction so the first
+    # query does not pay for spaCy's lazily allocated pipeline state.
+    init_globals()
+    parse_metadata_from_text("Car 1 - Unsafe release, 2024 Italian Grand Prix")
+
+
+async def warm_up(retry_sec=None):
+    """
+    Startup warm-up of one server process: NLP globals, Vertex AI models and
+    ChromaDB clients. Retries until ChromaDB is reachable; readiness() stays
+    false until then. Missing collections do not block readiness, so an
+    empty deployment can still be filled through /ingest.
+    """
+    global clients_ready
+
+    retry_sec = WARMUP_RETRY_SEC if retry_sec is None else retry_sec
+    while True:
+        try:
+            with stage_timer("warm_up"):
+                await asyncio.to_thread(warm_up_globals)
+                await start_cpu_pool()
+                await asyncio.to_thread(init_clients)
+                await init_async_clients()
+                await asyncio.to_thread(get_chroma_client().heartbeat)
+            clients_ready = True
+            DEBUG(DBG_LVL_HIGH, "Warm-up done.")
+            return
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Warm-up failed, retry in {retry_sec}s. Error: {e}")
+            reset_chroma_clients()
+        await asyncio.sleep(retry_sec)
+
+
+def readiness():
+    checks = {
+        "nlp": nlp is not None,
+        "gazetteers": location_matcher is not None,
+        "cpu_pool": cpu_pool_ready,
+        "clients": clients_ready,
+    }
+    return all(checks.values()), checks
+
+
+def close_clients():
+    global registry_loop
+    global embed_model_cache
+
+    reset_chroma_clients()
+    with registry_lock:
+        embed_model_cache = None
+        llm_model_cache.clear()
+        registry_loop = None
+
+
+# =============================================================================
+#                                    CACHES
+# =============================================================================
+class LRUCache:
+    """
+    Thread safe in-memory LRU cache with optional expiry ('ttl' seconds) and
+    an optional SQLite tier ('db_path') that survives restarts and is shared
+    by every worker on the node. Values must be JSON serialisable.
+    The *_async methods read and write the SQLite tier in a thread, so that
+    coroutines do not block the event loop on disk I/O.
+    """
+
+    def __init__(
+        self,
+        name,
+        max_items,
+        ttl=None,
+        db_path=None,
+        max_db_items=None,
+        db_prune_every=CACHE_DB_PRUNE_EVERY,
+    ):
+        self.name = name
+        self.max_items = max_items
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_db_items = max_db_items or max_items * 10
+        self.db_prune_every = db_prune_every
+        self.db_writes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.db_path:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            with self.db_connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache "
+                    "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, created REAL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS cache_created ON cache (created)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)"
+                )
+            self.db_prune(time.time())
+
+    def db_connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def db_get_many(self, keys, now):
+        # Returns: {key: (value, expires_at)} of the unexpired keys on disk.
+        rows = []
+        try:
+            with self.db_connect() as conn:
+                # Stay below SQLite's limit on query parameters.
+                for i in range(0, len(keys), 500):
+                    batch = keys[i : i + 500]
+                    rows += conn.execute(
+                        "SELECT key, value, expires_at FROM cache WHERE key IN "
+                        f"({', '.join('?' * len(batch))})",
+                        batch,
+                    ).fetchall()
+        except sqlite3.Error as e:
+            DEBUG(DBG_LVL_HIGH, f"{self.name} cache read failed: {e}")
+            return {}
+
+        return {
+            key: (json.loads(value), expires_at)
+            for key, value, expires_at in rows
+            if expires_at is None or expires_at > now
+        }
+
+    def db_set_many(self, items, expires_at, now):
+        try:
+            with self.db_connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                    [(key, json.dumps(value), expires_at, now) for key, value in items],
+                )
+        except sqlite3.Error as e:
+            DEBUG(DBG_LVL_HIGH, f"{self.name} cache write failed: {e}")
+            return
+
+        with self.lock:
+            before = self.db_writes
+            self.db_writes += len(items)
+            prune = (
+                before // self.db_prune_every != self.db_writes // self.db_prune_every
+            )
+        if prune:
+            self.db_prune(now)
+
+    def db_prune(self, now):
+        # Drops the expired entries and all but the newest max_db_items, both
+        # through an index.
+        try:
+            with self.db_connect() as conn:
+                conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM cache WHERE created < (SELECT created FROM cache "
+                    "ORDER BY created DESC LIMIT 1 OFFSET ?)",
+                    (self.max_db_items - 1,),
+                )
+        except sqlite3.Error as e:
+            DEBUG(DBG_LVL_HIGH, f"{self.name} cache prune failed: {e}")
+
+    def memory_get(self, key, now):
+        # Caller holds self.lock.
+        entry = self.items.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is None or expires_at > now:
+            self.items.move_to_end(key)
+            return value
+        del self.items[key]
+        return None
+
+    def memory_set(self, key, value, expires_at):
+        # Caller holds self.lock.
+        self.items[key] = (value, expires_at)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def memory_get_many(self, keys):
+        # Returns: ({key: value} found in memory, [keys] to look up on disk)
+        now = time.time()
+        found, missing = {}, []
+        with self.lock:
+            for key in keys:
+                value = self.memory_get(key, now)
+                if value is None:
+                    missing.append(key)
+                else:
+                    self.hits += 1
+                    found[key] = value
+        return found, missing
+
+    def promote(self, found, missing, rows):
+        # Moves the disk hits into memory; the other keys are misses.
+        with self.lock:
+            for key in missing:
+                if key not in rows:
+                    self.misses += 1
+                    continue
+                value, expires_at = rows[key]
+                self.hits += 1
+                self.memory_set(key, value, expires_at)
+                found[key] = value
+        return found
+
+    def get_many(self, keys):
+        # Returns: {key: value} of the cached keys.
+        found, missing = self.memory_get_many(keys)
+        rows = {}
+        if missing and self.db_path:
+            rows = self.db_get_many(missing, time.time())
+        return self.promote(found, missing, rows)
+
+    async def get_many_async(self, keys):
+        found, missing = self.memory_get_many(keys)
+        rows = {}
+        if missing and self.db_path:
+            rows = await asyncio.to_thread(self.db_get_many, missing, time.time())
+        return self.promote(found, missing, rows)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    async def get_async(self, key):
+        return (await self.get_many_async([key])).get(key)
+
+    def memory_set_many(self, items):
+        # Returns: (expiry time, time of writing) of the items.
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self.lock:
+            for key, value in items:
+                self.memory_set(key, value, expires_at)
+        return expires_at, now
+
+    def set_many(self, items):
+        # 'items' is a list of (key, value).
+        expires_at, now = self.memory_set_many(items)
+        if self.db_path:
+            self.db_set_many(items, expires_at, now)
+
+    async def set_many_async(self, items):
+        expires_at, now = self.memory_set_many(items)
+        if self.db_path:
+            await asyncio.to_thread(self.db_set_many, items, expires_at, now)
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    async def set_async(self, key, value):
+        await self.set_many_async([(key, value)])
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+        if self.db_path:
+            try:
+                with self.db_connect() as conn:
+                    conn.execute("DELETE FROM cache")
+            except sqlite3.Error as e:
+                DEBUG(DBG_LVL_HIGH, f"{self.name} cache clear failed: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.items), "hits": self.hits, "misses": self.misses}
+
+
+def embedding_cache_key(text, model=EMBEDDING_MODEL, dim=EMBED_DIM):
+    return hashlib.sha256(f"{model}|{dim}|{text}".encode()).hexdigest()
+
+
+def get_embedding_cache():
+    global embedding_cache
+
+    if embedding_cache is None:
+        with registry_lock:
+            if embedding_cache is None:
+                embedding_cache = LRUCache(
+                    "embedding",
+                    EMBED_CACHE_SIZE,
+                    db_path=get_settings().EMBED_CACHE_DB or None,
+                    max_db_items=EMBED_CACHE_DB_SIZE,
+                )
+    return embedding_cache
+
+
+async def embed_queries_async(texts):
+    # Query embeddings only depend on (text, model, dim), so they are cached
+    # in memory and on disk across restarts. The misses are sent to Vertex
+    # AI in batches of up to BATCH_SIZE texts.
+    cache = get_embedding_cache()
+    keys = {text: embedding_cache_key(text) for text in texts}
+    cached = await cache.get_many_async(list(set(keys.values())))
+    embeddings = {text: cached.get(key) for text, key in keys.items()}
+    missing = [text for text, embedding in embeddings.items() if embedding is None]
+    trace_attributes(embedding_cache_hits=len(embeddings) - len(missing))
+
+    if missing:
+        # NOTE: from_pretrained() fetches model metadata over a blocking call
+        # the first time around.
+        embed_model = await asyncio.to_thread(get_embed_model)
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i : i + BATCH_SIZE]
+            async with get_admission_gate("embed").slot():
+                with stage_timer("query_embedding"):
+                    trace_attributes(
+                        texts=len(batch),
+                        bytes_out=sum(len(text.encode()) for text in batch),
+                    )
+                    results = await embed_model.get_embeddings_async(
+                        batch, output_dimensionality=EMBED_DIM
+                    )
+            for text, result in zip(batch, results):
+                embeddings[text] = result.values
+            await cache.set_many_async(
+                [(keys[text], embeddings[text]) for text in batch]
+            )
+
+    return [embeddings[text] for text in texts]
+
+
+async def embed_query_async(text):
+    embeddings = await embed_queries_async([text])
+    return embeddings[0]
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight
+    computation; every caller gets its result (or its exception). The
+    computation is cancelled once every caller has gone away.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_fn())
+            future.waiters = 0
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.forget(key, f))
+        else:
+            self.coalesced += 1
+            DEBUG(DBG_LVL_MED, f"{self.name}: joined in-flight request.")
+
+        # A caller going away must not cancel the computation others still
+        # wait for.
+        future.waiters += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            future.waiters -= 1
+            if future.waiters == 0 and not future.done():
+                future.cancel()
+
+    def forget(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+
+class StreamFlight:
+    """
+    One streamed LLM answer shared by every concurrent request for the same
+    incident. Late joiners first get the chunks produced so far and then
+    follow the live stream.
+    """
+
+    def __init__(self):
+        # Resolves to (error string, error code) or (None, success code) once
+        # retrieval is done and streaming can start.
+        self.prepared = asyncio.get_running_loop().create_future()
+        # The llm choice that answers, once the stream has started.
+        self.served = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cond = asyncio.Condition()
+
+    async def publish(self, chunk):
+        async with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    async def finish(self, error=None):
+        async with self.cond:
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    async def follow(self):
+        sent = 0
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: sent < len(self.chunks) or self.done)
+                pending = self.chunks[sent:]
+                finished = self.done
+
+            for chunk in pending:
+                yield chunk
+            sent += len(pending)
+
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class Overloaded(Exception):
+    """
+    Raised by AdmissionGate when a call is turned away. 'retry_after' is the
+    estimated number of seconds until a slot frees up.
+    """
+
+    def __init__(self, stage, reason, retry_after):
+        super().__init__(
+            f"Server overloaded ({stage}: {reason}), retry after {retry_after} seconds."
+        )
+        self.stage = stage
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionGate:
+    """
+    Bounded concurrency for one stage of the query pipeline: at most 'limit'
+    calls run at once and at most 'queue_size' more wait, each for at most
+    'queue_timeout' seconds. Anything beyond is rejected with Overloaded
+    right away instead of piling up on Vertex AI quotas.
+    """
+
+    def __init__(
+        self,
+        stage,
+        limit,
+        queue_size=ADMISSION_QUEUE_SIZE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT_SEC,
+    ):
+        self.stage = stage
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+        # Moving average of how long a slot is held, for Retry-After.
+        self.hold_sec = 1.0
+
+    def full(self):
+        return self.active >= self.limit and len(self.waiters) >= self.queue_size
+
+    def retry_after(self):
+        # Seconds until the queue ahead of a new caller has drained.
+        backlog = len(self.waiters) + 1
+        return max(1, int(self.hold_sec * backlog / self.limit + 0.5))
+
+    def reject(self, reason):
+        ADMISSION_REJECTED.inc(self.stage, reason)
+        raise Overloaded(self.stage, reason, self.retry_after())
+
+    def try_acquire(self):
+        # Takes a slot only if one is free and nobody is waiting for it.
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return True
+        return False
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.queue_size:
+            self.reject("queue_full")
+
+        # release() hands its slot over by resolving the future.
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.remove(waiter)
+            self.reject("queue_timeout")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.remove(waiter)
+            raise
+
+    def remove(self, waiter):
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.hold_sec = 0.9 * self.hold_sec + 0.1 * (time.perf_counter() - start)
+            self.release()
+
+
+def get_admission_gate(stage):
+    # One gate per stage and worker process.
+    gate = admission_gates.get(stage)
+    if gate is None:
+        limit = LLM_CONCURRENCY if stage == "llm" else EMBED_CONCURRENCY
+        gate = admission_gates[stage] = AdmissionGate(stage, limit)
+    return gate
+
+
+def retry_after_sec():
+    # Retry-After of an overloaded or rate limited response.
+    return max([gate.retry_after() for gate in admission_gates.values()] + [1])
+
+
+def is_quota_error(e):
+    # Vertex AI reports exhausted quotas as google.api_core ResourceExhausted
+    # (HTTP 429).
+    return getattr(e, "code", None) == HTTP_CODE_TOO_MANY_REQUESTS
+
+
+def overloaded_answer(stage):
+    # Fast path: turn a query away before any work when its stage is full.
+    gate = get_admission_gate(stage)
+    if not gate.full():
+        return None
+    ADMISSION_REJECTED.inc(stage, "queue_full")
+    return f"Server overloaded ({stage}), retry after {gate.retry_after()} seconds."
+
+
+class RateLimiter:
+    """
+    Per-client token buckets: 'rate' requests per second with bursts of up
+    to 'burst'. Only the RATE_LIMIT_MAX_CLIENTS most recent clients are
+    tracked.
+    """
+
+    def __init__(self, rate, burst, max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> (tokens, last refill time)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, client, now=None):
+        # Returns 0 if the request may go ahead, otherwise the number of
+        # seconds until the client has a token again.
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, last = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = max(1, int((1 - tokens) / self.rate + 0.999))
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+def get_corpus_version():
+    config = get_settings()
+
+    # The store ledgers are rewritten whenever store_embeddings() changes a
+    # collection, so their stat() signature identifies the corpus version
+    # across all the workers sharing CSV_ROOT.
+    parts = []
+    for ledger in [
+        config.embed_deci_store_list_file,
+        config.embed_regul_store_list_file,
+    ]:
+        try:
+            st = os.stat(ledger)
+            parts.append(f"{st.st_mtime_ns}-{st.st_size}")
+        except OSError:
+            parts.append("none")
+    return ":".join(parts)
+
+
+def normalize_query_metadata(query_metadata):
+    # Only the fields that end up in create_user_query() and the retrieval
+    # filters decide the answer.
+    return {
+        field: str(query_metadata[field]).strip().lower()
+        for field in ["car_num", "year", "location"]
+        if query_metadata.get(field)
+    }
+
+
+def answer_cache_key(query_metadata, llm_choice):
+    key = {
+        "metadata": normalize_query_metadata(query_metadata),
+        "llm": llm_choice,
+        "corpus": get_corpus_version(),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def answer_etag(cache_key, answer):
+    # Strong ETag of a cached answer: the cache key covers the incident, the
+    # model and the corpus version, the digest the text itself (it changes
+    # when an expired answer is generated again).
+    digest = hashlib.sha256(f"{cache_key}\n{answer}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    If-None-Match holds "*" or a list of (possibly weak) ETags. The
+    compression middleware tags gzip variants with a suffix.
+    Returns: the matching ETag as it was sent with the response (so that a
+             304 repeats the variant the client holds), or None.
+    """
+    if not if_none_match or etag is None:
+        return None
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip().removeprefix("W/")
+        if candidate == "*":
+            return etag
+        if re.sub(r"-gzip\"$", '"', candidate) == etag:
+            return candidate
+    return None
+
+
+def get_answer_cache():
+    global answer_cache
+
+    if answer_cache is None:
+        with registry_lock:
+            if answer_cache is None:
+                answer_cache = LRUCache(
+                    "answer",
+                    ANSWER_CACHE_SIZE,
+                    ttl=ANSWER_CACHE_TTL_SEC,
+                    db_path=ANSWER_CACHE_DB,
+                )
+    return answer_cache
+
+
+def invalidate_answer_cache():
+    DEBUG(DBG_LVL_MED, "Corpus changed. Clearing answer cache.")
+    get_answer_cache().clear()
+
+
+# =============================================================================
+#                                CHUNK THE DATA
+# =============================================================================
+def is_file_interesting(file_name):
+    strs = ["Decision", "Summons", "Offence", "Infringement", "regulations"]
+    for substr in strs:
+        if substr in file_name:
+            return True
+    return False
+
+
+def find_markers(input_text):
+    markers = [
+        "No / Driver",
+        "Competitor",
+        "Time",
+        "Session",
+        "Fact",
+        "Infringement",
+        "Offence",
+        "Decision",
+        "Reason",
+    ]
+    marker_pattern = "|".join(re.escape(m) for m in markers)
+
+    # The main regex pattern:
+    # (marker_pattern)   -> Capture Group 1: Matches and captures one of the defined markers.
+    # \s* -> Matches zero or more whitespace characters (spaces, tabs, newlines).
+    # (.*?)              -> Capture Group 2: Matches and captures the content (non-greedily).
+    # (?=marker_pattern|$) -> Positive Lookahead: Looks ahead for the next marker OR the end of the string ($).
+    #                         This tells the non-greedy content capture (.*?) where to stop.
+    regex = rf"({marker_pattern})\s*(.*?)(?={marker_pattern}|$)"
+
+    # Find all matches
+    # re.DOTALL ensures that '.' matches newlines, allowing content to span multiple lines.
+    matches = re.findall(regex, input_text, re.DOTALL)
+
+    # Format results into a dictionary
+    results = {}
+    for marker, content in matches:
+        # Clean up any leading/trailing whitespace from the content before storing
+        results[marker.strip()] = content.strip()
+
+    return results
+
+
+def read_pdf_text(filepath):
+    # Returns: (text of all pages on one line, number of pages)
+    from pypdf import PdfReader
+
+    input_text = ""
+    pdf_reader = PdfReader(filepath)
+    for page in pdf_reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            page_text = page_text.replace("\n", " ") + " "
+            page_text = page_text.replace("\u00a0", " ")
+            page_text = page_text.replace("\u2013", " ")
+
+            input_text += page_text
+
+    # Collapse any sequence of one or more spaces into a single space
+    return re.sub(" +", " ", input_text).strip(), len(pdf_reader.pages)
+
+
+def chunk_file(filepath, filename, json_folder, counter, metadata, input_text=None):
+    # 'input_text' is the text of the PDF if the caller has read it already.
+    import pandas as pd
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    DEBUG(DBG_LVL_MED, "\nCOUNT: %d, FILE: %s" % (counter, filepath))
+    # DEBUG(DBG_LVL_LOW, "filename: %s" % (filename))
+
+    chunk_jsonl = os.path.join(json_folder, f"chunks-{filename}.jsonl")
+    if os.path.isfile(chunk_jsonl):
+        return ERROR_CODE_ALREADY_CHUNKED
+
+    if input_text is None:
+        try:
+            input_text, _ = read_pdf_text(filepath)
+        except Exception as e:
+            DEBUG(DBG_LVL_MED, f"Error processing {filepath}: {e}")
+            return ERROR_CODE_FILE_CORRUPTED
+
+    if metadata["doc_type"] == "decision":
+        if "car_num" not in metadata:
+            # Extract Car Number(s) from file content.
+            all_involved_cars = extract_car_num_from_txt(input_text)
+            if all_involved_cars:
+                # Use the first car found as the primary filter target
+                metadata["car_num"] = all_involved_cars[0]
+
+                # Store ALL involved cars for RAG context.
+                metadata["all_involved_cars"] = ", ".join(all_involved_cars)
+        DEBUG(DBG_LVL_LOW, '"Metadata:" ' + str(metadata))
+
+        # If "Car xxx" is still not found, this file can be skipped.
+        if "car_num" not in metadata:
+            DEBUG(DBG_LVL_MED, "CAR INFO NOT FOUND. FILE: %s" + filepath)
+            return ERROR_CODE_FILE_SKIPPED
+
+        # Find relevant markers in the input text.
+        markers = run_cpu_sync(find_markers, input_text)
+        if "Fact" not in markers.keys() or "Reason" not in markers.keys():
+            DEBUG(DBG_LVL_MED, "NO PARAMETERS FOUND. FILE: %s" + filepath)
+            return ERROR_CODE_FILE_SKIPPED
+
+    DEBUG(DBG_LVL_MED, "FILE COUNT-%d, CHUNKING: %s" % (counter, filepath))
+
+    # Initialize the splitter
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", " ", ""],
+    )
+
+    # Perform the chunking process.
+    text_chunks = text_splitter.create_documents([input_text.lower()])
+    text_chunks = [doc.page_content for doc in text_chunks]
+    assert len(text_chunks)
+
+    # Save the chunks
+    data_df = pd.DataFrame(text_chunks, columns=["chunk"])
+    data_df["file"] = filename
+
+    DEBUG(DBG_LVL_MED, "Writing chunks to: " + chunk_jsonl)
+    # Combine base metadata with chunk specifics
+    with open(chunk_jsonl, "w") as f:
+        for i, chunk in enumerate(text_chunks):
+            record = {"id": f"{filename}_{i}", "text": chunk, **metadata}
+            f.write(json.dumps(record) + "\n")
+
+    return ERROR_CODE_SUCCESS
+
+
+def get_delta_files_to_process(chunk_file_list, json_folder):
+    import pandas as pd
+
+    config = get_settings()
+
+    chunk_jsonl_list = glob.glob(os.path.join(json_folder, "chunks-*.jsonl"))
+    chunk_jsonl_files = [os.path.basename(file) for file in chunk_jsonl_list]
+    # print("len(chunk_jsonl_files) " + str(len(chunk_jsonl_files)))
+
+    if not os.path.isfile(config.chunk_processed_file):
+        # print("CHUNK PROCESSED file: %s DOES NOT exist" %(chunk_processed_file))
+
+        if len(chunk_jsonl_files):
+            # This is the case where some files are already processed before
+            # CSV tracking is introduced.
+
+            # print("%d no of already processed files" %(len(chunk_jsonl_files)))
+            chunk_processed_set.update(chunk_jsonl_files)
+            chunk_processed_set_orig.update(chunk_jsonl_files)
+
+            processed_df = pd.DataFrame(chunk_jsonl_files, columns=["filename"])
+            processed_df.to_csv(config.chunk_processed_file, index=False)
+    else:
+        # print("CHUNK PROCESSED file: %s Exist" %(chunk_processed_file))
+
+        df = pd.read_csv(config.chunk_processed_file)
+        chunk_processed_set.update(df["filename"])
+        chunk_processed_set_orig.update(df["filename"])
+    # print("Size of chunk_processed_set: " + str(len(chunk_processed_set)))
+
+    if os.path.isfile(config.chunk_skipped_file):
+        # print("CHUNK SKIPPED file: %s Exist" %(chunk_skipped_file))
+
+        df = pd.read_csv(config.chunk_skipped_file)
+        chunk_skipped_set.update(df["filename"])
+        chunk_skipped_set_orig.update(df["filename"])
+    # print("Size of chunk_skipped_set: %d" %len(chunk_skipped_set))
 
     skipped = 0
     already = 0
@@ -632,6 +2522,10 @@ def get_delta_files_to_process(chunk_file_list, json_folder):
 
 
 def chunk(tag, json_folder, limit):
+    import pandas as pd
+    from google.cloud import storage
+
+    config = get_settings()
 
     chunk_file_list = []
     try:
@@ -639,7 +2533,7 @@ def chunk(tag, json_folder, limit):
         storage_client = storage.Client()
 
         # Get the bucket object
-        bucket = storage_client.bucket(GCP_BUCKET)
+        bucket = storage_client.bucket(config.GCP_BUCKET)
 
         # List all blobs (files and folder objects)
         DEBUG(DBG_LVL_MED, "Reading file name blob from GCP start")
@@ -658,8 +2552,8 @@ def chunk(tag, json_folder, limit):
                 # Skip the files that are not of interest.
                 continue
 
-            DEBUG(DBG_LVL_LOW, f"gs://{GCP_BUCKET}/{blob.name}")
-            filepath = ROOT_DIR + "/" + blob.name
+            DEBUG(DBG_LVL_LOW, f"gs://{config.GCP_BUCKET}/{blob.name}")
+            filepath = config.ROOT_DIR + "/" + blob.name
             chunk_file_list.append(filepath)
     except Exception as e:
         ret_str = "INFRA FAILED. Error code: " + str(e) + "\n"
@@ -677,15 +2571,18 @@ def chunk(tag, json_folder, limit):
     delta_files = get_delta_files_to_process(chunk_file_list, json_folder)
     DEBUG(DBG_LVL_HIGH, "Total delta files to process: " + str(len(delta_files)))
 
+    # The metadata of all file names to be chunked, in one pass.
+    delta_files = delta_files[: limit + 1]
+    filenames = [
+        os.path.splitext(os.path.basename(file))[0].lower() for file in delta_files
+    ]
+    metadatas = get_document_metadata(filenames)
+
     # limit = 10
-    for file in delta_files:
+    for file, filename, metadata in zip(delta_files, filenames, metadatas):
         if total_files > limit:
             break
 
-        filename = os.path.basename(file)
-        filename = os.path.splitext(filename)[0].lower()
-
-        metadata = parse_metadata_from_text(filename)
         DEBUG(DBG_LVL_LOW, f"File: '{filename}', metadata: " + str(metadata))
 
         retval = chunk_file(file, filename, json_folder, total_files, metadata)
@@ -715,17 +2612,17 @@ def chunk(tag, json_folder, limit):
     # Update CHUNK_PROCESSED_LIST_FILE
     if len(chunk_processed_set) and chunk_processed_set != chunk_processed_set_orig:
         processed_df = pd.DataFrame(list(chunk_processed_set), columns=["filename"])
-        processed_df.to_csv(chunk_processed_file, index=False)
+        processed_df.to_csv(config.chunk_processed_file, index=False)
 
     # Update CHUNK_SKIPPED_LIST_FILE
     if len(chunk_skipped_set) and chunk_skipped_set != chunk_skipped_set_orig:
         skipped_df = pd.DataFrame(list(chunk_skipped_set), columns=["filename"])
-        skipped_df.to_csv(chunk_skipped_file, index=False)
+        skipped_df.to_csv(config.chunk_skipped_file, index=False)
 
     # Update CHUNK_CORRUPTED_LIST_FILE
     if len(chunk_corrupted_set) and chunk_corrupted_set != chunk_corrupted_set_orig:
         corrupted_df = pd.DataFrame(list(chunk_corrupted_set), columns=["filename"])
-        corrupted_df.to_csv(chunk_corrupted_file, index=False)
+        corrupted_df.to_csv(config.chunk_corrupted_file, index=False)
 
     ret_str = "No of files processed now: " + str(files_chunked_now) + "\n"
     ret_str += "No of files already chunked: " + str(total_already_chunked) + "\n"
@@ -737,20 +2634,22 @@ def chunk(tag, json_folder, limit):
 
 
 def create_chunks(limit=sys.maxsize):
+    config = get_settings()
+
     DEBUG(DBG_LVL_LOW, "NUM FILES LIMIT: " + str(limit))
 
     init_globals()
 
     # Ensure the destination directory exists
-    assert os.path.exists(DATASET_DIR), DATASET_DIR + " does not exist"
+    assert os.path.exists(config.DATASET_DIR), config.DATASET_DIR + " does not exist"
 
     # Make dataset folders
-    os.makedirs(JSON_OUTPUT_DIR, exist_ok=True)
-    os.makedirs(DECISION_JSON_DIR, exist_ok=True)
-    os.makedirs(REGULATION_JSON_DIR, exist_ok=True)
+    os.makedirs(config.JSON_OUTPUT_DIR, exist_ok=True)
+    os.makedirs(config.DECISION_JSON_DIR, exist_ok=True)
+    os.makedirs(config.REGULATION_JSON_DIR, exist_ok=True)
 
     DEBUG(DBG_LVL_HIGH, "\nChunking for decision files start")
-    ret_str, ret_val = chunk("decisions", DECISION_JSON_DIR, int(limit))
+    ret_str, ret_val = chunk("decisions", config.DECISION_JSON_DIR, int(limit))
     ret_str_1 = "Chunking for decision files done. \n" + ret_str + "\n"
     DEBUG(DBG_LVL_HIGH, ret_str_1)
     if ret_val == ERROR_CODE_GCS_FAILURE:
@@ -758,7 +2657,7 @@ def create_chunks(limit=sys.maxsize):
         return ret_str_1, ERROR_CODE_GCS_FAILURE
 
     DEBUG(DBG_LVL_HIGH, "\nChunking for regulation files start")
-    ret_str, ret_val = chunk("regulations", REGULATION_JSON_DIR, int(limit))
+    ret_str, ret_val = chunk("regulations", config.REGULATION_JSON_DIR, int(limit))
     ret_str_2 = "Chunking for regulation files done\n" + ret_str
     DEBUG(DBG_LVL_HIGH, ret_str_2)
 
@@ -798,10 +2697,39 @@ def generate_embeddings(embed_model, chunks, batch_size=250):  # Max for Vertex
     return all_embeds
 
 
+def embed_file_name(chunk_jsonl_file):
+    folder, name = os.path.split(chunk_jsonl_file)
+    return os.path.join(folder, name.replace("chunks-", "embeddings-", 1))
+
+
+def embed_chunk_file(chunk_jsonl_file, embed_model):
+    # Read from Chunk file.
+    records = []
+    with open(chunk_jsonl_file, "r") as f:
+        records = [json.loads(line) for line in f]
+
+    chunks = [record["text"] for record in records]
+    embeddings = generate_embeddings(embed_model, chunks, batch_size=BATCH_SIZE)
+
+    embed_jsonl_file = embed_file_name(chunk_jsonl_file)
+    DEBUG(DBG_LVL_LOW, "Writing embeddings to: " + embed_jsonl_file)
+
+    # Write to a temp file first: a half written embeddings file would
+    # otherwise be treated as 'ALREADY DONE' by the next run.
+    tmp_file = f"{embed_jsonl_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        for record, embedding in zip(records, embeddings):
+            record["embedding"] = embedding
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_file, embed_jsonl_file)
+
+    return embed_jsonl_file
+
+
 def embed(json_folder, file_limit=sys.maxsize):
     ret_val = ERROR_CODE_SUCCESS
 
-    embed_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+    embed_model = get_embed_model()
 
     # Get the list of chunk files
     jsonl_files = glob.glob(os.path.join(json_folder, "chunks-*.jsonl"))
@@ -816,7 +2744,7 @@ def embed(json_folder, file_limit=sys.maxsize):
         total_file_counter += 1
 
         # Check if an embedded file for this chunk file is already created.
-        embed_jsonl_file = chunk_jsonl_file.replace("chunks-", "embeddings-")
+        embed_jsonl_file = embed_file_name(chunk_jsonl_file)
         if os.path.isfile(embed_jsonl_file):  # File already processed
             DEBUG(
                 DBG_LVL_LOW,
@@ -831,27 +2759,14 @@ def embed(json_folder, file_limit=sys.maxsize):
                 % (total_file_counter, chunk_jsonl_file),
             )
 
-        # Read from Chunk file.
-        records = []
-        with open(chunk_jsonl_file, "r") as f:
-            records = [json.loads(line) for line in f]
-
-        chunks = [record["text"] for record in records]
-
         try:
-            embeddings = generate_embeddings(embed_model, chunks, batch_size=BATCH_SIZE)
+            embed_chunk_file(chunk_jsonl_file, embed_model)
         except Exception as e:
             DEBUG(DBG_LVL_LOW, f"Embeddings failed totally. Error: {str(e)}")
             ret_val = ERROR_CODE_GCS_FAILURE
             break
 
-        DEBUG(DBG_LVL_LOW, "Writing embeddings to: " + embed_jsonl_file)
-
         total_embedded_now += 1
-        with open(embed_jsonl_file, "w") as f:
-            for record, embedding in zip(records, embeddings):
-                record["embedding"] = embedding
-                f.write(json.dumps(record) + "\n")
 
     total_prev_embedded = total_file_counter - total_embedded_now
     ret_str = "Num files embedded now: " + str(total_embedded_now) + "\n"
@@ -862,19 +2777,21 @@ def embed(json_folder, file_limit=sys.maxsize):
 
 
 def create_embeddings(file_limit=sys.maxsize):
+    config = get_settings()
+
     DEBUG(DBG_LVL_LOW, "EMBEDDING FILE LIMIT: " + str(file_limit))
 
     init_globals()
 
     DEBUG(DBG_LVL_HIGH, "\nEmbedding for decision files start")
-    ret_str, ret_val = embed(DECISION_JSON_DIR, int(file_limit))
+    ret_str, ret_val = embed(config.DECISION_JSON_DIR, int(file_limit))
     ret_str_1 = "Embedding for decision files done. \n" + ret_str + "\n"
     if ret_val == ERROR_CODE_GCS_FAILURE:
         DEBUG(DBG_LVL_HIGH, ret_str_1)
         return ret_str_1, ERROR_CODE_GCS_FAILURE
 
     DEBUG(DBG_LVL_HIGH, "\nEmbedding for regulation files start")
-    ret_str, ret_val = embed(REGULATION_JSON_DIR, int(file_limit))
+    ret_str, ret_val = embed(config.REGULATION_JSON_DIR, int(file_limit))
     ret_str_2 = "Embedding for regulation files done. \n" + ret_str + "\n"
 
     ret_str = ret_str_1 + ret_str_2
@@ -888,20 +2805,75 @@ def create_embeddings(file_limit=sys.maxsize):
 # =============================================================================
 #                        STORE EMBEDDINGS INTO CHROMADB
 # =============================================================================
-def store_text_embeddings(jsonl_file, target_collection, batch_size=500):
+def read_store_list(store_list_file):
+    import pandas as pd
+
+    if not os.path.isfile(store_list_file):
+        return set()
+    df = pd.read_csv(store_list_file)
+    return set(df["filename"])
+
+
+def write_store_list(store_list_file, filenames):
+    import pandas as pd
+
+    # Replace the ledger in one step so readers never see a partial file.
+    tmp_file = f"{store_list_file}.{os.getpid()}.tmp"
+    store_df = pd.DataFrame(sorted(filenames), columns=["filename"])
+    store_df.to_csv(tmp_file, index=False)
+    os.replace(tmp_file, store_list_file)
+
+
+@contextmanager
+def store_list_lock(store_list_file):
+    # Serializes the changes of a collection and its ledger across API
+    # workers and job threads (flock() locks of separate open() calls
+    # exclude each other). Not reentrant.
+    with open(store_list_file + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def update_store_list(store_list_file, filename):
+    # Caller holds store_list_lock().
+    stored_set = read_store_list(store_list_file)
+    if filename not in stored_set:
+        stored_set.add(filename)
+        write_store_list(store_list_file, stored_set)
+
+
+def add_to_store_list(store_list_file, filename):
+    # Read-modify-write under an exclusive lock, API workers may ingest
+    # different documents at the same time.
+    with store_list_lock(store_list_file):
+        update_store_list(store_list_file, filename)
+
+
+def read_embedding_records(jsonl_file):
     filename = os.path.basename(jsonl_file)
     filename = os.path.splitext(filename)[0]
     DEBUG(DBG_LVL_LOW, "filename: " + filename)
-    base_metadata = parse_metadata_from_text(filename)
-    DEBUG(DBG_LVL_LOW, "Metadata: " + str(base_metadata))
+    base_metadata = None
 
     ids, embeddings, documents, metadatas = [], [], [], []
     with open(jsonl_file, "r") as f:
         for line in f:
             record = json.loads(line)
 
-            # Combine base metadata with chunk-specific metadata
-            chunk_metadata = base_metadata.copy()
+            # chunk_file() writes the document metadata into every record.
+            # Records of older chunk files only carry the text: their
+            # metadata comes from the file name, through the metadata index.
+            chunk_metadata = {
+                key: value for key, value in record.items() if key not in RECORD_FIELDS
+            }
+            if "doc_type" not in chunk_metadata:
+                if base_metadata is None:
+                    base_metadata = get_document_metadata([document_id(filename)])[0]
+                    DEBUG(DBG_LVL_LOW, "Metadata: " + str(base_metadata))
+                chunk_metadata = base_metadata.copy()
             # Store original filename and chunk index for traceability
             # Handle both old format (file/chunk) and new format (id/text)
             if "id" in record:
@@ -919,6 +2891,13 @@ def store_text_embeddings(jsonl_file, target_collection, batch_size=500):
             documents.append(record_text)
             metadatas.append(chunk_metadata)
 
+    return ids, embeddings, documents, metadatas
+
+
+def store_text_embeddings(jsonl_file, target_collection, batch_size=500):
+    filename = os.path.splitext(os.path.basename(jsonl_file))[0]
+    ids, embeddings, documents, metadatas = read_embedding_records(jsonl_file)
+
     try:
         # Add data to the collection
 
@@ -938,16 +2917,33 @@ def store_text_embeddings(jsonl_file, target_collection, batch_size=500):
 def store(
     jsonl_file_list, jsonl_file_names, target_collection, store_list_file, testing
 ):
+    # The collection is deleted and rebuilt under the ledger lock: an
+    # ingest_document() in between would lose its upsert, or its ledger entry
+    # would be overwritten. Ingests wait for the rebuild instead.
+    with store_list_lock(store_list_file):
+        return rebuild_collection(
+            jsonl_file_list,
+            jsonl_file_names,
+            target_collection,
+            store_list_file,
+            testing,
+        )
+
+
+def rebuild_collection(
+    jsonl_file_list, jsonl_file_names, target_collection, store_list_file, testing
+):
+    # Caller holds store_list_lock().
+    import chromadb
+
+    config = get_settings()
+
     ret_val = ERROR_CODE_SUCCESS
 
     DEBUG(DBG_LVL_LOW, "target_collection: " + target_collection)
     DEBUG(DBG_LVL_LOW, "store_list_file: " + store_list_file)
 
-    already_stored_set = set()
-    if os.path.isfile(store_list_file):
-        print("File: %s Exist" % (store_list_file))
-        df = pd.read_csv(store_list_file)
-        already_stored_set.update(df["filename"])
+    already_stored_set = read_store_list(store_list_file)
     # print("Size of alread_stored_set: %d" %len(already_stored_set))
 
     to_be_stored_set = set()
@@ -968,7 +2964,7 @@ def store(
     chromadb.api.client.SharedSystemClient.clear_system_cache()
 
     # Connect to chroma DB
-    client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+    client = chromadb.HttpClient(host=config.CHROMADB_HOST, port=config.CHROMADB_PORT)
 
     # Clear out any existing items in the collection
     try:
@@ -991,6 +2987,9 @@ def store(
     collection = client.create_collection(
         name=target_collection, metadata={"hnsw:space": "cosine"}
     )
+    # Cached collection handles (and clients, after clear_system_cache())
+    # point to the deleted collection now.
+    reset_chroma_clients()
     DEBUG(DBG_LVL_HIGH, f"Created new empty collection '{target_collection}'")
     DEBUG(DBG_LVL_LOW, "Collection: %s" % collection)
 
@@ -1012,23 +3011,27 @@ def store(
 
     if stored_files:
         assert stored_files == len(to_be_stored_set)
-        store_df = pd.DataFrame(list(to_be_stored_set), columns=["filename"])
-        store_df.to_csv(store_list_file, index=False)
+        write_store_list(store_list_file, to_be_stored_set)
+
+    # The collection has been rebuilt, cached answers may be stale.
+    invalidate_answer_cache()
 
     ret_str = "No of files stored: " + str(stored_files) + "\n"
     return ret_str, ret_val
 
 
 def store_embeddings(testing=False):
+    config = get_settings()
+
     init_globals()
 
     DEBUG(DBG_LVL_HIGH, "\nStoring of embeddings of decision files in Chromadb start")
-    jsonl_file_list, jsonl_file_names = find_embed_files(DECISION_JSON_DIR)
+    jsonl_file_list, jsonl_file_names = find_embed_files(config.DECISION_JSON_DIR)
     ret_str, ret_val = store(
         jsonl_file_list,
         jsonl_file_names,
         DECISIONS_COLLECTION,
-        embed_deci_store_list_file,
+        config.embed_deci_store_list_file,
         bool(testing),
     )
     ret_str_1 = "Storing of embeddings of decision files in Chromadb done."
@@ -1039,12 +3042,12 @@ def store_embeddings(testing=False):
         return ret_str_1, HTTP_CODE_GENERIC_FAILURE
 
     DEBUG(DBG_LVL_HIGH, "\nStoring of embeddings of regulation files in Chromadb start")
-    jsonl_file_list, jsonl_file_names = find_embed_files(REGULATION_JSON_DIR)
+    jsonl_file_list, jsonl_file_names = find_embed_files(config.REGULATION_JSON_DIR)
     ret_str, ret_val = store(
         jsonl_file_list,
         jsonl_file_names,
         REGULATIONS_COLLECTION,
-        embed_regul_store_list_file,
+        config.embed_regul_store_list_file,
         bool(testing),
     )
     ret_str_2 = "Storing of embeddings of regulation files in Chromadb done."
@@ -1055,12 +3058,386 @@ def store_embeddings(testing=False):
     return ret_str, ret_val
 
 
+def ingest_document(filename, json_folder, target_collection, store_list_file):
+    """
+    Embed one chunked document and upsert its vectors into the existing
+    collection. Unlike embed() + store(), the cost is O(document): the rest
+    of the corpus is neither re-scanned nor re-stored.
+    """
+    chunk_jsonl_file = os.path.join(json_folder, f"chunks-{filename}.jsonl")
+    embed_jsonl_file = embed_file_name(chunk_jsonl_file)
+    embed_filename = os.path.basename(embed_jsonl_file)
+
+    if embed_filename in read_store_list(store_list_file):
+        DEBUG(DBG_LVL_LOW, "ALREADY STORED - %s" % embed_filename)
+        return ERROR_CODE_SUCCESS
+
+    if not os.path.isfile(embed_jsonl_file):
+        try:
+            embed_chunk_file(chunk_jsonl_file, get_embed_model())
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Embedding of {chunk_jsonl_file} failed. Error: {e}")
+            return ERROR_CODE_GCS_FAILURE
+
+    # The upsert and the ledger entry go together, and not in the middle of
+    # a store() rebuilding the collection.
+    with store_list_lock(store_list_file):
+        try:
+            ids, embeddings, documents, metadatas = read_embedding_records(
+                embed_jsonl_file
+            )
+            collection = get_chroma_client().get_or_create_collection(
+                name=target_collection, metadata={"hnsw:space": "cosine"}
+            )
+            # upsert() keeps a retried ingest of the same document idempotent.
+            collection.upsert(
+                embeddings=embeddings, documents=documents, metadatas=metadatas, ids=ids
+            )
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Failed to upsert {embed_jsonl_file}. Error: {e}")
+            reset_chroma_clients()
+            return ERROR_CODE_CHROMADB_FAILED
+
+        DEBUG(DBG_LVL_MED, f"Upserted {len(ids)} embeddings from '{embed_filename}'")
+
+        # Updating the ledger bumps the corpus version, which is part of the
+        # answer cache key: older answers are no longer looked up, so the
+        # cache (and the disk tier shared with other workers) stays as is.
+        update_store_list(store_list_file, embed_filename)
+
+    return ERROR_CODE_SUCCESS
+
+
+# ==============================================================================
+#                               INGESTION JOBS
+# ==============================================================================
+JOB_PRIORITY_INTERACTIVE = 0
+JOB_PRIORITY_BULK = 10
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_DONE = "done"
+JOB_STATUS_FAILED = "failed"
+JOB_STATUS_CANCELLED = "cancelled"
+
+INGEST_STEPS = {
+    "chunk": lambda: create_chunks(),
+    "embed": lambda: create_embeddings(),
+    "store": lambda: store_embeddings(),
+}
+
+
+class Job:
+    """
+    One ingestion job. 'fn' runs in a worker thread and returns
+    (result, ret_val) like the rest of the pipeline.
+    """
+
+    def __init__(self, kind, fn, priority):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.priority = priority
+        self.status = JOB_STATUS_QUEUED
+        self.result = None
+        self.ret_val = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = asyncio.get_running_loop().create_future()
+        # Run in the submitter's context, so the job's spans end up in the
+        # trace of the request that queued it.
+        self.context = contextvars.copy_context()
+
+    async def wait(self):
+        # A caller going away must not cancel the job.
+        await asyncio.shield(self.finished)
+        return self.result, self.ret_val
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "priority": self.priority,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    In-process priority queue for ingestion jobs with a bounded number of
+    workers. Interactive jobs always run before queued bulk jobs, and bulk
+    jobs are limited to 'max_bulk_workers' at a time. There are at least two
+    workers, so that at least one is always left for interactive jobs.
+    """
+
+    def __init__(self, num_workers, max_bulk_workers):
+        self.loop = asyncio.get_running_loop()
+        self.num_workers = max(2, num_workers)
+        self.max_bulk_workers = max(1, min(max_bulk_workers, self.num_workers - 1))
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = asyncio.Condition()
+        self.jobs = OrderedDict()
+        self.workers = []
+        self.running = 0
+        self.bulk_running = 0
+
+    async def submit(self, kind, fn, priority=JOB_PRIORITY_BULK):
+        job = Job(kind, fn, priority)
+        self.jobs[job.id] = job
+        self.trim_history()
+
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self.worker()) for _ in range(self.num_workers)
+            ]
+
+        async with self.cond:
+            heapq.heappush(self.heap, (priority, next(self.seq), job))
+            self.cond.notify_all()
+        DEBUG(DBG_LVL_MED, f"Job {job.id} ({kind}) queued, priority {priority}")
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def has_runnable_job(self):
+        if not self.heap:
+            return False
+        priority = self.heap[0][0]
+        return priority < JOB_PRIORITY_BULK or self.bulk_running < self.max_bulk_workers
+
+    async def worker(self):
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(self.has_runnable_job)
+                priority, _, job = heapq.heappop(self.heap)
+                is_bulk = priority >= JOB_PRIORITY_BULK
+                self.running += 1
+                self.bulk_running += is_bulk
+
+            try:
+                await self.run(job)
+            finally:
+                async with self.cond:
+                    self.running -= 1
+                    self.bulk_running -= is_bulk
+                    self.cond.notify_all()
+
+    async def run(self, job):
+        job.status = JOB_STATUS_RUNNING
+        job.started_at = time.time()
+        try:
+            job.result, job.ret_val = await asyncio.to_thread(job.context.run, job.fn)
+            if job.ret_val in (ERROR_CODE_SUCCESS, HTTP_CODE_GENERIC_SUCCESS):
+                job.status = JOB_STATUS_DONE
+            else:
+                job.status = JOB_STATUS_FAILED
+        except asyncio.CancelledError:
+            job.status = JOB_STATUS_CANCELLED
+            raise
+        except Exception as e:
+            DEBUG(DBG_LVL_HIGH, f"Job {job.id} ({job.kind}) failed. Error: {e}")
+            job.status = JOB_STATUS_FAILED
+            job.ret_val = HTTP_CODE_GENERIC_FAILURE
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            if not job.finished.done():
+                job.finished.set_result(None)
+
+    def trim_history(self):
+        # Forget the oldest finished jobs; queued and running ones are kept.
+        excess = len(self.jobs) - JOB_HISTORY_SIZE
+        for job_id in list(self.jobs):
+            if excess <= 0:
+                break
+            if self.jobs[job_id].finished_at is not None:
+                del self.jobs[job_id]
+                excess -= 1
+
+    def stats(self):
+        return {
+            "queued": len(self.heap),
+            "running": self.running,
+            "bulk_running": self.bulk_running,
+        }
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+
+def get_job_queue():
+    global job_queue
+
+    # Workers are tasks of one event loop; asyncio.run() gets a fresh queue.
+    loop = asyncio.get_running_loop()
+    if job_queue is None or job_queue.loop is not loop:
+        job_queue = JobQueue(INGEST_WORKERS, BULK_INGEST_WORKERS)
+    return job_queue
+
+
+def get_job(job_id):
+    if job_queue is None:
+        return None
+    return job_queue.get(job_id)
+
+
+async def close_job_queue():
+    if job_queue is not None and job_queue.loop is asyncio.get_running_loop():
+        await job_queue.close()
+
+
+def ingest_url(user_query):
+    # Download, chunk, embed and store the linked document.
+    # Returns the metadata extracted from it.
+    init_globals()
+    ret_val, query_metadata = preprocess_query(user_query)
+    return query_metadata, ret_val
+
+
+def ingest_corpus(steps):
+    ret_str = ""
+    for step in steps:
+        step_str, ret_val = INGEST_STEPS[step]()
+        ret_str += step_str
+        if ret_val not in (ERROR_CODE_SUCCESS, HTTP_CODE_GENERIC_SUCCESS):
+            return ret_str, ret_val
+    return ret_str, ERROR_CODE_SUCCESS
+
+
+async def submit_url_ingest(url):
+    # Returns None if there is no weblink to ingest.
+    _, _, download_loc = extract_url_and_filename(url.lower(), shall_download=False)
+    if download_loc is None:
+        return None
+    return await get_job_queue().submit(
+        "url", lambda: ingest_url(url), JOB_PRIORITY_INTERACTIVE
+    )
+
+
+async def submit_corpus_ingest(steps):
+    # Returns None if a step is unknown.
+    unknown = [step for step in steps if step not in INGEST_STEPS]
+    if unknown:
+        DEBUG(DBG_LVL_HIGH, f"Unknown ingest steps: {unknown}")
+        return None
+    return await get_job_queue().submit(
+        "+".join(steps), lambda: ingest_corpus(steps), JOB_PRIORITY_BULK
+    )
+
+
+# ==============================================================================
+#                               CPU WORKER POOL
+# ==============================================================================
+def init_cpu_worker():
+    # Runs once in every worker process: load spaCy and the gazetteers
+    # before the first task. Ctrl-C is handled by the parent.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm_up_globals()
+
+
+def cpu_worker_pid():
+    return os.getpid()
+
+
+def get_cpu_pool():
+    """
+    Process pool for the CPU bound parts of a request (spaCy, PDF parsing,
+    find_markers()), so they neither hold the GIL nor stall the event loop.
+    Workers are spawned rather than forked: the server process already runs
+    gRPC and ChromaDB client threads. None if CPU_WORKERS is 0.
+    """
+    global cpu_pool
+
+    if cpu_pool is None and CPU_WORKERS > 0:
+        with registry_lock:
+            if cpu_pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                cpu_pool = ProcessPoolExecutor(
+                    max_workers=CPU_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_cpu_worker,
+                )
+    return cpu_pool
+
+
+async def start_cpu_pool():
+    # Starts every worker up front (one blocking task each), so the first
+    # requests do not pay for a spawn and a spaCy load.
+    global cpu_pool_ready
+
+    pool = get_cpu_pool()
+    if pool is not None:
+        try:
+            pids = await asyncio.gather(
+                *[
+                    asyncio.wrap_future(pool.submit(cpu_worker_pid))
+                    for _ in range(CPU_WORKERS)
+                ]
+            )
+        except Exception:
+            # A worker that failed to start breaks the whole pool; the next
+            # warm-up attempt starts a new one.
+            close_cpu_pool()
+            raise
+        DEBUG(DBG_LVL_HIGH, f"CPU workers ready: {sorted(set(pids))}")
+    cpu_pool_ready = True
+
+
+def close_cpu_pool():
+    global cpu_pool
+    global cpu_pool_ready
+
+    with registry_lock:
+        pool, cpu_pool = cpu_pool, None
+        cpu_pool_ready = False
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_cpu(fn, *args):
+    """
+    Runs fn(*args) on the CPU pool, or on a thread without one. Cancelling
+    the caller (e.g. the client went away) drops the task if no worker has
+    picked it up yet; a running task is left to finish.
+    """
+    if cpu_pool is None:
+        return await asyncio.to_thread(fn, *args)
+    return await asyncio.wrap_future(cpu_pool.submit(fn, *args))
+
+
+def run_cpu_sync(fn, *args):
+    # run_cpu() for the ingestion job threads.
+    if cpu_pool is None:
+        return fn(*args)
+    return cpu_pool.submit(fn, *args).result()
+
+
+def parse_metadata_on_cpu_pool(texts):
+    return run_cpu_sync(parse_metadata_bulk, texts)
+
+
 # ==============================================================================
 #                             QUERY THE RAG SYSTEM
 # ==============================================================================
 def download_file(url, download_loc):
     try:
-        request.urlretrieve(url, download_loc)
+        with stage_timer("pdf_download"):
+            request.urlretrieve(url, download_loc)
+            trace_attributes(bytes_in=os.path.getsize(download_loc))
         print(f"Download complete to: {download_loc}")
     except Exception as e:
         print(f"An error occurred during download: {e}")
@@ -1121,6 +3498,8 @@ def create_user_query(metadata):
 
 
 def preprocess_query(user_query):
+    config = get_settings()
+
     ret_val = ERROR_CODE_SUCCESS
     user_query = user_query.lower()
 
@@ -1132,44 +3511,47 @@ def preprocess_query(user_query):
         assert filename is not None
         assert text is not None
 
-        text_to_process = ""
         try:
-            pdf_reader = PdfReader(download_loc)
-            for page in pdf_reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    page_text = page_text.replace("\n", " ") + " "
-                    page_text = page_text.replace("\u00a0", " ")
-                    page_text = page_text.replace("\u2013", " ")
-
-                    text_to_process += page_text
-
-            # Collapse any sequence of one or more spaces into a single space
-            text_to_process = re.sub(" +", " ", text_to_process).strip()
-
-            # Extract metadata from file content.
-            metadata = parse_metadata_from_text(text_to_process)
+            with stage_timer("pdf_parsing"):
+                text_to_process, pages = run_cpu_sync(read_pdf_text, download_loc)
+                trace_attributes(pages=pages, chars=len(text_to_process))
 
             # STEP-1: Chunk the file.
             # Remove "_" if any. This is to check if the given file is already in our database.
             filename = filename.replace("_", " ").lower()
-            retval = chunk_file(download_loc, filename, DECISION_JSON_DIR, 1, metadata)
-            if ERROR_CODE_SUCCESS == retval:
-                DEBUG(DBG_LVL_MED, f"->CHUNKED: {download_loc}")
-
-                # STEP-2: Embed the chunk file.
-                ret_str, ret_val = embed(DECISION_JSON_DIR)
-                DEBUG(DBG_LVL_MED, "Embedding for decision files done.")
-                if retval == ERROR_CODE_GCS_FAILURE:
-                    return ret_val, None
 
-                # STEP-3: Store the embeddings file
-                ret_str, ret_val = store_embeddings(False)
-                if retval != ERROR_CODE_SUCCESS:
+            # Extract metadata from file content, unless the same document
+            # has been seen before.
+            with stage_timer("metadata_extraction"):
+                metadata = get_document_metadata(
+                    [filename], [text_to_process], parse_metadata_on_cpu_pool
+                )[0]
+            retval = chunk_file(
+                download_loc,
+                filename,
+                config.DECISION_JSON_DIR,
+                1,
+                metadata,
+                text_to_process,
+            )
+            if retval in (ERROR_CODE_SUCCESS, ERROR_CODE_ALREADY_CHUNKED):
+                if ERROR_CODE_SUCCESS == retval:
+                    DEBUG(DBG_LVL_MED, f"->CHUNKED: {download_loc}")
+                else:
+                    DEBUG(DBG_LVL_MED, f"->ALREADY CHUNKED: {download_loc}")
+
+                # STEP-2: Embed and store only this document's chunks.
+                # No-op if a previous query has already ingested it.
+                with stage_timer("document_ingest"):
+                    ret_val = ingest_document(
+                        filename,
+                        config.DECISION_JSON_DIR,
+                        DECISIONS_COLLECTION,
+                        config.embed_deci_store_list_file,
+                    )
+                if ret_val != ERROR_CODE_SUCCESS:
                     return ret_val, None
 
-            elif ERROR_CODE_ALREADY_CHUNKED == retval:
-                DEBUG(DBG_LVL_MED, f"->ALREADY CHUNKED: {download_loc}")
             elif ERROR_CODE_FILE_SKIPPED == retval:
                 DEBUG(DBG_LVL_MED, f"->SKIPPED: {download_loc}")
                 return ERROR_CODE_INVALID_PARAM, None
@@ -1184,134 +3566,352 @@ def preprocess_query(user_query):
             return ERROR_CODE_INVALID_PARAM, None
     else:
         # No web link. Just text.
-        metadata = parse_metadata_from_text(user_query)
+        with stage_timer("metadata_extraction"):
+            metadata = parse_metadata_from_text(user_query)
 
     return ret_val, metadata
 
 
-def query(user_query, llm_choice: str = PARAM_GOOGLE_LLM):
-    ret_val = ERROR_CODE_SUCCESS
+def create_decision_filter(query_metadata):
+    # Convert extracted metadata into a ChromaDB 'where' filter
+    decision_filter = {"$and": []}
+    if "location" in query_metadata:
+        decision_filter["$and"].append({"location": query_metadata["location"]})
+    if "year" in query_metadata:
+        decision_filter["$and"].append({"year": query_metadata["year"]})
+    if "car_num" in query_metadata:
+        decision_filter["$and"].append({"car_num": query_metadata["car_num"]})
 
-    init_globals()
+    # Apply filter only if some metadata is known.
+    target_filter = None
+    if decision_filter["$and"]:
+        # If there are filters, use the $and clause
+        target_filter = decision_filter
+    DEBUG(DBG_LVL_LOW, "target_filter for specific car case: " + str(target_filter))
 
-    # STEP-1: Preprocess the user query.
-    ret_val, query_metadata = preprocess_query(user_query)
-    if ret_val is not ERROR_CODE_SUCCESS:
-        return "Invalid parameters", ret_val
+    return target_filter
 
-    recreated_query = create_user_query(query_metadata)
-    DEBUG(DBG_LVL_LOW, "User query: " + recreated_query)
-    DEBUG(DBG_LVL_LOW, "Query metadata: " + str(query_metadata))
 
-    # STEP-2: Instantiate a pretrained model.
-    embed_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+def create_regulation_filter(query_metadata):
+    # Attempt to retrieve year specific regulations.
+    regulation_filter = None
+    if "year" in query_metadata:
+        regulation_filter = {"year": query_metadata["year"]}
+        DEBUG(DBG_LVL_LOW, "regulation_filter: " + str(regulation_filter))
 
-    # STEP-3: Create embeddings for the user query.
-    try:
-        embeddings = embed_model.get_embeddings(
-            [recreated_query], output_dimensionality=EMBED_DIM
-        )
-    except Exception as e:
-        ret_str = f"Failed to generate embeddings. Last error: {str(e)}"
-        DEBUG(DBG_LVL_HIGH, ret_str)
-        return ret_str, ERROR_CODE_GCS_FAILURE
+    return regulation_filter
+
+
+def estimate_tokens(text):
+    # Gemini averages about four characters per token; good enough for a
+    # budget, and free compared to a count_tokens() round trip.
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def split_chunk_id(chunk_id):
+    # '<document>_<index>' -> ('<document>', index). Index is None if absent.
+    document, _, index = chunk_id.rpartition("_")
+    if document and index.isdigit():
+        return document, int(index)
+    return chunk_id, None
+
+
+def join_overlapping(left, right):
+    # Concatenates consecutive chunks of a document, dropping the words the
+    # splitter repeated at the start of 'right' (up to CHUNK_OVERLAP chars).
+    for size in range(min(len(left), len(right), CHUNK_OVERLAP), 0, -1):
+        at_word = size == len(left) or left[-size - 1].isspace()
+        if at_word and left.endswith(right[:size]):
+            return left + right[size:]
+    return left + " " + right
+
+
+def merge_chunks(documents, metadatas):
+    """
+    Merges the retrieved chunks that are consecutive in their document
+    (chunk ids '<document>_<i>', '<document>_<i+1>', ...) into one passage.
+    Returns: [(passage, metadata)], by the rank of the best chunk of each.
+    """
+    chunks = {}
+    for rank, (doc, meta) in enumerate(zip(documents, metadatas)):
+        meta = meta or {}
+        chunk_id = meta.get("chunk_id") or doc
+        if chunk_id not in chunks:
+            chunks[chunk_id] = (rank, doc, meta)
+
+    by_document = {}
+    for chunk_id, (rank, doc, meta) in chunks.items():
+        document, index = split_chunk_id(chunk_id)
+        if index is None:
+            document, index = chunk_id, 0
+        by_document.setdefault(document, []).append((index, rank, doc, meta))
+
+    passages = []
+    for entries in by_document.values():
+        entries.sort(key=lambda entry: entry[0])
+        run = None
+        for index, rank, doc, meta in entries:
+            if run is not None and index == run[0] + 1:
+                run = [index, min(run[1], rank), join_overlapping(run[2], doc), run[3]]
+            else:
+                if run is not None:
+                    passages.append(run)
+                run = [index, rank, doc, meta]
+        passages.append(run)
+
+    passages.sort(key=lambda run: run[1])
+    return [(text, meta) for _, _, text, meta in passages]
+
+
+def word_trigrams(text):
+    words = text.lower().split()
+    return {tuple(words[i : i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+class ContextAssembler:
+    """
+    Builds the context sections of the prompt from the retrieved chunks:
+    consecutive chunks of a document are merged, near-duplicates of any
+    passage already in the context (of any section) are dropped, and each
+    section is cut to its token budget. 'tokens' keeps the estimated token
+    count of every section built.
+    """
+
+    # Leftover budget below which a passage is not worth truncating.
+    MIN_PASSAGE_TOKENS = 24
+
+    def __init__(self, budgets=None, dedup_threshold=CONTEXT_DEDUP_THRESHOLD):
+        self.budgets = CONTEXT_TOKEN_BUDGETS if budgets is None else budgets
+        self.dedup_threshold = dedup_threshold
+        self.selected = []
+        self.tokens = {}
+
+    def is_duplicate(self, trigrams):
+        for selected in self.selected:
+            if len(trigrams & selected) >= self.dedup_threshold * len(trigrams):
+                return True
+        return False
+
+    def truncate(self, text, max_tokens):
+        if max_tokens < self.MIN_PASSAGE_TOKENS:
+            return None
+        # Cut at a word boundary, leaving room for the ellipsis.
+        cut = text[: (max_tokens - 1) * CHARS_PER_TOKEN].rsplit(" ", 1)[0]
+        return cut + " ..."
+
+    def section(self, name, results, label=None, max_passages=None):
+        budget = self.budgets[name]
+        used = 0
+        passages = []
+        for passage, meta in merge_chunks(
+            results["documents"][0], results["metadatas"][0]
+        ):
+            trigrams = word_trigrams(passage)
+            if self.is_duplicate(trigrams):
+                continue
+
+            text = label(meta) + passage if label else passage
+            if used + estimate_tokens(text) > budget:
+                text = self.truncate(text, budget - used)
+                if text is None:
+                    break
+                # Only the kept part counts against later passages.
+                trigrams = word_trigrams(text)
+
+            passages.append(text)
+            self.selected.append(trigrams)
+            used += estimate_tokens(text)
+            if len(passages) == max_passages:
+                break
+
+        self.tokens[name] = used
+        return passages
+
+
+def build_target_context(assembler, target_results):
+    return assembler.section("target", target_results)
+
+
+def build_historical_context(assembler, broad_results):
+    # Passages already in the specific case are dropped as duplicates.
+    # Limit precedents to 4.
+    return assembler.section(
+        "historical",
+        broad_results,
+        label=lambda meta: f"Car {meta.get('car_num', 'Unknown')} ---\n",
+        max_passages=4,
+    )
+
+
+def build_regulation_context(assembler, results_regulation):
+    return assembler.section("regulation", results_regulation)
+
+
+def format_context(passages):
+    return "\n\n".join(passages) if passages else "None"
 
-    query_embedding = embeddings[0].values
-    # DEBUG(DBG_LVL_LOW, "\nQuery embeddings: \n" + str(query_embedding))
 
-    # STEP-4: Connect to chroma DB
-    client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+def slice_query_results(results, n_results):
+    # Keep the top 'n_results' hits of a single-embedding query result.
+    return {
+        "documents": [results["documents"][0][:n_results]],
+        "metadatas": [results["metadatas"][0][:n_results]],
+    }
 
-    # STEP-5: RETRIEVE SPECIFIC CASE THAT IS ASKED IN QUERY.
-    primary_car = query_metadata.get("car_num", None)
 
-    #  5.1 Convert extracted metadata into a ChromaDB 'where' filter
-    decision_filter = {"$and": []}
-    if "location" in query_metadata:
-        decision_filter["$and"].append({"location": query_metadata["location"]})
-    if "year" in query_metadata:
-        decision_filter["$and"].append({"year": query_metadata["year"]})
-    if "car_num" in query_metadata:
-        decision_filter["$and"].append({"car_num": query_metadata["car_num"]})
+# Deadline (time.monotonic()) of the current request and its optional stages
+# that were skipped or trimmed, {stage: reason}. Set by start_deadline(); the
+# tasks a request spawns inherit both.
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+degraded_stages = contextvars.ContextVar("degraded_stages", default=None)
 
-    #  STEP-5.2 Apply filter only if car number is known.
-    target_filter = None
-    if decision_filter["$and"]:
-        # If there are filters, use the $and clause
-        target_filter = decision_filter
-    DEBUG(DBG_LVL_LOW, "target_filter for specific car case: " + str(target_filter))
+EMPTY_RESULTS = {"documents": [[]], "metadatas": [[]]}
 
-    #  5.2 Query from ChromaDB collection.
-    target_context = []
-    try:
-        dec_collection = client.get_collection(name=DECISIONS_COLLECTION)
-    except Exception:
-        ret_str = f"Collection '{DECISIONS_COLLECTION}' does not exist."
-        DEBUG(DBG_LVL_HIGH, ret_str)
-        return ret_str, ERROR_CODE_CHROMADB_FAILED
 
-    target_results = dec_collection.query(
-        query_embeddings=[query_embedding],
-        n_results=5,
-        include=["documents", "metadatas"],
-        where=target_filter,  # METADATA FILTER
-    )
-    # Compile context, prioritizing the first result
-    for doc, meta in zip(
-        target_results["documents"][0], target_results["metadatas"][0]
-    ):
-        target_context.append(f"{doc}")
-    # STEP-5 TILL HERE: -------------------------
+def start_deadline(deadline_sec=None):
+    deadline_sec = QUERY_DEADLINE_SEC if deadline_sec is None else deadline_sec
+    request_deadline.set(time.monotonic() + deadline_sec)
+    degraded_stages.set({})
 
-    # STEP-6: RETRIEVE HISTORICAL PRECEDENTS.
+
+def stage_budget(limit=None, reserve=0.0):
+    """
+    Seconds a stage may take: what is left of the request deadline minus
+    'reserve' (kept for later stages), capped at 'limit'. None if there is
+    neither a deadline nor a limit.
+    """
+    deadline = request_deadline.get()
+    budget = limit
+    if deadline is not None:
+        left = max(0.0, deadline - time.monotonic() - reserve)
+        budget = left if limit is None else min(limit, left)
+    return budget
+
+
+def degrade(stage, reason):
+    DEBUG(DBG_LVL_MED, f"Deadline: {stage} {reason}")
+    DEGRADED_STAGES.inc(stage, reason)
+    trace_attributes(**{f"{stage}_degraded": reason})
+    stages = degraded_stages.get()
+    if stages is not None:
+        stages[stage] = reason
+
+
+def trimmed_context_budgets():
+    # Halves the optional context sections still in the prompt: the shorter
+    # the prompt, the sooner the LLM answers.
+    stages = degraded_stages.get() or {}
+    budgets = dict(CONTEXT_TOKEN_BUDGETS)
+    for section in ("historical", "regulation"):
+        if section not in stages:
+            budgets[section] //= 2
+            degrade(section, "trimmed")
+    return budgets
+
+
+def deadline_exceeded(stage):
+    ret_str = f"The query deadline was reached during {stage}."
+    DEBUG(DBG_LVL_HIGH, ret_str)
+    return ret_str, HTTP_CODE_DEADLINE_EXCEEDED
+
+
+async def query_or_raise(name, **kwargs):
     try:
-        dec_collection = client.get_collection(name=DECISIONS_COLLECTION)
-    except Exception:
-        ret_str = f"Collection '{DECISIONS_COLLECTION}' does not exist."
-        DEBUG(DBG_LVL_HIGH, ret_str)
-        return ret_str, ERROR_CODE_CHROMADB_FAILED
+        return await query_collection_async(name, **kwargs)
+    except Exception as e:
+        raise RuntimeError(f"Collection '{name}' is not accessible. Error: {e}")
 
-    broad_results = dec_collection.query(
-        query_embeddings=[query_embedding],
-        n_results=10,
-        include=["documents", "metadatas"],
-    )
-    # Filter the broad results in Python for relevance/uniqueness
-    historical_context = []
-    seen_ids = set()
-    for doc, meta in zip(broad_results["documents"][0], broad_results["metadatas"][0]):
-        doc_id = meta.get("chunk_id") or doc
-        if doc_id not in seen_ids and doc not in target_context:
-            historical_context.append(
-                f"Car {meta.get('car_num', 'Unknown')} ---\n{doc}"
-            )
-            seen_ids.add(doc_id)
-            # Limit precedents to 4.
-            if len(historical_context) >= 4:
-                break
-    # STEP-6 TILL HERE: -------------------------
 
-    # STEP-7: RETRIEVE RELEVANT REGULATIONS.
-    # Attempt to retrieve year specific regulations.
+async def retrieve_all_async(
+    query_embedding, query_metadata, timeout=None, optional_timeout=None
+):
+    """
+    Issues the STEP-5 (specific case), STEP-6 (historical precedents) and
+    STEP-7 (regulations) queries at the same time, so that retrieval takes
+    as long as the slowest one instead of their sum.
+    The specific case must arrive within 'timeout' seconds, otherwise
+    asyncio.TimeoutError is raised. The precedents and regulations are
+    optional: they are skipped if 'optional_timeout' is too short to start
+    them, and dropped if they fail or do not arrive within it (see
+    degrade()).
+    Returns: (target_results, broad_results, results_regulation)
+    """
+    start = time.monotonic()
+    target_filter = create_decision_filter(query_metadata)
+
+    optional_queries = {
+        "regulation": lambda: query_or_raise(
+            REGULATIONS_COLLECTION,
+            query_embeddings=[query_embedding],
+            n_results=3,
+            where=create_regulation_filter(query_metadata),
+        )
+    }
+    if target_filter is None:
+        # Without a metadata filter the specific case and the precedents
+        # come from the same query. Chroma applies one 'where' per call, so
+        # this is the only case where both fit in a single round trip.
+        decision_query = query_or_raise(
+            DECISIONS_COLLECTION,
+            query_embeddings=[query_embedding],
+            n_results=10,
+            include=["documents", "metadatas"],
+        )
+    else:
+        decision_query = query_or_raise(
+            DECISIONS_COLLECTION,
+            query_embeddings=[query_embedding],
+            n_results=5,
+            include=["documents", "metadatas"],
+            where=target_filter,  # METADATA FILTER
+        )
+        optional_queries["historical"] = lambda: query_or_raise(
+            DECISIONS_COLLECTION,
+            query_embeddings=[query_embedding],
+            n_results=10,
+            include=["documents", "metadatas"],
+        )
+
+    tasks = {}
+    for stage, query in optional_queries.items():
+        if optional_timeout is None or optional_timeout >= OPTIONAL_STAGE_MIN_SEC:
+            tasks[stage] = asyncio.ensure_future(query())
+        else:
+            degrade(stage, "skipped")
+
+    results = {stage: EMPTY_RESULTS for stage in optional_queries}
     try:
-        reg_collection = client.get_collection(name=REGULATIONS_COLLECTION)
-    except Exception:
-        ret_str = f"Collection '{REGULATIONS_COLLECTION}' does not exist."
-        DEBUG(DBG_LVL_HIGH, ret_str)
-        return ret_str, ERROR_CODE_CHROMADB_FAILED
+        decision_results = await asyncio.wait_for(decision_query, timeout)
+        if tasks:
+            rest = None
+            if optional_timeout is not None:
+                rest = max(0.0, start + optional_timeout - time.monotonic())
+            await asyncio.wait(tasks.values(), timeout=rest)
+        for stage, task in tasks.items():
+            if not task.done():
+                degrade(stage, "timeout")
+            elif task.exception() is not None:
+                DEBUG(DBG_LVL_HIGH, str(task.exception()))
+                degrade(stage, "error")
+            else:
+                results[stage] = task.result()
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+    if target_filter is None:
+        broad_results = decision_results
+        target_results = slice_query_results(broad_results, 5)
+    else:
+        target_results = decision_results
+        broad_results = results["historical"]
 
-    regulation_filter = None
-    if "year" in query_metadata:
-        regulation_filter = {"year": query_metadata["year"]}
-        DEBUG(DBG_LVL_LOW, "regulation_filter: " + str(regulation_filter))
+    return target_results, broad_results, results["regulation"]
 
-    results_regulation = reg_collection.query(
-        query_embeddings=[query_embedding], n_results=3, where=regulation_filter
-    )
-    regulation_context = [f"\n{doc}" for doc in results_regulation["documents"][0]]
-    # STEP-7 TILL HERE: -------------------------
 
-    # STEP-8: Create input for LLM.
+def create_prompt(
+    recreated_query, target_context, historical_context, regulation_context, primary_car
+):
     prompt_template = f"""
     User query:
     {recreated_query}
@@ -1371,29 +3971,852 @@ def query(user_query, llm_choice: str = PARAM_GOOGLE_LLM):
     """
     DEBUG(DBG_LVL_HIGH, prompt_template)
 
-    # STEP-7: Send context and query to target LLM.
+    return prompt_template
+
+
+def assemble_prompt(
+    query_metadata, target_results, broad_results, results_regulation, budgets=None
+):
+    with stage_timer("prompt_assembly"):
+        assembler = ContextAssembler(budgets)
+        target_context = build_target_context(assembler, target_results)
+        historical_context = build_historical_context(assembler, broad_results)
+        regulation_context = build_regulation_context(assembler, results_regulation)
+
+        prompt_template = create_prompt(
+            create_user_query(query_metadata),
+            format_context(target_context),
+            format_context(historical_context),
+            format_context(regulation_context),
+            query_metadata.get("car_num", None),
+        )
+
+        prompt_tokens = estimate_tokens(prompt_template)
+        for section, tokens in assembler.tokens.items():
+            PROMPT_TOKENS.observe(tokens, section)
+        PROMPT_TOKENS.observe(prompt_tokens, "total")
+        trace_attributes(
+            **{f"{name}_context_tokens": n for name, n in assembler.tokens.items()},
+            target_passages=len(target_context),
+            historical_passages=len(historical_context),
+            regulation_passages=len(regulation_context),
+            prompt_chars=len(prompt_template),
+            prompt_bytes=len(prompt_template.encode()),
+            prompt_tokens_estimated=prompt_tokens,
+        )
+        return prompt_template
+
+
+def get_llm_name(llm_choice):
     DEBUG(DBG_LVL_HIGH, "llm_choice: " + str(llm_choice))
     selected_llm = str(LLM_MODELS[llm_choice])
     DEBUG(DBG_LVL_HIGH, "Selected LLM: " + selected_llm)
 
-    llm_model = GenerativeModel(selected_llm)
+    return selected_llm
+
+
+def preprocess_flight_key(user_query):
+    # The text next to a weblink is discarded, so concurrent prompts with the
+    # same link share one download and ingest.
+    text, filename, download_loc = extract_url_and_filename(
+        user_query.lower(), shall_download=False
+    )
+    if download_loc is not None:
+        return "url:" + download_loc
+    return "text:" + user_query.lower().strip()
+
+
+async def preprocess_query_async(user_query):
+    global preprocess_flights
+
+    if preprocess_flights is None:
+        preprocess_flights = SingleFlight("preprocess")
+
+    flight_key = preprocess_flight_key(user_query)
+
+    async def run():
+        if flight_key.startswith("url:"):
+            # Ingesting a linked document runs on a bounded job worker, ahead
+            # of any queued bulk ingestion.
+            job = await get_job_queue().submit(
+                "url", lambda: ingest_url(user_query), JOB_PRIORITY_INTERACTIVE
+            )
+            query_metadata, ret_val = await job.wait()
+            return ret_val, query_metadata
+
+        # spaCy is CPU bound; keep it off the event loop and the GIL.
+        if cpu_pool is None:
+            await asyncio.to_thread(init_globals)
+            return await asyncio.to_thread(preprocess_query, user_query)
+        with stage_timer("metadata_extraction"):
+            metadata = await run_cpu(parse_metadata_from_text, user_query.lower())
+        return ERROR_CODE_SUCCESS, metadata
+
+    with trace_span("preprocess"):
+        ret_val, query_metadata = await preprocess_flights.do(flight_key, run)
+    # Every caller gets its own copy of the shared metadata.
+    return ret_val, dict(query_metadata) if query_metadata is not None else None
+
+
+async def prepare_prompt_async(query_metadata):
+    """
+    Runs the retrieval half of the RAG pipeline (STEP-2 to STEP-8) for the
+    metadata extracted by preprocess_query(). Every network call goes
+    through the async Vertex AI and ChromaDB clients, so that many queries
+    can be in flight on a single event loop.
+    Returns: (prompt, ERROR_CODE_SUCCESS) or (error string, error code).
+    """
+    recreated_query = create_user_query(query_metadata)
+    DEBUG(DBG_LVL_LOW, "User query: " + recreated_query)
+    DEBUG(DBG_LVL_LOW, "Query metadata: " + str(query_metadata))
+
+    # STEP-2 and STEP-3: Create embeddings for the user query, or reuse the
+    # cached ones for a query text that was seen before.
+    try:
+        query_embedding = await asyncio.wait_for(
+            embed_query_async(recreated_query), stage_budget()
+        )
+    except Overloaded as e:
+        return str(e), HTTP_CODE_OVERLOADED
+    except asyncio.TimeoutError:
+        return deadline_exceeded("query embedding")
+    except Exception as e:
+        ret_str = f"Failed to generate embeddings. Last error: {str(e)}"
+        DEBUG(DBG_LVL_HIGH, ret_str)
+        if is_quota_error(e):
+            ADMISSION_REJECTED.inc("embed", "quota")
+            return ret_str, HTTP_CODE_TOO_MANY_REQUESTS
+        return ret_str, ERROR_CODE_GCS_FAILURE
+
+    # STEP-4: The warm ChromaDB client and collection handles come from the
+    # client registry (see init_clients()).
+
+    # STEP-5 to STEP-7: Retrieve the specific case, the historical
+    # precedents and the regulations concurrently, within the deadline.
+    timeout = stage_budget(RETRIEVAL_TIMEOUT_SEC)
+    try:
+        with stage_timer("retrieval"):
+            (
+                target_results,
+                broad_results,
+                results_regulation,
+            ) = await retrieve_all_async(
+                query_embedding,
+                query_metadata,
+                timeout=timeout,
+                optional_timeout=stage_budget(
+                    RETRIEVAL_TIMEOUT_SEC, reserve=LLM_MIN_BUDGET_SEC
+                ),
+            )
+            trace_attributes(
+                target_chunks=count_chunks(target_results),
+                precedent_chunks=count_chunks(broad_results),
+                regulation_chunks=count_chunks(results_regulation),
+            )
+    except asyncio.TimeoutError:
+        if timeout < RETRIEVAL_TIMEOUT_SEC:
+            return deadline_exceeded("retrieval")
+        ret_str = f"Retrieval did not finish within {RETRIEVAL_TIMEOUT_SEC} seconds."
+        DEBUG(DBG_LVL_HIGH, ret_str)
+        return ret_str, ERROR_CODE_CHROMADB_FAILED
+    except Exception as e:
+        ret_str = str(e)
+        DEBUG(DBG_LVL_HIGH, ret_str)
+        return ret_str, ERROR_CODE_CHROMADB_FAILED
+
+    # STEP-8: Create input for LLM, shorter if the LLM is short of time.
+    budgets = None
+    llm_budget = stage_budget()
+    if llm_budget is not None and llm_budget < LLM_TRIM_BELOW_SEC:
+        budgets = trimmed_context_budgets()
+    prompt_template = assemble_prompt(
+        query_metadata, target_results, broad_results, results_regulation, budgets
+    )
+
+    return prompt_template, ERROR_CODE_SUCCESS
+
+
+@counted_query("query")
+async def query_async(
+    user_query,
+    llm_choice: str = PARAM_GOOGLE_LLM,
+    if_none_match=None,
+    deadline_sec=None,
+):
+    """
+    Non-blocking version of query(), answered within 'deadline_sec'
+    (default: QUERY_DEADLINE_SEC). The optional stages skipped or trimmed
+    to meet it are left in degraded_stages.
+    Returns: (response string, status code) exactly like query(), or
+             ("", HTTP_CODE_NOT_MODIFIED) if the cached answer still has one
+             of the ETags in 'if_none_match'.
+    """
+    served_llm.set(None)
+    response_etag.set(None)
+    start_deadline(deadline_sec)
+
+    # STEP-1: Preprocess the user query.
+    try:
+        ret_val, query_metadata = await asyncio.wait_for(
+            preprocess_query_async(user_query), stage_budget()
+        )
+    except asyncio.TimeoutError:
+        return deadline_exceeded("preprocessing")
+    if ret_val != ERROR_CODE_SUCCESS:
+        return "Invalid parameters", ret_val
+
+    # Identical incidents produce identical prompts; serve repeats from cache.
+    cache_key = answer_cache_key(query_metadata, llm_choice)
+    cached_answer = await get_answer_cache().get_async(cache_key)
+    trace_attributes(llm_choice=llm_choice, answer_cached=cached_answer is not None)
+    if cached_answer is not None:
+        DEBUG(DBG_LVL_MED, "Answer served from cache.")
+        served_llm.set(llm_choice)
+        response_etag.set(answer_etag(cache_key, cached_answer))
+        matched = etag_matches(if_none_match, response_etag.get())
+        if matched is not None:
+            response_etag.set(matched)
+            return "", HTTP_CODE_NOT_MODIFIED
+        return cached_answer, HTTP_CODE_GENERIC_SUCCESS
+
+    global answer_flights
+
+    if answer_flights is None:
+        answer_flights = SingleFlight("answer")
+
+    # Joining an in-flight computation costs nothing; a new one needs a slot.
+    if cache_key not in answer_flights.calls:
+        overloaded = overloaded_answer("llm")
+        if overloaded is not None:
+            return overloaded, HTTP_CODE_OVERLOADED
+
+    # Concurrent requests about the same incident wait on one computation
+    # (and its deadline).
+    answer, ret_val, served, degraded = await answer_flights.do(
+        cache_key, lambda: generate_answer_async(query_metadata, llm_choice, cache_key)
+    )
+    served_llm.set(served)
+    degraded_stages.get().update(degraded)
+    # Only answers that went into the cache are served again as they are.
+    if ret_val == HTTP_CODE_GENERIC_SUCCESS and served == llm_choice and not degraded:
+        response_etag.set(answer_etag(cache_key, answer))
+    return answer, ret_val
+
+
+async def generate_answer_async(query_metadata, llm_choice, cache_key):
+    # Returns: (answer, status code, served llm choice, degraded stages)
+    prompt_template, ret_val = await prepare_prompt_async(query_metadata)
+    degraded = dict(degraded_stages.get() or {})
+    if ret_val != ERROR_CODE_SUCCESS:
+        return prompt_template, ret_val, None, degraded
+
+    # STEP-9: Send context and query to target LLM.
+    answer, ret_val, served = await generate_llm_answer_async(
+        prompt_template, llm_choice
+    )
+    # A hedge, fallback or degraded answer is not cached under the chosen
+    # model.
+    if ret_val == HTTP_CODE_GENERIC_SUCCESS and served == llm_choice and not degraded:
+        await get_answer_cache().set_async(cache_key, answer)
+    return answer, ret_val, served, degraded
+
+
+# The LLM choice that produced the answer of the current request. Set by
+# query_async(); differs from the requested one after a hedge or fallback.
+served_llm = contextvars.ContextVar("served_llm", default=None)
+
+# The ETag of the answer of the current request, None if it is not cached
+# (see answer_etag()), or the matching one of If-None-Match for a 304. Set by
+# query_async().
+response_etag = contextvars.ContextVar("response_etag", default=None)
+
+# Recent latencies per LLM choice (see LatencyWindow).
+llm_latencies = {}
+
+
+class LatencyWindow:
+    """
+    Latencies of the last 'size' successful calls of one model, for the
+    percentile based hedging delay.
+    """
+
+    def __init__(self, size=LLM_LATENCY_WINDOW):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q):
+        # None until LLM_HEDGE_MIN_SAMPLES latencies have been observed.
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * q / 100))
+        return samples[index]
+
+
+def get_llm_latency(llm_choice):
+    return llm_latencies.setdefault(llm_choice, LatencyWindow())
+
+
+def hedge_delay(llm_choice):
+    # Seconds after which a hedge request is issued, None if hedging is off.
+    if not LLM_HEDGE:
+        return None
+    delay = get_llm_latency(llm_choice).percentile(LLM_HEDGE_PERCENTILE)
+    if delay is None:
+        delay = LLM_HEDGE_DEFAULT_SEC
+    return max(delay, LLM_HEDGE_MIN_SEC)
+
+
+async def call_llm(prompt_template, llm_choice, via):
+    # One generate_content round trip. Returns: (llm_choice, via, response)
+    llm_model = get_llm_model(get_llm_name(llm_choice))
+    LLM_REQUESTS.inc(llm_choice, "generate" if via == "primary" else via)
+    with trace_span("llm_call"):
+        trace_attributes(model=llm_choice, via=via)
+        start = time.perf_counter()
+        try:
+            response = await llm_model.generate_content_async(prompt_template)
+            # Accessing .text raises for blocked or empty candidates.
+            response.text
+        except asyncio.CancelledError:
+            trace_attributes(cancelled=True)
+            raise
+        except Exception:
+            LLM_FAILURES.inc(llm_choice, "error")
+            raise
+        get_llm_latency(llm_choice).observe(time.perf_counter() - start)
+    return llm_choice, via, response
+
+
+async def generate_with_fallback(prompt_template, llm_choice, timeout):
+    """
+    Calls the chosen LLM within 'timeout' seconds. A second request goes to
+    the Gemini model (PARAM_GOOGLE_LLM):
+      - as a hedge, once the first one runs past hedge_delay(); the first
+        answer wins and the other request is cancelled;
+      - as a fallback, when another model (the fine-tuned endpoint) fails.
+    The second request takes its own "llm" admission slot: a hedge is only
+    sent if a slot is free right away, a fallback waits for one.
+    Returns: (served llm choice, via, response). Raises the error of the
+    chosen model if no answer came, asyncio.TimeoutError at the deadline.
+    """
+    gate = get_admission_gate("llm")
+
+    async def backup_call(via, acquired):
+        if not acquired:
+            await gate.acquire()
+        try:
+            return await call_llm(prompt_template, PARAM_GOOGLE_LLM, via)
+        finally:
+            gate.release()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = hedge_delay(llm_choice)
+    hedge_at = None if delay is None else loop.time() + delay
+
+    pending = {asyncio.ensure_future(call_llm(prompt_template, llm_choice, "primary"))}
+    errors = []
+    backup = False
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                LLM_FAILURES.inc(llm_choice, "timeout")
+                raise asyncio.TimeoutError()
+
+            wake_at = (
+                deadline if backup or hedge_at is None else min(deadline, hedge_at)
+            )
+            done, pending = await asyncio.wait(
+                pending, timeout=wake_at - now, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+
+            if not backup:
+                if errors and llm_choice != PARAM_GOOGLE_LLM:
+                    via = "fallback"
+                elif not errors and hedge_at is not None and loop.time() >= hedge_at:
+                    via = "hedge"
+                else:
+                    via = None
+                acquired = via == "hedge" and gate.try_acquire()
+                if via == "hedge" and not acquired:
+                    # Hedging an overloaded server would only add load.
+                    DEBUG(DBG_LVL_MED, f"LLM hedge skipped: no free {gate.stage} slot")
+                    ADMISSION_REJECTED.inc(gate.stage, "hedge_skipped")
+                    hedge_at = None
+                elif via is not None:
+                    DEBUG(DBG_LVL_MED, f"LLM {via}: {llm_choice} -> {PARAM_GOOGLE_LLM}")
+                    backup = True
+                    pending.add(asyncio.ensure_future(backup_call(via, acquired)))
+
+            if not pending:
+                raise errors[0]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def generate_llm_answer_async(prompt_template, llm_choice):
+    """
+    STEP-9: Sends the prompt to the LLM, within LLM_TIMEOUT_SEC (or what is
+    left of the query deadline) and with hedging/fallback (see
+    generate_with_fallback()).
+    Returns: (answer, status code, served llm choice)
+    """
+    ret_val = ERROR_CODE_SUCCESS
+    served = None
     DEBUG(DBG_LVL_HIGH, "\nSending prompt to the LLM...")
 
     DEBUG(DBG_LVL_HIGH, "\n\nLLM RESPONSE")
     answer = ""
+    timeout = LLM_TIMEOUT_SEC
     try:
-        response = llm_model.generate_content(prompt_template)
-        answer = response.text
+        async with get_admission_gate("llm").slot():
+            timeout = stage_budget(LLM_TIMEOUT_SEC)
+            with stage_timer("llm_generation"):
+                trace_attributes(
+                    model=llm_choice, bytes_out=len(prompt_template.encode())
+                )
+                served, via, response = await generate_with_fallback(
+                    prompt_template, llm_choice, timeout
+                )
+            answer = response.text
+            LLM_ANSWERS.inc(llm_choice, served, via)
+            trace_attributes(
+                served_model=served,
+                via=via,
+                bytes_in=len(answer.encode()),
+                **llm_usage_attributes(response),
+            )
+    except Overloaded as e:
+        return str(e), HTTP_CODE_OVERLOADED, None
+    except asyncio.TimeoutError:
+        if timeout < LLM_TIMEOUT_SEC:
+            ret_str, ret_val = deadline_exceeded("LLM generation")
+            return ret_str, ret_val, served
+        answer = f"\nLLM did not answer within {LLM_TIMEOUT_SEC} seconds."
+        ret_val = ERROR_CODE_GCS_FAILURE
     except Exception as e:
         answer = f"\nCommunication with LLM failed. Error: {e}"
+        if is_quota_error(e):
+            ADMISSION_REJECTED.inc("llm", "quota")
+            return answer, HTTP_CODE_TOO_MANY_REQUESTS, served
         ret_val = ERROR_CODE_GCS_FAILURE
 
     DEBUG(DBG_LVL_HIGH, answer)
 
     if ret_val != ERROR_CODE_SUCCESS:
-        return answer, HTTP_CODE_GENERIC_FAILURE
+        return answer, HTTP_CODE_GENERIC_FAILURE, served
+
+    return "\n" + answer, HTTP_CODE_GENERIC_SUCCESS, served
+
+
+async def stream_llm_answer(prompt_template, llm_choice):
+    """
+    Starts a streamed generation (see open_llm_stream()). The
+    'llm_generation' stage lasts until the returned iterator is exhausted.
+    Returns: (served llm choice, async iterator over the answer text)
+    """
+    DEBUG(DBG_LVL_HIGH, "\nStreaming prompt to the LLM...")
+
+    LLM_REQUESTS.inc(llm_choice, "stream")
+    timer = ExitStack()
+    timer.enter_context(stage_timer("llm_generation"))
+    try:
+        trace_attributes(model=llm_choice, bytes_out=len(prompt_template.encode()))
+        served, responses = await open_llm_stream(prompt_template, llm_choice)
+    except BaseException:
+        timer.close()
+        raise
+    LLM_ANSWERS.inc(
+        llm_choice, served, "primary" if served == llm_choice else "fallback"
+    )
+    trace_attributes(served_model=served)
+
+    async def texts():
+        with timer:
+            bytes_in = 0
+            async for response in responses:
+                # Gemini reports token usage on the last chunk.
+                trace_attributes(**llm_usage_attributes(response))
+                try:
+                    text = response.text
+                except ValueError:
+                    # Chunks without text parts (e.g. the final safety/finish
+                    # chunk) have nothing to forward.
+                    continue
+                if text:
+                    bytes_in += len(text.encode())
+                    trace_attributes(bytes_in=bytes_in)
+                    yield text
+
+    return served, texts()
+
+
+async def open_llm_stream(prompt_template, llm_choice):
+    """
+    Starts a streamed generation and waits for its first chunk, within
+    LLM_TIMEOUT_SEC or what is left of the query deadline. Once text went
+    out to the client the answer cannot change model, so the fine-tuned
+    endpoint falls back to the Gemini model only when it fails before its
+    first chunk.
+    Returns: (served llm choice, async iterator over the response chunks)
+    """
+
+    async def first_chunk(choice):
+        llm_model = get_llm_model(get_llm_name(choice))
+        responses = await llm_model.generate_content_async(prompt_template, stream=True)
+        responses = aiter(responses)
+        # None for an empty stream.
+        first = await anext(responses, None)
+        return responses, first
+
+    try:
+        responses, first = await asyncio.wait_for(
+            first_chunk(llm_choice), stage_budget(LLM_TIMEOUT_SEC)
+        )
+        served = llm_choice
+    except Exception as e:
+        reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+        LLM_FAILURES.inc(llm_choice, reason)
+        if llm_choice == PARAM_GOOGLE_LLM:
+            raise
+        DEBUG(DBG_LVL_MED, f"LLM fallback: {llm_choice} -> {PARAM_GOOGLE_LLM} ({e})")
+        LLM_REQUESTS.inc(PARAM_GOOGLE_LLM, "fallback")
+        responses, first = await asyncio.wait_for(
+            first_chunk(PARAM_GOOGLE_LLM), stage_budget(LLM_TIMEOUT_SEC)
+        )
+        served = PARAM_GOOGLE_LLM
+
+    async def chain():
+        if first is None:
+            return
+        yield first
+        async for response in responses:
+            yield response
+
+    return served, chain()
+
+
+def llm_usage_attributes(response):
+    # Token counts reported by Gemini, if any.
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", 0),
+        "answer_tokens": getattr(usage, "candidates_token_count", 0),
+    }
+
+
+async def stream_cached_answer(answer):
+    yield answer
+
+
+async def run_stream_flight(flight, query_metadata, llm_choice, cache_key):
+    parts = []
+    try:
+        prompt_template, ret_val = await prepare_prompt_async(query_metadata)
+        if ret_val != ERROR_CODE_SUCCESS:
+            flight.prepared.set_result((prompt_template, ret_val))
+            await flight.finish()
+            return
+
+        # The slot is taken and the first chunk awaited before the response
+        # starts, so that an overloaded server or a failing LLM still answer
+        # with a status code, and the served model is known.
+        async with get_admission_gate("llm").slot():
+            try:
+                served, chunks = await stream_llm_answer(prompt_template, llm_choice)
+            except Exception as e:
+                ret_str = f"Communication with LLM failed. Error: {e}"
+                DEBUG(DBG_LVL_HIGH, ret_str)
+                ret_val = HTTP_CODE_GENERIC_FAILURE
+                if is_quota_error(e):
+                    ADMISSION_REJECTED.inc("llm", "quota")
+                    ret_val = HTTP_CODE_TOO_MANY_REQUESTS
+                flight.prepared.set_result((ret_str, ret_val))
+                await flight.finish()
+                return
+            flight.served = served
+            flight.prepared.set_result((None, HTTP_CODE_GENERIC_SUCCESS))
+
+            async for chunk in chunks:
+                parts.append(chunk)
+                await flight.publish(chunk)
+    except Overloaded as e:
+        flight.prepared.set_result((str(e), HTTP_CODE_OVERLOADED))
+        await flight.finish()
+        return
+    except Exception as e:
+        if not flight.prepared.done():
+            flight.prepared.set_exception(e)
+        await flight.finish(e)
+        return
+    finally:
+        if stream_flights.get(cache_key) is flight:
+            del stream_flights[cache_key]
+
+    # Only a fully streamed answer of the chosen model with its whole context
+    # goes into the cache.
+    if served == llm_choice and not degraded_stages.get():
+        await get_answer_cache().set_async(cache_key, "\n" + "".join(parts))
+    await flight.finish()
+
+
+@counted_query("stream")
+async def query_stream_async(
+    user_query, llm_choice: str = PARAM_GOOGLE_LLM, deadline_sec=None
+):
+    """
+    Streaming version of query_async(). Retrieval is done up front so that
+    failures are still reported with a status code; the LLM answer is then
+    handed back as an async iterator of text chunks as Gemini produces them.
+    The deadline bounds the time to the first chunk. The model that answers
+    is left in served_llm.
+    Returns: (async iterator of chunks, HTTP_CODE_GENERIC_SUCCESS) or
+             (error string, error code).
+    """
+    served_llm.set(None)
+    start_deadline(deadline_sec)
+    try:
+        ret_val, query_metadata = await asyncio.wait_for(
+            preprocess_query_async(user_query), stage_budget()
+        )
+    except asyncio.TimeoutError:
+        return deadline_exceeded("preprocessing")
+    if ret_val != ERROR_CODE_SUCCESS:
+        return "Invalid parameters", ret_val
+
+    cache_key = answer_cache_key(query_metadata, llm_choice)
+    cached_answer = await get_answer_cache().get_async(cache_key)
+    trace_attributes(llm_choice=llm_choice, answer_cached=cached_answer is not None)
+    if cached_answer is not None:
+        DEBUG(DBG_LVL_MED, "Answer served from cache.")
+        served_llm.set(llm_choice)
+        return (
+            stream_cached_answer(cached_answer.lstrip("\n")),
+            HTTP_CODE_GENERIC_SUCCESS,
+        )
+
+    # Concurrent requests about the same incident follow one LLM stream.
+    flight = stream_flights.get(cache_key)
+    if flight is None:
+        overloaded = overloaded_answer("llm")
+        if overloaded is not None:
+            return overloaded, HTTP_CODE_OVERLOADED
+        flight = StreamFlight()
+        stream_flights[cache_key] = flight
+        flight.task = asyncio.ensure_future(
+            run_stream_flight(flight, query_metadata, llm_choice, cache_key)
+        )
+    else:
+        DEBUG(DBG_LVL_MED, "stream: joined in-flight request.")
+
+    error_str, ret_val = await asyncio.shield(flight.prepared)
+    if ret_val != HTTP_CODE_GENERIC_SUCCESS:
+        return error_str, ret_val
+
+    served_llm.set(flight.served)
+    return flight.follow(), HTTP_CODE_GENERIC_SUCCESS
+
+
+def split_query_results(results):
+    # Split a multi-embedding query result into one result per embedding.
+    return [
+        {"documents": [documents], "metadatas": [metadatas]}
+        for documents, metadatas in zip(results["documents"], results["metadatas"])
+    ]
+
+
+def group_by_filter(filters):
+    # Chroma applies one 'where' per call, so only embeddings sharing the
+    # same filter can go into one multi-vector query.
+    groups = {}
+    for i, where in enumerate(filters):
+        key = json.dumps(where, sort_keys=True)
+        groups.setdefault(key, (where, []))[1].append(i)
+    return list(groups.values())
+
+
+async def query_groups_async(name, embeddings, filters, **kwargs):
+    results = [None] * len(embeddings)
+    groups = group_by_filter(filters)
+    group_results = await asyncio.gather(
+        *[
+            query_or_raise(
+                name,
+                query_embeddings=[embeddings[i] for i in indices],
+                where=where,
+                **kwargs,
+            )
+            for where, indices in groups
+        ]
+    )
+    for (where, indices), group_result in zip(groups, group_results):
+        for i, result in zip(indices, split_query_results(group_result)):
+            results[i] = result
+    return results
+
+
+async def retrieve_batch_async(embeddings, metadatas):
+    """
+    Vectorized retrieve_all_async(). The precedent search has no filter and
+    goes out as a single multi-vector query; the specific case and the
+    regulation searches are grouped by identical filters.
+    Returns: list of (target_results, broad_results, results_regulation)
+    """
+    target_filters = [create_decision_filter(md) for md in metadatas]
+    filtered = [i for i, where in enumerate(target_filters) if where is not None]
+
+    broad_task = query_or_raise(
+        DECISIONS_COLLECTION,
+        query_embeddings=embeddings,
+        n_results=10,
+        include=["documents", "metadatas"],
+    )
+    target_task = query_groups_async(
+        DECISIONS_COLLECTION,
+        [embeddings[i] for i in filtered],
+        [target_filters[i] for i in filtered],
+        n_results=5,
+        include=["documents", "metadatas"],
+    )
+    regulation_task = query_groups_async(
+        REGULATIONS_COLLECTION,
+        embeddings,
+        [create_regulation_filter(md) for md in metadatas],
+        n_results=3,
+    )
+    broad_results, filtered_results, regulation_results = await asyncio.gather(
+        broad_task, target_task, regulation_task
+    )
+
+    broad_results = split_query_results(broad_results)
+    # Without a filter the specific case is the top of the precedent search.
+    target_results = [slice_query_results(result, 5) for result in broad_results]
+    for i, result in zip(filtered, filtered_results):
+        target_results[i] = result
+
+    return list(zip(target_results, broad_results, regulation_results))
+
+
+async def answer_batch_async(metadatas, cache_keys, llm_choice):
+    n = len(metadatas)
+
+    # STEP-2 and STEP-3: Embed every recreated query in Vertex AI batches.
+    try:
+        embeddings = await embed_queries_async(
+            [create_user_query(md) for md in metadatas]
+        )
+    except Overloaded as e:
+        return [(str(e), HTTP_CODE_OVERLOADED)] * n
+    except Exception as e:
+        ret_str = f"Failed to generate embeddings. Last error: {str(e)}"
+        DEBUG(DBG_LVL_HIGH, ret_str)
+        if is_quota_error(e):
+            ADMISSION_REJECTED.inc("embed", "quota")
+            return [(ret_str, HTTP_CODE_TOO_MANY_REQUESTS)] * n
+        return [(ret_str, ERROR_CODE_GCS_FAILURE)] * n
 
-    return "\n" + answer, HTTP_CODE_GENERIC_SUCCESS
+    # STEP-5 to STEP-7: Multi-vector retrieval for the whole batch.
+    try:
+        retrieved = await asyncio.wait_for(
+            retrieve_batch_async(embeddings, metadatas),
+            timeout=RETRIEVAL_TIMEOUT_SEC,
+        )
+    except asyncio.TimeoutError:
+        ret_str = f"Retrieval did not finish within {RETRIEVAL_TIMEOUT_SEC} seconds."
+        DEBUG(DBG_LVL_HIGH, ret_str)
+        return [(ret_str, ERROR_CODE_CHROMADB_FAILED)] * n
+    except Exception as e:
+        ret_str = str(e)
+        DEBUG(DBG_LVL_HIGH, ret_str)
+        return [(ret_str, ERROR_CODE_CHROMADB_FAILED)] * n
+
+    # STEP-8 and STEP-9: One LLM call per incident, with bounded concurrency.
+    semaphore = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def answer(query_metadata, results, cache_key):
+        prompt_template = assemble_prompt(query_metadata, *results)
+        async with semaphore:
+            answer, ret_val, served = await generate_llm_answer_async(
+                prompt_template, llm_choice
+            )
+        if ret_val == HTTP_CODE_GENERIC_SUCCESS and served == llm_choice:
+            await get_answer_cache().set_async(cache_key, answer)
+        return answer, ret_val
+
+    return await asyncio.gather(
+        *[
+            answer(md, results, key)
+            for md, results, key in zip(metadatas, retrieved, cache_keys)
+        ]
+    )
+
+
+async def query_batch_async(prompts, llm_choice: str = PARAM_GOOGLE_LLM):
+    """
+    Answers many prompts at once (e.g. every penalty of a race weekend).
+    Returns: list of (response string, status code), one per prompt, in the
+             same order and with the same meaning as query_async().
+    """
+    results = [None] * len(prompts)
+
+    # STEP-1: Preprocess every prompt.
+    preprocessed = await asyncio.gather(
+        *[preprocess_query_async(prompt) for prompt in prompts]
+    )
+
+    # Serve cached answers, and compute identical incidents only once.
+    pending = {}
+    for i, (ret_val, query_metadata) in enumerate(preprocessed):
+        if ret_val != ERROR_CODE_SUCCESS:
+            results[i] = ("Invalid parameters", ret_val)
+            continue
+
+        cache_key = answer_cache_key(query_metadata, llm_choice)
+        cached_answer = await get_answer_cache().get_async(cache_key)
+        if cached_answer is not None:
+            results[i] = (cached_answer, HTTP_CODE_GENERIC_SUCCESS)
+            continue
+
+        pending.setdefault(cache_key, (query_metadata, []))[1].append(i)
+
+    if pending:
+        cache_keys = list(pending.keys())
+        answers = await answer_batch_async(
+            [pending[key][0] for key in cache_keys], cache_keys, llm_choice
+        )
+        for key, result in zip(cache_keys, answers):
+            for i in pending[key][1]:
+                results[i] = result
+
+    for _, ret_val in results:
+        count_query("batch", ret_val)
+    return results
+
+
+def query_batch(prompts, llm_choice: str = PARAM_GOOGLE_LLM):
+    # Blocking entry point for the CLI and tests.
+    return asyncio.run(query_batch_async(prompts, llm_choice))
+
+
+def query(user_query, llm_choice: str = PARAM_GOOGLE_LLM):
+    # Blocking entry point for the CLI and tests. The API server awaits
+    # query_async() directly.
+    with start_trace("query"):
+        return asyncio.run(query_async(user_query, llm_choice))
 
 
 def main(args=None):
@@ -1412,6 +4835,8 @@ def main(args=None):
             store_embeddings()
         if args.query:
             query(args.query)
+        if args.build_gazetteer:
+            write_gazetteer()
 
 
 if __name__ == "__main__":
@@ -1439,6 +4864,11 @@ if __name__ == "__main__":
         type=str,
         help="Query vector db and chat with LLM",
     )
+    parser.add_argument(
+        "--build-gazetteer",
+        action="store_true",
+        help="Regenerate the prebuilt country and demonym lookups",
+    )
     parser.add_argument(
         "--all",
         action="store_true",
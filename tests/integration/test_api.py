@@ -14,7 +14,7 @@ from fastapi.testclient import TestClient
 #project_src_path = os.path.join(current_dir, '..', '..', 'src')
 #sys.path.insert(0, project_src_path)
 
-from api.main import app
+from api.main import app, format_sse
 
 client = TestClient(app)
 
@@ -45,6 +45,57 @@ class TestAPIEndpoints:
         response = client.post("/")
         assert response.status_code == 405
 
+    def test_query_stream_requires_prompt(self):
+        """Test that the streaming endpoint validates its parameters"""
+        response = client.get("/query/stream")
+        assert response.status_code == 422
+
+    def test_query_batch_rejects_empty_list(self):
+        """Test that the batch endpoint needs at least one prompt"""
+        response = client.post("/query/batch", json={"prompts": []})
+        assert response.status_code == 422
+
+    def test_ingest_requires_url_or_steps(self):
+        """Test that an ingest request names exactly one kind of work"""
+        response = client.post("/ingest", json={})
+        assert response.status_code == 422
+
+    def test_ingest_rejects_invalid_weblink(self):
+        """Test that a URL ingest needs an actual weblink"""
+        response = client.post("/ingest", json={"url": "not a link"})
+        assert response.status_code == 422
+
+    def test_unknown_job_returns_404(self):
+        """Test that the job status endpoint reports unknown ids"""
+        response = client.get("/jobs/does-not-exist")
+        assert response.status_code == 404
+
+    def test_metrics_endpoint(self):
+        """Test that metrics are exposed in the Prometheus text format"""
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE rag_stage_duration_seconds histogram" in response.text
+        # Samples are labelled with the serving process.
+        assert f'rag_http_requests_in_flight{{worker="{os.getpid()}"}} 1' in response.text
+
+    def test_healthz(self):
+        """Test that liveness does not depend on the warm-up"""
+        response = client.get("/healthz")
+        assert response.status_code == 200
+        assert response.json()["status"] == "alive"
+
+    def test_readyz_reports_checks(self):
+        """Test that readiness reports every warm-up check"""
+        response = client.get("/readyz")
+        assert response.status_code in (200, 503)
+        assert set(response.json()["checks"]) == {"nlp", "gazetteers", "cpu_pool", "clients"}
+
+    def test_sse_format(self):
+        """Test that multi-line chunks are framed as one SSE event"""
+        assert format_sse("a\nb") == "data: a\ndata: b\n\n"
+        assert format_sse("", event="end") == "event: end\ndata: \n\n"
+
 
 class TestCORS:
     """Tests for CORS configuration"""
@@ -1,6 +1,10 @@
 import os
+import asyncio
+import time
+import threading
 import pytest
 from src.rag import rag
+from src.rag import benchmark
 
 class TestRag:
     def test_delete_file(self):
@@ -22,6 +26,64 @@ class TestRag:
         assert country_list is not None and len(country_list) > 0
         assert "Abu Dhabi".lower() in country_list
 
+    def test_gazetteer_matches_live_computation(self):
+        # Fails if country_converter/countryinfo or the overrides changed:
+        # regenerate with 'python src/rag/rag.py --build-gazetteer'.
+        locations, country_adjectives, stop_words = rag.load_gazetteer()
+        gazetteer = rag.build_gazetteer()
+        assert locations == set(gazetteer["locations"])
+        assert country_adjectives == gazetteer["country_adjectives"]
+        assert stop_words == set(gazetteer["stop_words"])
+        assert country_adjectives["turkish"] == "türkiye"
+
+    def test_location_matcher(self):
+        matcher = rag.get_location_matcher()
+
+        assert matcher.match("This is Japanese car") == ("japan", False)
+        assert matcher.match("2019 Sakhir Grand Prix") == ("bahrain", False)
+        assert matcher.match("infringement of Car 30 in 2024 abu dhabi GP") == ("abu dhabi", False)
+        # Unknown place: the last word in front of the GP marker.
+        assert matcher.match("2023 Las Vegas Grand Prix - Car 4") == ("vegas", False)
+        assert matcher.match("Car 30 penalty") == (None, False)
+        # Several countries are left to spaCy.
+        assert matcher.match("Car 30 Italian and French GP")[1]
+
+    def test_parse_metadata_bulk(self):
+        texts = [
+            "2024 British Grand Prix - Cars 16 and 55 - Pit lane speeding",
+            "2024 formula 1 sporting regulations",
+            "2019 Sakhir Grand Prix",
+            "2024 British Grand Prix - Cars 16 and 55 - Pit lane speeding",
+        ]
+        result = rag.parse_metadata_bulk(texts)
+
+        assert result == [rag.parse_metadata_from_text(text) for text in texts]
+        assert result[0]["location"] == "united kingdom"
+        assert result[1]["doc_type"] == "regulation"
+        # Every text gets its own dict, chunk_file() adds keys to it.
+        assert result[0] is not result[3]
+
+    def test_location_matcher_matches_nlp(self):
+        # Compiled matcher and spaCy path agree, see 'python src/rag/benchmark.py extract'.
+        assert benchmark.compare_extractors(rag, benchmark.EXTRACT_SAMPLES) == []
+
+    def test_import_is_lightweight(self):
+        # Importing rag must not need the deployment env nor load the heavy
+        # libraries: see 'python src/rag/benchmark.py import'.
+        env = benchmark.import_env()
+        for name in ["GCP_PROJECT", "ROOT_DIR", "OUTPUT_DIR", "CHROMADB_HOST", "CSV_ROOT"]:
+            env.pop(name, None)
+        elapsed_ms, heavy, records = benchmark.run_import(env)
+        assert heavy == []
+        assert any(module == "rag.rag" for _, _, module in records)
+
+    def test_process_memory(self):
+        # Used by 'python src/rag/benchmark.py serve'.
+        assert benchmark.process_tree(os.getpid())[0] == os.getpid()
+        rss_mb, pss_mb = benchmark.process_memory([os.getpid()])
+        assert 0 < pss_mb <= rss_mb
+        assert benchmark.percentile_ms([0.1, 0.2, 0.3], 50) == 200
+
     def test_denonyms(self):
         txt = "This is Japanese car"
         demonym_list = rag.extract_countries_using_demonyms(txt)
@@ -108,3 +170,442 @@ class TestRag:
         query = "Is the Car 30 infringement in 2024 Abu Dhabi Grand Prix a fair penalty?"
         ret_str, err_code = rag.query(query, "gemini-default")
         assert err_code == rag.HTTP_CODE_GENERIC_SUCCESS
+
+    def test_decision_filter(self):
+        metadata = {"year": "2024", "location": "abu dhabi", "car_num": "30"}
+        result = rag.create_decision_filter(metadata)
+
+        assert isinstance(result, dict)
+        assert {"car_num": "30"} in result["$and"]
+        assert rag.create_decision_filter({}) is None
+        assert rag.create_regulation_filter(metadata) == {"year": "2024"}
+
+    def test_slice_query_results(self):
+        results = {
+            "documents": [["d0", "d1", "d2"]],
+            "metadatas": [[{"chunk_id": "0"}, {"chunk_id": "1"}, {"chunk_id": "2"}]],
+        }
+        result = rag.slice_query_results(results, 2)
+
+        assert result["documents"] == [["d0", "d1"]]
+        assert len(result["metadatas"][0]) == 2
+
+    def test_context_assembler(self):
+        # Consecutive chunks of a document share up to CHUNK_OVERLAP chars.
+        results = {
+            "documents": [["car 30 left the track and", "track and gained an advantage.", "car 30 left the track and"]],
+            "metadatas": [[{"chunk_id": "doc_0"}, {"chunk_id": "doc_1"}, {"chunk_id": "copy_5"}]],
+        }
+        assembler = rag.ContextAssembler({"target": 100, "historical": 100, "regulation": 8})
+
+        target = rag.build_target_context(assembler, results)
+        assert target == ["car 30 left the track and gained an advantage."]
+        # The copy is a near-duplicate of the specific case.
+        assert rag.build_historical_context(assembler, results) == []
+
+        regulation = {"documents": [["article 33.4 " * 20]], "metadatas": [[None]]}
+        assert rag.build_regulation_context(assembler, regulation) == []
+        assert assembler.tokens == {"target": 12, "historical": 0, "regulation": 0}
+
+    def test_lru_cache(self):
+        cache = rag.LRUCache("test", 2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+
+        # "b" is the least recently used entry.
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+        assert cache.stats()["hits"] == 2
+
+    def test_answer_cache_key(self):
+        key_1 = rag.answer_cache_key({"car_num": "30", "location": "Abu Dhabi "}, "gemini-default")
+        key_2 = rag.answer_cache_key({"location": "abu dhabi", "car_num": "30", "doc_type": "decision"}, "gemini-default")
+        key_3 = rag.answer_cache_key({"car_num": "30", "location": "abu dhabi"}, "gemini-finetuned")
+
+        assert key_1 == key_2
+        assert key_1 != key_3
+
+    def test_answer_etag(self):
+        etag = rag.answer_etag("key", "answer")
+        assert etag != rag.answer_etag("key", "another answer")
+
+        assert rag.etag_matches(etag, etag) == etag
+        # Weak comparison, lists and the compressed variant also match; the
+        # variant the client holds is returned.
+        assert rag.etag_matches(f'"x", W/{etag[:-1]}-gzip"', etag) == f'{etag[:-1]}-gzip"'
+        assert rag.etag_matches("*", etag) == etag
+        assert rag.etag_matches('"x"', etag) is None
+        assert rag.etag_matches(None, etag) is None
+
+    def test_lru_cache_persistence(self):
+        db_path = "/tmp/test_lru_cache.sqlite"
+        if os.path.isfile(db_path):
+            rag.delete_file(db_path)
+
+        rag.LRUCache("test", 4, db_path=db_path).set("key", [0.1, 0.2])
+
+        # A fresh instance (e.g. after a restart) reads from the SQLite tier.
+        cache = rag.LRUCache("test", 4, db_path=db_path)
+        assert cache.get("key") == [0.1, 0.2]
+        assert cache.stats()["hits"] == 1
+        rag.delete_file(db_path)
+
+    def test_lru_cache_async_prune(self):
+        db_path = "/tmp/test_lru_cache_prune.sqlite"
+        if os.path.isfile(db_path):
+            rag.delete_file(db_path)
+
+        cache = rag.LRUCache("test", 4, db_path=db_path, max_db_items=2, db_prune_every=3)
+        for i in range(3):
+            asyncio.run(cache.set_async(f"key{i}", i))
+            time.sleep(0.01)
+
+        # Every third write keeps the newest 'max_db_items' entries on disk.
+        fresh = rag.LRUCache("test", 4, db_path=db_path, max_db_items=2)
+        assert asyncio.run(fresh.get_many_async(["key0", "key1", "key2"])) == {"key1": 1, "key2": 2}
+        assert fresh.stats() == {"size": 2, "hits": 2, "misses": 1}
+        rag.delete_file(db_path)
+
+    def test_metadata_index(self):
+        db_path = "/tmp/test_metadata_index.sqlite"
+        if os.path.isfile(db_path):
+            rag.delete_file(db_path)
+
+        rag.MetadataIndex(db_path).put_many([("doc", "2024 car 30", {"car_num": "30"})])
+
+        # A fresh instance (e.g. the next pipeline run) reads it back, unless
+        # the content it was derived from has changed.
+        index = rag.MetadataIndex(db_path)
+        assert index.get_many([("doc", "2024 car 30"), ("other", "x")]) == {"doc": {"car_num": "30"}}
+        assert index.get_many([("doc", "2024 car 31")]) == {}
+        assert rag.document_id("/data/embeddings-doc.jsonl") == "doc"
+        rag.delete_file(db_path)
+
+    def test_store_list_update(self):
+        store_list_file = "/tmp/test_store_list.csv"
+        if os.path.isfile(store_list_file):
+            rag.delete_file(store_list_file)
+
+        assert rag.read_store_list(store_list_file) == set()
+        rag.add_to_store_list(store_list_file, "embeddings-a.jsonl")
+        rag.add_to_store_list(store_list_file, "embeddings-b.jsonl")
+        rag.add_to_store_list(store_list_file, "embeddings-a.jsonl")
+        assert rag.read_store_list(store_list_file) == {"embeddings-a.jsonl", "embeddings-b.jsonl"}
+        rag.delete_file(store_list_file)
+
+    def test_embed_file_name(self):
+        assert rag.embed_file_name("/data/chunks-x/chunks-doc.jsonl") == "/data/chunks-x/embeddings-doc.jsonl"
+
+    def test_single_flight(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        async def run():
+            flights = rag.SingleFlight("test")
+            return await asyncio.gather(*[flights.do("key", compute) for _ in range(5)]), flights
+
+        results, flights = asyncio.run(run())
+        assert results == ["answer"] * 5
+        assert len(calls) == 1
+        assert flights.coalesced == 4
+        assert not flights.calls
+
+    def test_generate_with_fallback(self, monkeypatch):
+        class Response:
+            text = "answer"
+
+        class Model:
+            def __init__(self, name, delay, fail=False):
+                self.name, self.delay, self.fail = name, delay, fail
+
+            async def generate_content_async(self, prompt):
+                await asyncio.sleep(self.delay)
+                if self.fail:
+                    raise RuntimeError("endpoint down")
+                return Response()
+
+        models = {}
+        monkeypatch.setattr(rag, "get_llm_name", lambda choice: choice)
+        monkeypatch.setattr(rag, "get_llm_model", lambda name: models[name])
+        models[rag.PARAM_GOOGLE_LLM] = Model(rag.PARAM_GOOGLE_LLM, 0.01)
+
+        # A failing fine-tuned endpoint falls back to Gemini.
+        models["tuned"] = Model("tuned", 0, fail=True)
+        served, via, _ = asyncio.run(rag.generate_with_fallback("prompt", "tuned", 1))
+        assert (served, via) == (rag.PARAM_GOOGLE_LLM, "fallback")
+
+        # A slow model is hedged past its hedge delay, the first answer wins.
+        models["tuned"] = Model("tuned", 5)
+        monkeypatch.setattr(rag, "hedge_delay", lambda choice: 0.05)
+        served, via, _ = asyncio.run(rag.generate_with_fallback("prompt", "tuned", 1))
+        assert (served, via) == (rag.PARAM_GOOGLE_LLM, "hedge")
+
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(rag.generate_with_fallback("prompt", "tuned", 0.02))
+
+    def test_hedge_needs_admission_slot(self, monkeypatch):
+        class Response:
+            text = "answer"
+
+        class Model:
+            def __init__(self, delay):
+                self.delay = delay
+
+            async def generate_content_async(self, prompt):
+                await asyncio.sleep(self.delay)
+                return Response()
+
+        models = {"tuned": Model(0.2), rag.PARAM_GOOGLE_LLM: Model(0.01)}
+        monkeypatch.setattr(rag, "get_llm_name", lambda choice: choice)
+        monkeypatch.setattr(rag, "get_llm_model", lambda name: models[name])
+        monkeypatch.setattr(rag, "hedge_delay", lambda choice: 0.05)
+        gate = rag.AdmissionGate("llm", 1)
+        monkeypatch.setattr(rag, "admission_gates", {"llm": gate})
+
+        # The hedge takes the free slot and gives it back.
+        served, via, _ = asyncio.run(rag.generate_with_fallback("prompt", "tuned", 1))
+        assert (served, via) == (rag.PARAM_GOOGLE_LLM, "hedge")
+        assert gate.active == 0
+
+        # A saturated gate suppresses the hedge: the chosen model answers.
+        assert gate.try_acquire() and not gate.try_acquire()
+        served, via, _ = asyncio.run(rag.generate_with_fallback("prompt", "tuned", 1))
+        assert (served, via) == ("tuned", "primary")
+        assert gate.active == 1
+
+    def test_latency_window(self):
+        window = rag.LatencyWindow(size=100)
+        for i in range(rag.LLM_HEDGE_MIN_SAMPLES - 1):
+            window.observe(1)
+        assert window.percentile(95) is None
+        for i in range(100):
+            window.observe(i / 100)
+        assert window.percentile(95) == 0.95
+
+    def test_admission_gate(self):
+        async def hold(gate, seconds):
+            async with gate.slot():
+                await asyncio.sleep(seconds)
+
+        async def run():
+            gate = rag.AdmissionGate("test", 1, queue_size=1, queue_timeout=0.05)
+            holder = asyncio.ensure_future(hold(gate, 0.2))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(hold(gate, 0))
+            await asyncio.sleep(0)
+            assert gate.full()
+
+            # The queue is full: rejected right away.
+            with pytest.raises(rag.Overloaded) as full:
+                await hold(gate, 0)
+            # The waiter gives up after queue_timeout.
+            with pytest.raises(rag.Overloaded) as timeout:
+                await waiter
+            await holder
+            return gate, full.value, timeout.value
+
+        gate, full, timeout = asyncio.run(run())
+        assert (full.reason, timeout.reason) == ("queue_full", "queue_timeout")
+        assert full.retry_after >= 1
+        assert gate.active == 0 and not gate.waiters
+
+    def test_rate_limiter(self):
+        limiter = rag.RateLimiter(rate=1, burst=2)
+        assert limiter.acquire("a", now=0) == 0
+        assert limiter.acquire("a", now=0) == 0
+        assert limiter.acquire("a", now=0) == 1
+        # Buckets are per client and refill over time.
+        assert limiter.acquire("b", now=0) == 0
+        assert limiter.acquire("a", now=1) == 0
+
+    def test_retrieval_degradation(self, monkeypatch):
+        delays = {"target": 0, "historical": 0.5, "regulation": 0}
+
+        async def fake_query(name, **kwargs):
+            if name == rag.REGULATIONS_COLLECTION:
+                stage = "regulation"
+            else:
+                stage = "target" if "where" in kwargs else "historical"
+            await asyncio.sleep(delays[stage])
+            return {"documents": [[stage]], "metadatas": [[{}]]}
+
+        monkeypatch.setattr(rag, "query_or_raise", fake_query)
+        monkeypatch.setattr(rag, "create_decision_filter", lambda md: {"year": 2024})
+        monkeypatch.setattr(rag, "create_regulation_filter", lambda md: None)
+        monkeypatch.setattr(rag, "OPTIONAL_STAGE_MIN_SEC", 0.05)
+
+        async def run(optional_timeout):
+            rag.start_deadline()
+            results = await rag.retrieve_all_async([0.0], {}, timeout=1, optional_timeout=optional_timeout)
+            return results, rag.degraded_stages.get()
+
+        # The slow precedents are dropped, the regulations kept.
+        (target, broad, regulation), degraded = asyncio.run(run(0.1))
+        assert target["documents"] == [["target"]]
+        assert regulation["documents"] == [["regulation"]]
+        assert broad["documents"] == [[]]
+        assert degraded == {"historical": "timeout"}
+
+        # Without time for them, the optional stages are not even started.
+        (target, broad, regulation), degraded = asyncio.run(run(0))
+        assert target["documents"] == [["target"]]
+        assert degraded == {"historical": "skipped", "regulation": "skipped"}
+
+    def test_stage_budget(self):
+        async def run():
+            no_deadline = rag.stage_budget(5)
+            rag.start_deadline(2)
+            return no_deadline, rag.stage_budget(5), rag.stage_budget(), rag.stage_budget(5, reserve=3)
+
+        no_deadline, capped, left, reserved = asyncio.run(run())
+        assert no_deadline == 5
+        assert 1.9 < capped <= 2 and 1.9 < left <= 2
+        assert reserved == 0
+
+    def test_single_flight_cancel(self):
+        started = []
+
+        async def compute():
+            started.append(1)
+            await asyncio.sleep(10)
+
+        async def run():
+            flights = rag.SingleFlight("test")
+            callers = [asyncio.ensure_future(flights.do("key", compute)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            future = flights.calls["key"]
+
+            # The computation outlives the first caller, not the last one.
+            callers[0].cancel()
+            await asyncio.sleep(0)
+            alive = not future.done()
+            callers[1].cancel()
+            await asyncio.gather(*callers, return_exceptions=True)
+            await asyncio.sleep(0)
+            return alive, future.cancelled()
+
+        assert asyncio.run(run()) == (True, True)
+        assert len(started) == 1
+
+    def test_run_cpu(self, monkeypatch):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        monkeypatch.setattr(rag, "cpu_pool", pool)
+        try:
+            markers = asyncio.run(rag.run_cpu(rag.find_markers, "Fact speeding Decision fine Reason pit lane"))
+            assert markers == {"Fact": "speeding", "Decision": "fine", "Reason": "pit lane"}
+            assert rag.run_cpu_sync(rag.cpu_worker_pid) != os.getpid()
+        finally:
+            pool.shutdown()
+
+    def test_query_collection_reconnect(self, monkeypatch):
+        calls = []
+
+        class Collection:
+            async def query(self, **kwargs):
+                calls.append(kwargs)
+                if len(calls) == 1:
+                    raise kwargs["error"]
+                return {"documents": [["doc"]]}
+
+        async def get_collection(name):
+            return Collection()
+
+        monkeypatch.setattr(rag, "get_async_collection", get_collection)
+        monkeypatch.setattr(rag, "reset_chroma_clients", lambda: calls.append("reset"))
+
+        # A bad request is raised as is, without touching the shared clients.
+        with pytest.raises(ValueError):
+            asyncio.run(rag.query_collection_async("test", error=ValueError("Invalid where clause")))
+        assert "reset" not in calls
+
+        # A lost connection or a recreated collection reconnects once.
+        calls.clear()
+        results = asyncio.run(rag.query_collection_async("test", error=ConnectionError("refused")))
+        assert results == {"documents": [["doc"]]} and "reset" in calls
+
+    def test_job_queue_priority(self):
+        release = threading.Event()
+
+        def bulk():
+            release.wait(5)
+            return "bulk", rag.ERROR_CODE_SUCCESS
+
+        async def run():
+            # Even with INGEST_WORKERS=1 a bulk job cannot take every worker.
+            queue = rag.JobQueue(num_workers=1, max_bulk_workers=1)
+            first = await queue.submit("bulk", bulk, rag.JOB_PRIORITY_BULK)
+            second = await queue.submit("bulk", bulk, rag.JOB_PRIORITY_BULK)
+            url = await queue.submit("url", lambda: ("url", rag.ERROR_CODE_SUCCESS), rag.JOB_PRIORITY_INTERACTIVE)
+            await url.wait()
+            bulk_status = (first.status, second.status)
+            release.set()
+            await asyncio.gather(first.wait(), second.wait())
+            await queue.close()
+            return url, bulk_status
+
+        url_job, bulk_status = asyncio.run(run())
+        assert bulk_status == (rag.JOB_STATUS_RUNNING, rag.JOB_STATUS_QUEUED)
+        assert url_job.status == rag.JOB_STATUS_DONE
+        assert url_job.to_dict()["result"] == "url"
+
+    def test_histogram_render(self):
+        histogram = rag.Histogram("test_latency_seconds", "Test.", ["stage"], buckets=(0.1, 1))
+        rag.metrics_registry.remove(histogram)
+        histogram.observe(0.05, "embed")
+        histogram.observe(0.5, "embed")
+        histogram.observe(5, "embed")
+
+        lines = histogram.render()
+        assert 'test_latency_seconds_bucket{stage="embed",le="0.1"} 1' in lines
+        assert 'test_latency_seconds_bucket{stage="embed",le="1"} 2' in lines
+        assert 'test_latency_seconds_bucket{stage="embed",le="+Inf"} 3' in lines
+        assert 'test_latency_seconds_count{stage="embed"} 3' in lines
+
+    def test_count_query_errors(self):
+        rag.count_query("test", rag.ERROR_CODE_CHROMADB_FAILED)
+        assert rag.QUERY_ERRORS.values[("test", "ERROR_CODE_CHROMADB_FAILED")] >= 1
+
+    def test_trace_spans(self):
+        with rag.trace_span("untraced") as span:
+            assert span is None
+
+        with rag.start_trace("query", force=True) as trace:
+            with rag.stage_timer("retrieval"):
+                with rag.trace_span("chroma_query"):
+                    rag.trace_attributes(chunks=5)
+            rag.trace_attributes(status=200)
+
+        assert rag.current_trace.get() is None
+        breakdown = trace.breakdown()
+        assert [span["name"] for span in breakdown["spans"]] == ["retrieval", "chroma_query"]
+        assert breakdown["spans"][1]["parent"] == "retrieval"
+        assert breakdown["spans"][1]["attributes"] == {"chunks": 5}
+        assert breakdown["attributes"] == {"status": 200}
+
+        otlp_spans = trace.to_otlp()["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        assert otlp_spans[2]["parentSpanId"] == otlp_spans[1]["spanId"]
+        assert otlp_spans[2]["attributes"] == [{"key": "chunks", "value": {"intValue": "5"}}]
+
+    def test_group_by_filter(self):
+        filters = [{"year": "2024"}, None, {"year": "2024"}, {"year": "2023"}]
+        groups = rag.group_by_filter(filters)
+
+        assert len(groups) == 3
+        assert ({"year": "2024"}, [0, 2]) in groups
+        assert (None, [1]) in groups
+
+    def test_split_query_results(self):
+        results = {"documents": [["a"], ["b"]], "metadatas": [[{}], [{}]]}
+        split = rag.split_query_results(results)
+
+        assert len(split) == 2
+        assert split[1]["documents"] == [["b"]]